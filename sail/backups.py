@@ -1,7 +1,10 @@
-from sail import cli, util
+from sail import cli, util, database
 
 import requests, json, os, subprocess, time
 import click, hashlib, pathlib, shutil
+import re, shlex
+import gzip, tempfile, zlib
+import bisect, tarfile
 from datetime import datetime
 
 @cli.group(invoke_without_command=True)
@@ -27,8 +30,11 @@ def restore_compat(ctx, path, yes, skip_db, skip_uploads):
 @click.option('--yes', '-y', is_flag=True, help='Skip the AYS message and force yes')
 @click.option('--skip-db', is_flag=True, help='Do not import the database')
 @click.option('--skip-uploads', is_flag=True, help='Do not import uploads')
-def restore(path, yes, skip_db, skip_uploads):
-	'''Restore your application files, uploads and database from a backup file'''
+@click.option('--parallel', type=click.IntRange(1, 64), default=4, help='Threads for importing per-table database backups')
+@click.option('--only', multiple=True, help='Only restore this file or directory, relative to the application root')
+@click.option('--table', 'tables', multiple=True, help='Only restore this database table')
+def restore(path, yes, skip_db, skip_uploads, parallel, only, tables):
+	'''Restore your application files, uploads and database from a backup snapshot or archive'''
 	root = util.find_root()
 	config = util.config()
 	c = util.connection()
@@ -37,189 +43,1060 @@ def restore(path, yes, skip_db, skip_uploads):
 	if not path.exists():
 		raise util.SailException('File does not exist')
 
-	if path.name.endswith('.sql.gz') or path.name.endswith('.sql'):
+	if re.search(r'\.sql(\.gz|\.zst|\.d)?$', path.name):
 		raise util.SailException('Looks like a database-only backup. Try: sail db import')
 
-	if not path.name.endswith('.tar.gz'):
+	if path.is_dir() and not (path / 'www').is_dir():
+		raise util.SailException('Doesn\'t look like a backup snapshot')
+
+	if path.is_file() and not re.search(r'\.tar\.(gz|zst)$', path.name):
 		raise util.SailException('Doesn\'t look like a backup file')
 
+	if only or tables:
+		if not yes:
+			click.confirm('This will restore parts of a backup to production. Continue?', abort=True)
+
+		util.heading('Restoring local backup')
+		_restore_partial(c, path, only, tables, parallel)
+		util.success('Backup restored successfully. Local copy may be out of date.')
+		return
+
 	if not yes:
 		click.confirm('This will restore a full backup to production. Continue?', abort=True)
 
 	util.heading('Restoring local backup')
 
-	app_id = config['app_id']
+	# Snapshots are restored in place.
+	if path.is_dir():
+		_restore(c, path, skip_db, skip_uploads, parallel)
+		util.success('Backup restored successfully. Local copy may be out of date.')
+		return
+
 	backups_dir = pathlib.Path(root + '/.backups')
 	backups_dir.mkdir(parents=True, exist_ok=True)
 	progress_dir = pathlib.Path(backups_dir / ('.%s.progress' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]))
 	progress_dir.mkdir()
-	remote_path = util.remote_path()
-
-	database_filename = 'database.%s.sql.gz' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]
 
-	util.item('Extracting backup files')
-
-	p = subprocess.Popen([
-		'tar', ('-xzvf' if util.debug() else '-xzf'), path.resolve(), '--directory', progress_dir.resolve()
-	])
+	try:
+		util.item('Extracting backup files')
+		_extract(path, progress_dir)
+		_restore(c, progress_dir, skip_db, skip_uploads, parallel)
+	finally:
+		shutil.rmtree(progress_dir)
 
-	while p.poll() is None:
-		util.loader()
+	util.success('Backup restored successfully. Local copy may be out of date.')
 
-	if p.returncode != 0:
-		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred during backup. Please try again.')
+def _restore(c, source, skip_db, skip_uploads, parallel):
+	'''Restore uploads, application files and database from an unpacked backup'''
+	config = util.config()
+	remote_path = util.remote_path()
 
-	for x in progress_dir.iterdir():
-		if x.name not in ['www', 'database.sql.gz', 'uploads']:
-			shutil.rmtree(progress_dir)
+	for x in source.iterdir():
+		if x.name not in ['www', 'database.sql', 'database.sql.gz', 'database.sql.zst', 'database.sql.manifest.json', 'database', 'uploads']:
 			raise util.SailException('Unexpected file in backup archive: %s' % x.name)
 
+	for name in ['database.sql', 'database.sql.zst', 'database.sql.gz']:
+		database_file = source / name
+		if database_file.exists():
+			break
+
 	if skip_uploads:
 		util.item('Skipping uploads')
 	else:
 		util.item('Importing uploads')
 
 		args = ['-rtl', '--delete', '--rsync-path', 'sudo -u www-data rsync']
-		source = '%s/uploads/' % progress_dir
+		source_uploads = '%s/uploads/' % source
 		destination = 'root@%s:%s/uploads/' % (config['hostname'], remote_path)
-		returncode, stdout, stderr = util.rsync(args, source, destination, default_filters=False)
+		returncode, stdout, stderr = util.rsync(args, source_uploads, destination, default_filters=False)
 
 		if returncode != 0:
-			shutil.rmtree(progress_dir)
 			raise util.SailException('An error occurred during restore. Please try again.')
 
 	util.item('Importing application files')
 
 	args = ['-rtl', '--delete', '--rsync-path', 'sudo -u www-data rsync']
-	source = '%s/www/' % progress_dir
+	source_www = '%s/www/' % source
 	destination = 'root@%s:%s/public/' % (config['hostname'], remote_path)
-	returncode, stdout, stderr = util.rsync(args, source, destination)
+	returncode, stdout, stderr = util.rsync(args, source_www, destination)
 
 	if returncode != 0:
-		shutil.rmtree(progress_dir)
 		raise util.SailException('An error occurred during restore. Please try again.')
 
 	if skip_db:
 		util.item('Skipping database import')
+	elif (source / 'database').is_dir():
+		util.item('Importing database into MySQL (%d threads)' % parallel)
+		database._restore_parallel(c, source / 'database', parallel)
+	elif (source / 'database.sql.manifest.json').exists():
+		util.item('Reassembling database from the backup repository')
+
+		with tempfile.TemporaryDirectory(dir=_repository().parent) as temp_dir:
+			database_file = pathlib.Path(temp_dir) / 'database.sql.gz'
+			_materialize(source / 'database.sql.manifest.json', database_file)
+			_restore_database(c, database_file)
 	else:
+		_restore_database(c, database_file)
+
+def _restore_partial(c, path, only, tables, parallel):
+	'''Restore some paths and database tables from a snapshot or archive'''
+	root = util.find_root()
+	config = util.config()
+	remote_path = util.remote_path()
+
+	# Paths in the backup, application files are under www, uploads are separate.
+	paths = []
+	for p in only:
+		p = p.strip('/')
+		if p == 'wp-content/uploads' or p.startswith('wp-content/uploads/'):
+			paths.append('uploads' + p[len('wp-content/uploads'):])
+		else:
+			paths.append(('www/' + p).rstrip('/'))
+
+	index = _load_archive_index(path) if path.is_file() else None
+
+	backups_dir = pathlib.Path(root + '/.backups')
+	backups_dir.mkdir(parents=True, exist_ok=True)
+
+	with tempfile.TemporaryDirectory(dir=backups_dir) as temp_dir:
+		temp_dir = pathlib.Path(temp_dir)
+		source = path
+
+		if path.is_file():
+			source = temp_dir / 'source'
+			source.mkdir()
+
+			if index:
+				util.item('Reading requested files from the archive index')
+				prefixes = paths + [m['name'] for m in index['members']
+					if m['name'].startswith('database/') and _table_file(m['name'][len('database/'):], tables)]
+				_extract_members(path, index, prefixes, source)
+			else:
+				util.item('Archive has no index, extracting all backup files')
+				_extract(path, source)
+
+		for p in paths:
+			if not (source / p).exists():
+				raise util.SailException('Could not find %s in backup' % p.split('/', 1)[-1])
+
+			section, _, relative = p.partition('/')
+			util.item('Restoring %s' % (relative if section == 'www' else 'wp-content/uploads/' + relative).rstrip('/'))
+
+			# Include the path and its parents, --delete only applies to what is included.
+			filters = []
+			parts = relative.split('/') if relative else []
+			for i in range(1, len(parts) + 1):
+				filters.append('+ /%s' % '/'.join(parts[:i]))
+			if parts:
+				filters += ['+ /%s/***' % relative, '- *']
+
+			args = ['-rtl', '--delete', '--rsync-path', 'sudo -u www-data rsync']
+			destination = 'root@%s:%s/%s/' % (config['hostname'], remote_path, 'public' if section == 'www' else 'uploads')
+			returncode, stdout, stderr = util.rsync(args, '%s/%s/' % (source, section), destination,
+				default_filters=False, extend_filters=filters)
+
+			if returncode != 0:
+				raise util.SailException('An error occurred during restore. Please try again.')
+
+		if not tables:
+			return
+
+		if (source / 'database').is_dir():
+			database_dir = temp_dir / 'database'
+			database_dir.mkdir()
+			for x in (source / 'database').iterdir():
+				if _table_file(x.name, tables):
+					shutil.copy(x, database_dir)
+
+			util.item('Importing %d tables into MySQL (%d threads)' % (len(tables), parallel))
+			database._restore_parallel(c, database_dir, parallel)
+			return
+
+		database_file = temp_dir / 'database.sql'
+
+		if index and index['tables']:
+			util.item('Reading tables from the archive index')
+			member = [m for m in index['members'] if m['name'] == 'database.sql'][0]
+			reader = _ArchiveReader(path, index)
+			try:
+				_write_tables(lambda start, length, f: reader.read(member['data'] + start, length, f),
+					index['tables'], tables, database_file)
+			finally:
+				reader.close()
+		else:
+			util.item('Reading tables from the database dump')
+			plain_file = temp_dir / 'database.full.sql'
+			_plain_dump(source, plain_file)
+
+			with open(plain_file, 'rb') as plain:
+				def read(start, length, f):
+					plain.seek(start)
+					f.write(plain.read(length))
+
+				_write_tables(read, _index_tables(plain_file), tables, database_file)
+
+		_restore_database(c, database_file)
+
+def _table_file(name, tables):
+	'''Whether a mydumper output file belongs to one of the tables'''
+	if name == 'metadata':
+		return True
+
+	m = re.match(r'^[^.]+\.(.+?)(?:-schema(?:-triggers)?|\.\d+)?\.sql(?:\.gz|\.zst)?$', name)
+	return bool(m) and m.group(1) in tables
+
+def _write_tables(read, index, tables, target):
+	'''Write the header, the requested table sections and the footer of a dump'''
+	missing = [t for t in tables if t not in index['tables']]
+	if missing:
+		raise util.SailException('Could not find table in backup: %s' % ', '.join(missing))
+
+	with open(target, 'wb') as f:
+		start, end = index['header']
+		read(start, end - start, f)
+
+		for table in tables:
+			start, end = index['tables'][table]
+			read(start, end - start, f)
+
+		start, end = index['footer']
+		read(start, end - start, f)
+
+def _restore_database(c, database_file):
+	'''Upload a single-file database dump and import it into the live database'''
+	config = util.config()
+	remote_path = util.remote_path()
+
+	# Not the repository, which would create its chunk directories as a side effect.
+	backups_dir = pathlib.Path(util.find_root()) / '.backups'
+	backups_dir.mkdir(parents=True, exist_ok=True)
+
+	with tempfile.TemporaryDirectory(dir=backups_dir) as temp_dir:
+		# Plain dumps from seekable archives are compressed for the upload.
+		if util.detect_compression(database_file) is None:
+			util.item('Compressing database backup')
+			database_file = _compress_dump(database_file, pathlib.Path(temp_dir))
+
+		database_filename = 'database.%s%s' % (hashlib.sha256(os.urandom(32)).hexdigest()[:8], database_file.name[len('database'):])
+
 		util.item('Uploading database backup')
 
 		args = ['-t']
-		source = '%s/database.sql.gz' % progress_dir
 		destination = 'root@%s:%s/%s' % (config['hostname'], remote_path, database_filename)
-		returncode, stdout, stderr = util.rsync(args, source, destination, default_filters=False)
+		returncode, stdout, stderr = util.rsync(args, database_file, destination, default_filters=False)
 
 		if returncode != 0:
-			shutil.rmtree(progress_dir)
 			raise util.SailException('An error occurred in rsync. Please try again.')
 
-		util.item('Importing database into MySQL')
+		compression = util.detect_compression(database_file)
 
-		# TODO: Maybe do an atomic import which deletes tables that no longer exist
-		# by doing a rename.
-		try:
-			c.run('zcat %s/%s | mysql -uroot "wordpress_%s"' % (remote_path, database_filename, config['namespace']))
-		except:
-			shutil.rmtree(progress_dir)
-			raise util.SailException('An error occurred in SSH. Please try again.')
+	util.item('Importing database into MySQL')
 
-		util.item('Cleaning up production')
+	# TODO: Maybe do an atomic import which deletes tables that no longer exist
+	# by doing a rename.
+	try:
+		if compression == 'zstd':
+			util.ensure_command(c, 'zstd')
 
-		try:
-			c.run('rm %s/%s' % (remote_path, database_filename)) # TODO: Move to /tmp maybe, or /root
-		except:
-			shutil.rmtree(progress_dir)
-			raise util.SailException('An error occurred in SSH. Please try again.')
+		c.run('%s < %s/%s | mysql -uroot "wordpress_%s"' % (util.decompress_command(compression),
+			remote_path, database_filename, config['namespace']))
+	except:
+		raise util.SailException('An error occurred in SSH. Please try again.')
 
-	shutil.rmtree(progress_dir)
+	util.item('Cleaning up production')
 
-	util.success('Backup restored successfully. Local copy may be out of date.')
+	try:
+		c.run('rm %s/%s' % (remote_path, database_filename)) # TODO: Move to /tmp maybe, or /root
+	except:
+		raise util.SailException('An error occurred in SSH. Please try again.')
 
 @backup.command()
-def create():
-	'''Backup your production files and database to your local .backups directory'''
+@click.option('--compression', type=click.Choice(list(util.compressors)), default='zstd', help='Database compression format, zstd (default) or gzip')
+@click.option('--level', type=int, help='Compression level, 1-19 for zstd (default 6), 1-9 for gzip (default 9)')
+@click.option('--threads', type=click.IntRange(0, 64), default=0, help='Compression threads for zstd, 0 uses all cores')
+@click.option('--parallel', type=click.IntRange(1, 64), help='Dump database tables with this many threads')
+@click.option('--dedupe/--no-dedupe', default=True, help='Store the database dump in the deduplicating backup repository, with one row per INSERT for better deduplication (a larger, slower dump, batched again on import)')
+@click.option('--extended-insert', is_flag=True, help='Keep extended INSERTs in a --dedupe dump, faster to dump but deduplicates poorly')
+def create(compression, level, threads, parallel, dedupe, extended_insert):
+	'''Backup your production files and database to an incremental snapshot in .backups'''
 	root = util.find_root()
 	config = util.config()
-	c = util.connection()
 
 	util.heading('Creating a local backup')
 
-	app_id = config['app_id']
-	backups_dir = pathlib.Path(root + '/.backups')
-	backups_dir.mkdir(parents=True, exist_ok=True)
-	progress_dir = pathlib.Path(backups_dir / ('.%s.progress' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]))
+	snapshots_dir = pathlib.Path(root + '/.backups/snapshots')
+	snapshots_dir.mkdir(parents=True, exist_ok=True)
+	timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+	progress_dir = pathlib.Path(snapshots_dir / ('.%s.progress' % timestamp))
 	(progress_dir / 'www').mkdir(parents=True)
 	(progress_dir / 'uploads').mkdir()
 	remote_path = util.remote_path()
 
-	database_filename = 'database.%s.sql.gz' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]
+	# Unchanged files are hard-linked to the previous snapshot. The very first
+	# snapshot copies what it can from the working copy instead.
+	previous = _snapshots()
+	previous = previous[-1] if previous else None
 
-	util.item('Downloading application files')
+	if previous:
+		util.item('Linking unchanged files to snapshot %s' % previous.name)
 
-	args = ['-rtl', '--copy-dest', '%s/' % root]
-	source = 'root@%s:%s/public/' % (config['hostname'], remote_path)
-	destination = '%s/www/' % progress_dir
-	returncode, stdout, stderr = util.rsync(args, source, destination)
+	try:
+		util.item('Downloading application files')
 
-	if returncode != 0:
-		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred during backup. Please try again.')
+		args = ['-rtl']
+		if previous:
+			args += ['--link-dest', '%s/www/' % previous.resolve()]
+		else:
+			args += ['--copy-dest', '%s/' % root]
 
-	util.item('Downloading uploads')
+		source = 'root@%s:%s/public/' % (config['hostname'], remote_path)
+		destination = '%s/www/' % progress_dir
+		returncode, stdout, stderr = util.rsync(args, source, destination)
 
-	args = ['-rtl', '--copy-dest', '%s/wp-content/uploads/' % root]
-	source = 'root@%s:%s/uploads/' % (config['hostname'], remote_path)
-	destination = '%s/uploads/' % progress_dir
-	returncode, stdout, stderr = util.rsync(args, source, destination, default_filters=False)
+		if returncode != 0:
+			raise util.SailException('An error occurred during backup. Please try again.')
 
-	if returncode != 0:
-		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred during backup. Please try again.')
+		util.item('Downloading uploads')
 
-	util.item('Exporting WordPress database')
+		args = ['-rtl']
+		if previous:
+			args += ['--link-dest', '%s/uploads/' % previous.resolve()]
+		else:
+			args += ['--copy-dest', '%s/wp-content/uploads/' % root]
 
-	try:
-		c.run('mysqldump --quick --single-transaction --default-character-set=utf8mb4 -uroot "wordpress_%s" | gzip -c9 > %s/%s' % (config['namespace'], remote_path, database_filename))
+		source = 'root@%s:%s/uploads/' % (config['hostname'], remote_path)
+		destination = '%s/uploads/' % progress_dir
+		returncode, stdout, stderr = util.rsync(args, source, destination, default_filters=False)
+
+		if returncode != 0:
+			raise util.SailException('An error occurred during backup. Please try again.')
+
+		util.item('Exporting WordPress database')
+
+		if parallel:
+			(progress_dir / 'database').mkdir()
+			database._export_parallel(util.connection(), progress_dir / 'database', parallel)
+		else:
+			# The repository stores plain SQL, so the dump has to be decompressed locally.
+			# Rows are dumped one per INSERT unless --extended-insert, so an added row
+			# does not shift every extended INSERT after it. They are batched again on
+			# reassembly.
+			if dedupe and compression == 'zstd' and not shutil.which('zstd'):
+				util.item('zstd not found locally, using gzip for the database dump')
+				compression, level = 'gzip', None
+
+			if compression == 'zstd':
+				util.ensure_command(util.connection(), 'zstd')
+
+			database_file = progress_dir / ('database.sql' + util.compressors[compression]['ext'])
+			with open(database_file, 'wb') as f:
+				util.ssh_stream(database._dump_command(config['namespace'], compression, level, threads,
+					extended_insert=extended_insert or not dedupe), f)
+
+			if dedupe:
+				util.item('Storing database in the backup repository')
+				manifest = _store(database_file)
+				database_file.unlink()
+
+				with open(progress_dir / 'database.sql.manifest.json', 'w') as f:
+					json.dump(manifest, f)
+
+				util.item('Added %d new of %d chunks (%s of %s)' % (manifest['new_chunks'], len(manifest['chunks']),
+					util.sizeof_fmt(manifest['new_size']), util.sizeof_fmt(manifest['size'])))
 	except:
 		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred in SSH. Please try again.')
+		raise
 
-	util.item('Export completed, downloading database')
+	progress_dir.rename(snapshots_dir / timestamp)
 
-	args = ['-t']
-	source = 'root@%s:%s/%s' % (config['hostname'], remote_path, database_filename)
-	destination = '%s/database.sql.gz' % progress_dir
-	returncode, stdout, stderr = util.rsync(args, source, destination, default_filters=False)
+	util.success('Backup completed at .backups/snapshots/%s' % timestamp)
 
-	if returncode != 0:
-		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred in rsync. Please try again.')
+@backup.command()
+@click.argument('snapshot', nargs=1, required=False)
+@click.option('--compression', type=click.Choice(list(util.compressors)), default='zstd', help='Archive compression format, zstd (default) or gzip')
+@click.option('--level', type=int, help='Compression level, 1-19 for zstd (default 6), 1-9 for gzip (default 9)')
+@click.option('--threads', type=click.IntRange(0, 64), default=0, help='Compression threads for zstd, 0 uses all cores')
+def export(snapshot, compression, level, threads):
+	'''Export a backup snapshot (latest by default) to a compressed archive'''
+	root = util.find_root()
+	snapshot = _resolve_snapshot(snapshot)
 
-	util.item('Cleaning up production')
+	util.heading('Exporting backup snapshot %s' % snapshot.name)
+
+	if compression == 'zstd' and not shutil.which('zstd'):
+		util.item('zstd not found locally, compressing archive with gzip')
+		compression, level = 'gzip', None
+
+	filename = snapshot.name + '.tar' + util.compressors[compression]['ext']
+	target = pathlib.Path(root + '/.backups') / filename
+
+	with tempfile.TemporaryDirectory(dir=pathlib.Path(root + '/.backups')) as temp_dir:
+		database_file = None
+
+		# Single-file dumps are stored as plain SQL, so tables can be read individually.
+		if not (snapshot / 'database').is_dir():
+			util.item('Preparing database dump')
+			database_file = pathlib.Path(temp_dir) / 'database.sql'
+			_plain_dump(snapshot, database_file)
+
+		util.item('Archiving and compressing backup files')
+		_archive(snapshot, target, compression, level, threads, database_file)
+
+	util.success('Backup exported to .backups/%s' % filename)
+
+@backup.command('ls')
+@click.argument('path', nargs=1, required=True)
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def ls(path, as_json):
+	'''List the contents of a backup archive'''
+	path = pathlib.Path(path)
+	if not path.is_file():
+		raise util.SailException('File does not exist')
+
+	index = _load_archive_index(path)
+
+	if index:
+		members = [{'name': m['name'], 'size': m['size'], 'mtime': m['mtime'], 'type': m['type']}
+			for m in index['members']]
+		tables = list(index['tables']['tables']) if index['tables'] else None
+	else:
+		# Archives without an index have to be read in full.
+		compression = util.detect_compression(path)
+		if compression == 'zstd' and not shutil.which('zstd'):
+			raise util.SailException('This backup is compressed with zstd, please install zstd and try again.')
+
+		members = []
+		with open(path, 'rb') as f:
+			decompressor = subprocess.Popen(shlex.split(util.decompress_command(compression)),
+				stdin=f, stdout=subprocess.PIPE)
+
+			with tarfile.open(fileobj=decompressor.stdout, mode='r|') as tar:
+				for tarinfo in tar:
+					members.append({'name': tarinfo.name, 'size': tarinfo.size, 'mtime': tarinfo.mtime,
+						'type': tarinfo.type.decode()})
+
+			decompressor.wait()
+
+		tables = None
+
+	if as_json:
+		click.echo(json.dumps({'members': members, 'tables': tables}))
+		return
+
+	for member in members:
+		name = member['name'] + ('/' if member['type'] == tarfile.DIRTYPE.decode() else '')
+		click.echo('%10s  %s  %s' % (util.sizeof_fmt(member['size']),
+			datetime.fromtimestamp(member['mtime']).strftime('%Y-%m-%d %H:%M'), name))
+
+	if tables:
+		click.echo()
+		click.echo('Tables: %s' % ', '.join(tables))
+
+@backup.command()
+@click.option('--keep', type=click.IntRange(1), required=True, help='Number of most recent snapshots to keep')
+@click.option('--dry-run', is_flag=True, help='Show what would be deleted without deleting anything')
+def prune(keep, dry_run):
+	'''Delete old backup snapshots and unreferenced repository chunks'''
+	util.heading('Pruning local backups')
+
+	snapshots = _snapshots()
+	remove = snapshots[:max(len(snapshots) - keep, 0)]
+
+	for snapshot in remove:
+		util.item('Removing snapshot %s' % snapshot.name)
+		if not dry_run:
+			shutil.rmtree(snapshot)
+
+	referenced = set()
+	for snapshot in snapshots:
+		if snapshot in remove:
+			continue
+
+		manifest = snapshot / 'database.sql.manifest.json'
+		if manifest.exists():
+			with open(manifest) as f:
+				referenced.update(json.load(f)['chunks'])
+
+	# Files are removed by what's on disk, not by the index, so orphans of
+	# interrupted or failed runs and leftover .tmp files go too.
+	index = _load_index()
+	unreferenced = [path for path in _chunk_files() if path.name not in referenced]
+	freed = sum(path.stat().st_size for path in unreferenced)
+
+	util.item('Removing %d unreferenced chunks (%s)' % (len(unreferenced), util.sizeof_fmt(freed)))
+
+	if not dry_run:
+		for path in unreferenced:
+			path.unlink(missing_ok=True)
+
+		_save_index({h: value for h, value in index.items() if h in referenced})
+
+	util.success('Pruned %d snapshots%s' % (len(remove), ' (dry run)' if dry_run else ''))
+
+@backup.command()
+@click.option('--quick', is_flag=True, help='Only check that chunks exist, do not read and verify their contents')
+def check(quick):
+	'''Verify the integrity of backup snapshots and the backup repository'''
+	util.heading('Checking local backups')
+
+	repository = _repository()
+	index = _load_index()
+	problems = 0
+	verified = set()
+
+	for snapshot in _snapshots():
+		manifest_path = snapshot / 'database.sql.manifest.json'
+		if not manifest_path.exists():
+			continue
+
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+
+		util.item('Checking snapshot %s' % snapshot.name)
+		checksum = hashlib.sha256()
+
+		for h in manifest['chunks']:
+			if h not in index:
+				util.item('Chunk missing from index: %s' % h)
+				problems += 1
+
+			path = repository / 'chunks' / h[:2] / h
+			if not path.exists():
+				util.item('Missing chunk: %s' % h)
+				problems += 1
+				continue
+
+			if quick:
+				continue
+
+			try:
+				chunk = _read_chunk(h)
+			except Exception as e:
+				util.dlog(repr(e))
+				chunk = None
+
+			if chunk is None or (h not in verified and hashlib.sha256(chunk).hexdigest() != h):
+				util.item('Corrupt chunk: %s' % h)
+				problems += 1
+				continue
+
+			verified.add(h)
+			checksum.update(chunk)
+
+		if not quick and checksum.hexdigest() != manifest['sha256']:
+			util.item('Checksum mismatch in snapshot %s' % snapshot.name)
+			problems += 1
+
+	referenced = set()
+	for snapshot in _snapshots():
+		manifest_path = snapshot / 'database.sql.manifest.json'
+		if manifest_path.exists():
+			with open(manifest_path) as f:
+				referenced.update(json.load(f)['chunks'])
+
+	orphans = [path for path in _chunk_files() if path.name not in referenced]
+	if orphans:
+		util.item('Found %d unreferenced chunk files (%s), run sail backup prune to remove them' % (
+			len(orphans), util.sizeof_fmt(sum(path.stat().st_size for path in orphans))))
+
+	if problems:
+		raise util.SailException('Backup check found %d problems' % problems)
+
+	util.success('All backups verified')
+
+def _snapshots():
+	'''Completed backup snapshots, oldest first'''
+	root = util.find_root()
+	snapshots_dir = pathlib.Path(root + '/.backups/snapshots')
+
+	if not snapshots_dir.is_dir():
+		return []
+
+	return sorted([p for p in snapshots_dir.iterdir() if p.is_dir() and not p.name.startswith('.')])
+
+def _resolve_snapshot(snapshot=None):
+	'''Find a snapshot by name or path, defaults to the latest one'''
+	snapshots = _snapshots()
+
+	if not snapshot:
+		if not snapshots:
+			raise util.SailException('No backup snapshots found. Create one with: sail backup')
+		return snapshots[-1]
+
+	path = pathlib.Path(snapshot)
+	if path.is_dir():
+		return path
+
+	for p in snapshots:
+		if p.name == snapshot:
+			return p
+
+	raise util.SailException('Could not find backup snapshot: %s' % snapshot)
+
+# Seekable archives. The tarball is compressed in independent frames of about
+# FRAME_SIZE bytes, cut at member boundaries where possible. Concatenated gzip
+# members and zstd frames are still a regular .tar.gz/.tar.zst, and a sidecar
+# .index.json maps members and database tables to frames for selective reads.
+FRAME_SIZE = 16 * 1024 * 1024
+
+class _FrameWriter:
+	'''A write-only file object which compresses its input in independent frames'''
+	def __init__(self, f, compression, level=None, threads=0):
+		self.f = f
+		self.compression = compression
+		self.level = level
+		self.threads = threads
+		self.buffer = bytearray()
+		self.offset = 0
+		self.frames = []
+
+	def write(self, data):
+		self.buffer += data
+
+		# Very large members are split across frames.
+		if len(self.buffer) >= 4 * FRAME_SIZE:
+			self.flush()
+
+		return len(data)
+
+	def tell(self):
+		return self.offset + len(self.buffer)
+
+	def boundary(self):
+		if len(self.buffer) >= FRAME_SIZE:
+			self.flush()
+
+	def flush(self):
+		if not self.buffer:
+			return
+
+		data = _compress_frame(bytes(self.buffer), self.compression, self.level, self.threads)
+		self.frames.append([self.f.tell(), len(data), self.offset, len(self.buffer)])
+		self.f.write(data)
+		self.offset += len(self.buffer)
+		self.buffer = bytearray()
+
+def _compress_frame(data, compression, level=None, threads=0):
+	if compression == 'gzip':
+		c = zlib.compressobj(level or util.compressors['gzip']['default_level'], zlib.DEFLATED, 31)
+		return c.compress(data) + c.flush()
+
+	p = subprocess.run(shlex.split(util.compress_command(compression, level, threads)),
+		input=data, stdout=subprocess.PIPE)
+
+	if p.returncode != 0:
+		raise util.SailException('An error occurred during compression.')
+
+	return p.stdout
+
+def _decompress_frame(data, compression):
+	if compression == 'gzip':
+		return zlib.decompress(data, 31)
+
+	p = subprocess.run(shlex.split(util.decompress_command(compression)),
+		input=data, stdout=subprocess.PIPE)
+
+	if p.returncode != 0:
+		raise util.SailException('An error occurred during decompression.')
+
+	return p.stdout
+
+def _archive(source, target, compression, level=None, threads=0, database_file=None):
+	'''Create a seekable compressed tarball of a snapshot, with a sidecar index.
+
+	The snapshot database is replaced by the plain SQL database_file if given.
+	'''
+	index = {'version': 1, 'compression': compression, 'frames': [], 'members': [], 'tables': None}
+	skip = ['database.sql.gz', 'database.sql.zst', 'database.sql.manifest.json']
+
+	entries = []
+	for dirpath, dirnames, filenames in os.walk(source):
+		dirnames.sort()
+		for name in dirnames + sorted(filenames):
+			path = pathlib.Path(dirpath) / name
+			arcname = str(path.relative_to(source))
+			if arcname not in skip:
+				entries.append((path, arcname))
+
+	if database_file:
+		entries.append((database_file, 'database.sql'))
+		index['tables'] = _index_tables(database_file)
 
 	try:
-		c.run('rm %s/%s' % (remote_path, database_filename))
+		with open(target, 'wb') as f:
+			writer = _FrameWriter(f, compression, level, threads)
+			tar = tarfile.open(fileobj=writer, mode='w', format=tarfile.PAX_FORMAT)
+
+			for path, arcname in entries:
+				# Snapshots are hard-linked to each other, store every file in full.
+				tar.inodes.clear()
+				tarinfo = tar.gettarinfo(str(path), arcname)
+				offset = tar.offset
+
+				if tarinfo.isreg():
+					with open(path, 'rb') as member:
+						tar.addfile(tarinfo, member)
+				else:
+					tar.addfile(tarinfo)
+
+				data = tar.offset
+				if tarinfo.isreg():
+					data -= -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+				index['members'].append({'name': arcname, 'type': tarinfo.type.decode(), 'size': tarinfo.size,
+					'mode': tarinfo.mode, 'mtime': tarinfo.mtime, 'linkname': tarinfo.linkname,
+					'offset': offset, 'data': data})
+
+				writer.boundary()
+				util.loader()
+
+			tar.close()
+			writer.flush()
+			index['frames'] = writer.frames
+
+		with open(_index_path(target), 'w') as f:
+			json.dump(index, f)
+
 	except:
-		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred in SSH. Please try again.')
+		target.unlink(missing_ok=True)
+		_index_path(target).unlink(missing_ok=True)
+		raise
+
+def _index_path(archive):
+	return archive.parent / (archive.name + '.index.json')
+
+def _load_archive_index(archive):
+	path = _index_path(archive)
+	if not path.exists():
+		return None
 
-	timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S.tar.gz')
-	target = pathlib.Path(backups_dir / timestamp)
+	with open(path) as f:
+		return json.load(f)
+
+class _ArchiveReader:
+	'''Random access to the uncompressed tar stream of a seekable archive'''
+	def __init__(self, archive, index):
+		self.f = open(archive, 'rb')
+		self.index = index
+		self.starts = [frame[2] for frame in index['frames']]
+		self.cache = (None, None)
+
+	def close(self):
+		self.f.close()
+
+	def _frame(self, i):
+		if self.cache[0] == i:
+			return self.cache[1]
+
+		offset, size, _, _ = self.index['frames'][i]
+		self.f.seek(offset)
+		data = _decompress_frame(self.f.read(size), self.index['compression'])
+		self.cache = (i, data)
+		return data
+
+	def read(self, start, length, f):
+		'''Copy length bytes of the tar stream from start into a file object'''
+		i = bisect.bisect_right(self.starts, start) - 1
+		while length > 0:
+			data = self._frame(i)
+			begin = start - self.starts[i]
+			piece = data[begin:begin + length]
+			f.write(piece)
+			start += len(piece)
+			length -= len(piece)
+			i += 1
+
+def _extract_members(archive, index, prefixes, destination):
+	'''Extract members matching any of the path prefixes, reading only their frames'''
+	reader = _ArchiveReader(archive, index)
+	count = 0
+
+	try:
+		for member in index['members']:
+			name = member['name']
+			if not any(name == p or name.startswith(p + '/') for p in prefixes):
+				continue
 
-	util.item('Archiving and compressing backup files')
+			path = destination / name
+			path.parent.mkdir(parents=True, exist_ok=True)
 
-	p = subprocess.Popen([
-		'tar', ('-cvzf' if util.debug() else '-czf'), target.resolve(), '-C', progress_dir.resolve(), '.'
-	])
+			if member['type'] == tarfile.DIRTYPE.decode():
+				path.mkdir(exist_ok=True)
+			elif member['type'] == tarfile.SYMTYPE.decode():
+				os.symlink(member['linkname'], path)
+			elif member['type'] in (tarfile.REGTYPE.decode(), tarfile.AREGTYPE.decode()):
+				with open(path, 'wb') as f:
+					reader.read(member['data'], member['size'], f)
+				os.chmod(path, member['mode'])
+				os.utime(path, (member['mtime'], member['mtime']))
+			else:
+				continue
 
-	while p.poll() is None:
-		pass
+			count += 1
+	finally:
+		reader.close()
+
+	return count
+
+def _index_tables(path):
+	'''Byte ranges of the header, footer and every table section in a mysqldump file'''
+	tables = {}
+	header_end = None
+	current = None
+	last = 0
+	offset = 0
+
+	with open(path, 'rb') as f:
+		for line in f:
+			table = re.match(rb'^-- Table structure for table `(.+)`', line)
+			if table:
+				if current:
+					tables[current][1] = last
+				elif header_end is None:
+					header_end = offset
+
+				current = table.group(1).decode('utf8')
+				tables[current] = [offset, None]
+
+			offset += len(line)
+
+			# Sections end after their last statement, trailing comments belong to the footer.
+			if line.strip() and not line.startswith(b'--') and not line.startswith(b'/*!'):
+				last = offset
+
+	if current:
+		tables[current][1] = last
+
+	if header_end is None:
+		header_end = offset
+
+	return {'header': [0, header_end], 'footer': [last if current else offset, offset], 'tables': tables}
+
+def _plain_dump(snapshot, target):
+	'''Write the single-file database dump of a snapshot as plain SQL'''
+	manifest = snapshot / 'database.sql.manifest.json'
+	if manifest.exists():
+		return _materialize(manifest, target, compress=False)
+
+	# Extracted seekable archives store the dump uncompressed.
+	if (snapshot / 'database.sql').exists():
+		return shutil.copyfile(snapshot / 'database.sql', target)
+
+	database_file = snapshot / 'database.sql.zst'
+	if not database_file.exists():
+		database_file = snapshot / 'database.sql.gz'
+
+	compression = util.detect_compression(database_file)
+	if compression == 'zstd' and not shutil.which('zstd'):
+		raise util.SailException('This database dump is compressed with zstd, please install zstd and try again.')
+
+	with open(database_file, 'rb') as f, open(target, 'wb') as out:
+		p = subprocess.run(shlex.split(util.decompress_command(compression)), stdin=f, stdout=out)
 
 	if p.returncode != 0:
-		shutil.rmtree(progress_dir)
-		raise util.SailException('An error occurred during backup. Please try again.')
+		raise util.SailException('Could not decompress the database dump.')
+
+def _compress_dump(database_file, directory):
+	'''Compress a plain SQL dump into directory, with zstd if available'''
+	compression = 'zstd' if shutil.which('zstd') else 'gzip'
+	target = directory / ('database.sql' + util.compressors[compression]['ext'])
+
+	with open(database_file, 'rb') as f, open(target, 'wb') as out:
+		p = subprocess.run(shlex.split(util.compress_command(compression, level=1)), stdin=f, stdout=out)
+
+	if p.returncode != 0:
+		raise util.SailException('Could not compress the database dump.')
+
+	return target
+
+def _extract(path, destination):
+	'''Extract a gzip or zstd compressed tarball into the destination directory'''
+	compression = util.detect_compression(path)
+
+	if compression == 'zstd' and not shutil.which('zstd'):
+		raise util.SailException('This backup is compressed with zstd, please install zstd and try again.')
+
+	with open(path, 'rb') as f:
+		decompressor = subprocess.Popen(shlex.split(util.decompress_command(compression)),
+			stdin=f, stdout=subprocess.PIPE)
+		tar = subprocess.Popen(['tar', ('-xvf' if util.debug() else '-xf'), '-', '--directory', destination.resolve()],
+			stdin=decompressor.stdout)
+		decompressor.stdout.close()
+
+		while tar.poll() is None:
+			util.loader()
+
+		decompressor.wait()
+
+	if tar.returncode != 0 or decompressor.returncode != 0:
+		raise util.SailException('An error occurred during restore. Please try again.')
+
+# Content-defined chunking. Cut points are only considered at SQL row and line
+# boundaries, and taken where a hash of the bytes before them matches the mask.
+# An inserted or updated row only changes the chunks around it.
+CHUNK_MIN = 256 * 1024
+CHUNK_MAX = 8 * 1024 * 1024
+CHUNK_MASK = (1 << 12) - 1
+_chunk_boundary = re.compile(rb'\),\(|\n')
+
+def _chunks(f):
+	'''Split a binary stream into content-defined chunks'''
+	buf = b''
+	eof = False
+
+	while buf or not eof:
+		while not eof and len(buf) < CHUNK_MAX:
+			data = f.read(CHUNK_MAX)
+			if not data:
+				eof = True
+			buf += data
+
+		cut = None
+		for m in _chunk_boundary.finditer(buf, CHUNK_MIN, CHUNK_MAX):
+			end = m.end()
+			if zlib.crc32(buf[end-32:end]) & CHUNK_MASK == 0:
+				cut = end
+				break
+
+		if cut is None:
+			cut = min(len(buf), CHUNK_MAX)
+
+		yield buf[:cut]
+		buf = buf[cut:]
+
+def _repository():
+	root = util.find_root()
+	repository = pathlib.Path(root + '/.backups/repository')
+	(repository / 'chunks').mkdir(parents=True, exist_ok=True)
+	return repository
+
+def _chunk_files():
+	'''Every file in the repository chunk directories, including .tmp files'''
+	return [path for path in (_repository() / 'chunks').glob('*/*') if path.is_file()]
+
+def _load_index():
+	'''Map of chunk hash to [size, stored size]'''
+	path = _repository() / 'index.json'
+	if not path.exists():
+		return {}
+
+	with open(path) as f:
+		return json.load(f)
+
+def _save_index(index):
+	path = _repository() / 'index.json'
+	with open(path.with_suffix('.tmp'), 'w') as f:
+		json.dump(index, f)
+
+	os.replace(path.with_suffix('.tmp'), path)
+
+def _read_chunk(h):
+	with open(_repository() / 'chunks' / h[:2] / h, 'rb') as f:
+		return zlib.decompress(f.read())
+
+def _store(path):
+	'''Add a compressed database dump to the repository and return its manifest'''
+	repository = _repository()
+	index = _load_index()
+	compression = util.detect_compression(path)
+
+	manifest = {'chunks': [], 'size': 0, 'new_chunks': 0, 'new_size': 0}
+	checksum = hashlib.sha256()
+
+	with open(path, 'rb') as f:
+		p = subprocess.Popen(shlex.split(util.decompress_command(compression)), stdin=f, stdout=subprocess.PIPE)
+
+		for chunk in _chunks(p.stdout):
+			h = hashlib.sha256(chunk).hexdigest()
+			checksum.update(chunk)
+			manifest['chunks'].append(h)
+			manifest['size'] += len(chunk)
+
+			if h in index:
+				continue
+
+			data = zlib.compress(chunk, 6)
+			chunk_path = repository / 'chunks' / h[:2] / h
+			chunk_path.parent.mkdir(exist_ok=True)
+
+			with open(chunk_path.with_suffix('.tmp'), 'wb') as c:
+				c.write(data)
+
+			os.replace(chunk_path.with_suffix('.tmp'), chunk_path)
+			index[h] = [len(chunk), len(data)]
+			manifest['new_chunks'] += 1
+			manifest['new_size'] += len(data)
+
+		p.wait()
+
+	if p.returncode != 0:
+		raise util.SailException('Could not decompress the database dump.')
+
+	# Chunks are written before the index, an interrupted run only leaves
+	# orphans, which backup prune removes.
+	_save_index(index)
+	manifest['sha256'] = checksum.hexdigest()
+	return manifest
+
+def _materialize(manifest_path, target, compress=True):
+	'''Reassemble a database dump from repository chunks into a .sql.gz or plain .sql file'''
+	with open(manifest_path) as f:
+		manifest = json.load(f)
+
+	checksum = hashlib.sha256()
+	with (gzip.open(target, 'wb', compresslevel=1) if compress else open(target, 'wb')) as f:
+		batcher = _InsertBatcher(f)
+		for h in manifest['chunks']:
+			chunk = _read_chunk(h)
+			checksum.update(chunk)
+			batcher.write(chunk)
+
+		batcher.close()
+
+	if checksum.hexdigest() != manifest['sha256']:
+		raise util.SailException('Checksum mismatch while reassembling the database. Try: sail backup check')
+
+class _InsertBatcher:
+	'''Join consecutive single-row INSERT statements for the same table into
+	extended INSERTs of up to ~1 MiB, like mysqldump does by default.'''
+	def __init__(self, f, limit=1024 * 1024):
+		self.f = f
+		self.limit = limit
+		self.pending = b''
+		self.prefix = None
+		self.rows = []
+		self.size = 0
+
+	def write(self, data):
+		lines = (self.pending + data).split(b'\n')
+		self.pending = lines.pop()
+		for line in lines:
+			self._line(line)
+
+	def close(self):
+		self._flush()
+		self.f.write(self.pending)
+		self.pending = b''
+
+	def _line(self, line):
+		if line.startswith(b'INSERT INTO `') and line.endswith(b');'):
+			prefix, sep, values = line.partition(b' VALUES ')
+			if sep:
+				if prefix != self.prefix or self.size > self.limit:
+					self._flush()
+					self.prefix = prefix
+
+				self.rows.append(values[:-1])
+				self.size += len(values)
+				return
+
+		self._flush()
+		self.f.write(line + b'\n')
 
-	shutil.rmtree(progress_dir)
+	def _flush(self):
+		if self.rows:
+			self.f.write(self.prefix + b' VALUES ' + b','.join(self.rows) + b';\n')
 
-	util.success('Backup completed at .backups/%s' % timestamp)
+		self.prefix = None
+		self.rows = []
+		self.size = 0
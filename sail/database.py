@@ -1,6 +1,6 @@
 from sail import cli, util
 
-import os, subprocess
+import os, subprocess, shutil
 import click
 import hashlib
 import pathlib
@@ -21,10 +21,7 @@ def cli():
 	config = util.config()
 
 	os.execlp('ssh', 'ssh', '-t',
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'root@%s' % config['hostname'],
 		'sudo -u www-data wp --path=%s db cli' % util.remote_path('/public')
 	)
@@ -32,8 +29,9 @@ def cli():
 @db.command(name='import')
 @click.argument('path', nargs=1, required=True)
 @click.option('--partial', is_flag=True, help='Do not wipe production database and perform a partial import')
-def import_cmd(path, partial):
-	'''Import a local .sql or .sql.gz file to the production MySQL database'''
+@click.option('--parallel', type=click.IntRange(1, 64), help='Number of threads for importing a directory export')
+def import_cmd(path, partial, parallel):
+	'''Import a local .sql, .sql.gz or .sql.zst file (or a .sql.d directory export) to the production MySQL database'''
 	root = util.find_root()
 	config = util.config()
 	c = util.connection()
@@ -44,11 +42,17 @@ def import_cmd(path, partial):
 	if not path.exists():
 		raise util.SailException('File does not exist')
 
-	if not path.name.endswith('.sql') and not path.name.endswith('.sql.gz'):
-		raise util.SailException('This does not look like a .sql or .sql.gz file')
+	if path.is_dir():
+		return _import_parallel(c, path, partial, parallel or 4)
+
+	if parallel:
+		raise util.SailException('Parallel imports require a directory created with: sail db export --parallel')
+
+	if not re.search(r'\.sql(\.gz|\.zst)?$', path.name):
+		raise util.SailException('This does not look like a .sql, .sql.gz or .sql.zst file')
 
 	temp_filename = '%s.%s' % (hashlib.sha256(os.urandom(32)).hexdigest()[:8], path.name)
-	is_gz = path.name.endswith('.sql.gz')
+	compression = util.detect_compression(path)
 
 	util.heading('Importing WordPress database')
 	util.item('Uploading database file to production')
@@ -61,10 +65,13 @@ def import_cmd(path, partial):
 	if returncode != 0:
 		raise util.SailException('An error occurred in rsync. Please try again.')
 
-	cat_bin = 'zcat' if is_gz else 'cat'
+	cat_bin = util.decompress_command(compression)
 	temp_name = 'import_%s' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]
 
 	try:
+		if compression == 'zstd':
+			util.ensure_command(c, 'zstd')
+
 		# A partial import, no temp table, no replacements
 		# Run as is on production db.
 		if partial:
@@ -79,97 +86,269 @@ def import_cmd(path, partial):
 			util.item('Importing into temporary database')
 			c.run(f'{cat_bin} {remote_path}/{temp_filename} | mysql -uroot "{temp_name}"')
 
-			# Fetch all tables and determine table prefix
-			tables = c.run(f'mysql -uroot "{temp_name}" --skip-column-names -e "SHOW TABLES;"').stdout.splitlines()
-			core_tables = ['commentmeta', 'comments', 'links', 'options', 'postmeta',
-				'posts', 'term_relationships', 'term_taxonomy', 'termmeta', 'terms',
-				'usermeta', 'users'
-			]
+			_replace_database(c, temp_name, namespace)
 
-			prefixes = []
+			util.item('Dropping temporary database')
+			c.run(f'mysql -uroot -e "DROP DATABASE \\`{temp_name}\\`;"')
 
-			for table in tables:
-				prefix = re.search(r'^(.+?)(?:\d+_)?(?:%s)$' % '|'.join(core_tables), table)
-				if prefix:
-					prefixes.append(prefix.group(1))
+	except Exception as e:
+		util.dlog(str(e))
+		c.run(f'mysql -uroot -e "DROP DATABASE \\`{temp_name}\\`;"', warn=True)
+		raise util.SailException('An error occurred in SSH. Please try again.')
 
-			# Convert to set and make unique
-			prefixes = set(prefixes)
-			if len(prefixes) == 1:
-				prefix = prefixes.pop()
-				util.item(f'Determined table prefix: {prefix}')
-			else:
-				prefix = None
+	util.item('Cleaning up production')
 
-			clean_tables = []
+	try:
+		c.run(f'rm {remote_path}/{temp_filename}')
+	except:
+		raise util.SailException('An error occurred in SSH. Please try again.')
 
-			# Rename
-			if prefix and prefix != 'wp_':
-				for table in tables:
-					if table[:len(prefix)] != prefix:
-						clean_tables.append(table)
-						continue
+	util.success('Database imported')
 
-					table = table[len(prefix):]
-					util.item(f'Renaming {prefix}{table} to wp_{table}')
-					c.run(f'mysql -uroot "{temp_name}" -e "RENAME TABLE \\`{prefix}{table}\\` TO \\`wp_{table}\\`;"')
-					clean_tables.append(f'wp_{table}')
+def _import_parallel(c, path, partial, threads):
+	'''Import a per-table directory export with myloader'''
+	config = util.config()
+	remote_path = util.remote_path()
+	namespace = config['namespace']
 
-				tables = clean_tables
+	util.heading('Importing WordPress database')
+	util.item('Uploading database files to production')
 
-				util.item(f'Updating prefix in wp_options, wp_usermeta')
-				meta_keys = ['capabilities', 'user_level']
-				option_names = ['user_roles']
+	remote_dir = '%s/import.%s' % (remote_path, hashlib.sha256(os.urandom(32)).hexdigest()[:8])
+	_upload_directory(path, remote_dir)
 
-				for meta_key in meta_keys:
-					c.run(f'mysql -uroot "{temp_name}" -e "UPDATE \\`wp_usermeta\\` SET meta_key = \'wp_{meta_key}\' WHERE meta_key = \'{prefix}{meta_key}\';"')
+	temp_name = 'import_%s' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]
 
-				for option_name in option_names:
-					c.run(f'mysql -uroot "{temp_name}" -e "UPDATE \\`wp_options\\` SET option_name = \'wp_{option_name}\' WHERE option_name = \'{prefix}{option_name}\';"')
+	try:
+		_ensure_mydumper(c)
 
-			util.item('Dropping live database, moving temporary to live')
-			c.run(f'mysql -uroot -e "DROP DATABASE \\`wordpress_{namespace}\\`; CREATE DATABASE \\`wordpress_{namespace}\\`;"')
-			for table in tables:
-				c.run(f'mysql -uroot -e "RENAME TABLE \\`{temp_name}\\`.\\`{table}\\` TO \\`wordpress_{namespace}\\`.\\`{table}\\`;"')
+		if partial:
+			util.item('Importing database into MySQL (%d threads)' % threads)
+			c.run(_parallel_load_command(remote_dir, f'wordpress_{namespace}', threads), timeout=None)
+
+		else:
+			util.item('Creating temporary database')
+			c.run(f'mysql -uroot -e "CREATE DATABASE \\`{temp_name}\\`;"')
+
+			util.item('Importing into temporary database (%d threads)' % threads)
+			c.run(_parallel_load_command(remote_dir, temp_name, threads), timeout=None)
+
+			_replace_database(c, temp_name, namespace)
 
 			util.item('Dropping temporary database')
 			c.run(f'mysql -uroot -e "DROP DATABASE \\`{temp_name}\\`;"')
 
 	except Exception as e:
 		util.dlog(str(e))
-		c.run(f'mysql -uroot -e "DROP DATABASE \\`{temp_name}\\`;"', warn=True)
+		c.run(f'mysql -uroot -e "DROP DATABASE IF EXISTS \\`{temp_name}\\`;"', warn=True)
+		c.run(util.join(['rm', '-rf', remote_dir]), warn=True)
 		raise util.SailException('An error occurred in SSH. Please try again.')
 
 	util.item('Cleaning up production')
+	c.run(util.join(['rm', '-rf', remote_dir]))
+
+	util.success('Database imported')
+
+def _upload_directory(source, remote_dir):
+	config = util.config()
+	args = ['-rt']
+	destination = 'root@%s:%s/' % (config['hostname'], remote_dir)
+	returncode, stdout, stderr = util.rsync(args, '%s/' % source, destination, default_filters=False)
+
+	if returncode != 0:
+		raise util.SailException('An error occurred in rsync. Please try again.')
+
+def _ensure_mydumper(c):
+	'''Install mydumper/myloader on production if they are missing'''
+	util.ensure_command(c, 'mydumper')
+	util.ensure_command(c, 'myloader', 'mydumper')
+
+def _parallel_dump_command(namespace, output, threads, rows=500000):
+	'''A remote mydumper command writing one consistent snapshot as per-table files.
+
+	Tables with a primary key are split into chunks of roughly rows rows, so
+	large tables like wp_postmeta are dumped and loaded by several threads.
+	'''
+	return util.join(['mydumper', '--user', 'root', '--database', f'wordpress_{namespace}',
+		'--outputdir', output, '--threads', str(threads), '--rows', str(rows),
+		'--compress', '--triggers'])
+
+def _parallel_load_command(directory, database, threads):
+	return util.join(['myloader', '--user', 'root', '--directory', directory,
+		'--database', database, '--threads', str(threads), '--overwrite-tables'])
+
+def _export_parallel(c, destination, threads, progress=True):
+	'''Dump the production database with mydumper into a local directory'''
+	config = util.config()
+	remote_path = util.remote_path()
+	remote_dir = '%s/export.%s' % (remote_path, hashlib.sha256(os.urandom(32)).hexdigest()[:8])
 
 	try:
-		c.run(f'rm {remote_path}/{temp_filename}')
-	except:
+		_ensure_mydumper(c)
+
+		if progress:
+			util.item('Dumping tables (%d threads)' % threads)
+
+		c.run(_parallel_dump_command(config['namespace'], remote_dir, threads), timeout=None)
+
+		if progress:
+			util.item('Export completed, downloading')
+
+		args = ['-rt']
+		source = 'root@%s:%s/' % (config['hostname'], remote_dir)
+		returncode, stdout, stderr = util.rsync(args, source, '%s/' % destination, default_filters=False)
+
+		if returncode != 0:
+			raise util.SailException('An error occurred in rsync. Please try again.')
+
+	except util.SailException:
+		raise
+	except Exception as e:
+		util.dlog(str(e))
 		raise util.SailException('An error occurred in SSH. Please try again.')
+	finally:
+		c.run(util.join(['rm', '-rf', remote_dir]), warn=True)
 
-	util.success('Database imported')
+def _restore_parallel(c, path, threads):
+	'''Load a directory export straight into the live database, used by restore'''
+	config = util.config()
+	remote_dir = '%s/import.%s' % (util.remote_path(), hashlib.sha256(os.urandom(32)).hexdigest()[:8])
+	_upload_directory(path, remote_dir)
+
+	try:
+		_ensure_mydumper(c)
+		c.run(_parallel_load_command(remote_dir, 'wordpress_%s' % config['namespace'], threads), timeout=None)
+	except Exception as e:
+		util.dlog(str(e))
+		raise util.SailException('An error occurred in SSH. Please try again.')
+	finally:
+		c.run(util.join(['rm', '-rf', remote_dir]), warn=True)
+
+def _replace_database(c, temp_name, namespace):
+	'''Normalize the table prefix in a temporary database and move its tables to live'''
+	# Fetch all tables and determine table prefix
+	tables = c.run(f'mysql -uroot "{temp_name}" --skip-column-names -e "SHOW TABLES;"').stdout.splitlines()
+	core_tables = ['commentmeta', 'comments', 'links', 'options', 'postmeta',
+		'posts', 'term_relationships', 'term_taxonomy', 'termmeta', 'terms',
+		'usermeta', 'users'
+	]
+
+	prefixes = []
+
+	for table in tables:
+		prefix = re.search(r'^(.+?)(?:\d+_)?(?:%s)$' % '|'.join(core_tables), table)
+		if prefix:
+			prefixes.append(prefix.group(1))
+
+	# Convert to set and make unique
+	prefixes = set(prefixes)
+	if len(prefixes) == 1:
+		prefix = prefixes.pop()
+		util.item(f'Determined table prefix: {prefix}')
+	else:
+		prefix = None
+
+	clean_tables = []
+
+	# Rename
+	if prefix and prefix != 'wp_':
+		for table in tables:
+			if table[:len(prefix)] != prefix:
+				clean_tables.append(table)
+				continue
+
+			table = table[len(prefix):]
+			util.item(f'Renaming {prefix}{table} to wp_{table}')
+			c.run(f'mysql -uroot "{temp_name}" -e "RENAME TABLE \\`{prefix}{table}\\` TO \\`wp_{table}\\`;"')
+			clean_tables.append(f'wp_{table}')
+
+		tables = clean_tables
+
+		util.item(f'Updating prefix in wp_options, wp_usermeta')
+		meta_keys = ['capabilities', 'user_level']
+		option_names = ['user_roles']
+
+		for meta_key in meta_keys:
+			c.run(f'mysql -uroot "{temp_name}" -e "UPDATE \\`wp_usermeta\\` SET meta_key = \'wp_{meta_key}\' WHERE meta_key = \'{prefix}{meta_key}\';"')
+
+		for option_name in option_names:
+			c.run(f'mysql -uroot "{temp_name}" -e "UPDATE \\`wp_options\\` SET option_name = \'wp_{option_name}\' WHERE option_name = \'{prefix}{option_name}\';"')
+
+	util.item('Dropping live database, moving temporary to live')
+	c.run(f'mysql -uroot -e "DROP DATABASE \\`wordpress_{namespace}\\`; CREATE DATABASE \\`wordpress_{namespace}\\`;"')
+	for table in tables:
+		c.run(f'mysql -uroot -e "RENAME TABLE \\`{temp_name}\\`.\\`{table}\\` TO \\`wordpress_{namespace}\\`.\\`{table}\\`;"')
+
+def _dump_command(namespace, compression='zstd', level=None, threads=0, extended_insert=True):
+	'''A remote shell command which writes a compressed dump to stdout'''
+	extra = '' if extended_insert else ' --skip-extended-insert'
+	return 'mysqldump --quick --single-transaction --default-character-set=utf8mb4%s -uroot "wordpress_%s" | %s' % (
+		extra, namespace, util.compress_command(compression, level, threads))
 
 @db.command()
 @click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
-def export(as_json):
-	'''Export the production database to a local .sql.gz file'''
+@click.option('--stream/--no-stream', default=True, help='Stream the dump over SSH instead of writing a temporary file on production')
+@click.option('--compression', type=click.Choice(list(util.compressors)), default='zstd', help='Compression format, zstd (default) or gzip')
+@click.option('--level', type=int, help='Compression level, 1-19 for zstd (default 6), 1-9 for gzip (default 9)')
+@click.option('--threads', type=click.IntRange(0, 64), default=0, help='Compression threads for zstd, 0 uses all cores')
+@click.option('--parallel', type=click.IntRange(1, 64), help='Dump tables with this many threads into a .sql.d directory')
+def export(as_json, stream, compression, level, threads, parallel):
+	'''Export the production database to a local .sql.zst or .sql.gz file'''
 	root = util.find_root()
 	config = util.config()
-	c = util.connection()
 	remote_path = util.remote_path()
+	dump_command = _dump_command(config['namespace'], compression, level, threads)
 
 	if as_json:
 		util.loader(suspend=True)
 
 	backups_dir = pathlib.Path(root + '/.backups')
 	backups_dir.mkdir(parents=True, exist_ok=True)
-	filename = datetime.now().strftime('%Y-%m-%d-%H%M%S.sql.gz')
+	filename = datetime.now().strftime('%Y-%m-%d-%H%M%S.sql') + util.compressors[compression]['ext']
+
+	if parallel:
+		filename = datetime.now().strftime('%Y-%m-%d-%H%M%S.sql.d')
+
+	destination = '%s/%s' % (backups_dir, filename)
 
 	if not as_json:
 		util.heading('Exporting WordPress database')
 
+	if compression == 'zstd' and not parallel:
+		util.ensure_command(util.connection(), 'zstd')
+
+	if parallel:
+		try:
+			_export_parallel(util.connection(), destination, parallel, progress=not as_json)
+		except:
+			shutil.rmtree(destination, ignore_errors=True)
+			raise
+
+	elif stream:
+		if not as_json:
+			util.item('Streaming database export')
+
+		try:
+			with open(destination, 'wb') as f:
+				util.ssh_stream(dump_command, f, progress=not as_json)
+		except:
+			pathlib.Path(destination).unlink(missing_ok=True)
+			raise
+
+	else:
+		_export_via_file(config, remote_path, filename, destination, dump_command, as_json)
+
+	if not as_json:
+		util.success('Database export saved to .backups/%s' % filename)
+	else:
+		click.echo(json.dumps(destination))
+
+def _export_via_file(config, remote_path, filename, destination, dump_command, as_json):
+	'''Dump to a temporary file on production, then download it with rsync'''
+	c = util.connection()
+
 	try:
-		c.run('mysqldump --quick --single-transaction --default-character-set=utf8mb4 -uroot "wordpress_%s" | gzip -c9 > %s/%s' % (config['namespace'], remote_path, filename))
+		c.run('set -o pipefail; %s > %s/%s' % (dump_command, remote_path, filename))
 	except:
 		raise util.SailException('An error occurred in SSH. Please try again.')
 
@@ -178,7 +357,6 @@ def export(as_json):
 
 	args = ['-t']
 	source = 'root@%s:%s/%s' % (config['hostname'], remote_path, filename)
-	destination = '%s/%s' % (backups_dir, filename)
 	returncode, stdout, stderr = util.rsync(args, source, destination, default_filters=False)
 
 	if returncode != 0:
@@ -192,11 +370,6 @@ def export(as_json):
 	except:
 		raise util.SailException('An error occurred in SSH. Please try again.')
 
-	if not as_json:
-		util.success('Database export saved to .backups/%s' % filename)
-	else:
-		click.echo(json.dumps(destination))
-
 @db.command()
 def reset_password():
 	'''Reset the WordPress database password and update wp-config.php'''
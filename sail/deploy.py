@@ -1,7 +1,7 @@
-from sail import cli, util
+from sail import cli, util, profiling
 
 import subprocess, time
-import click, pathlib
+import click, pathlib, shutil
 import re, shlex, os, stat
 
 from glob import glob
@@ -88,8 +88,11 @@ def _get_deployignore_filters():
 @click.option('--dry-run', is_flag=True, help='Show changes about to be deployed to production')
 @click.option('--skip-hooks', '--no-verify', is_flag=True, help='Do not run pre-deploy hooks')
 @click.option('--redeploy', is_flag=True, help='Redeploy to an existing release directory')
+@click.option('--perf-gate', help='Profile the URLs in this file or sitemap.xml before and after the release, roll back on regressions')
+@click.option('--perf-threshold', type=click.IntRange(1), default=20, help='Wall time or query count increase in percent which fails the --perf-gate, 20 by default')
+@click.option('--perf-runs', type=click.IntRange(1, 20), default=3, help='Profile each --perf-gate URL this many times, 3 by default')
 @click.pass_context
-def deploy(ctx, with_uploads, dry_run, path, skip_hooks, redeploy):
+def deploy(ctx, with_uploads, dry_run, path, skip_hooks, redeploy, perf_gate, perf_threshold, perf_runs):
 	'''Deploy your working copy to production. If path is not specified then all application files are deployed.'''
 	root = util.find_root()
 	config = util.config()
@@ -99,6 +102,17 @@ def deploy(ctx, with_uploads, dry_run, path, skip_hooks, redeploy):
 	if dry_run:
 		return ctx.invoke(diff, path=path)
 
+	if perf_gate:
+		if redeploy:
+			raise util.SailException('A --perf-gate needs a new release to compare with, it can not be used with --redeploy')
+
+		if 'profile_key' not in config:
+			raise util.SailException('Profile key not found in .sail/config.json')
+
+		gate_urls = profiling._batch_urls(perf_gate)
+		if not gate_urls:
+			raise util.SailException('Could not find any URLs in %s' % perf_gate)
+
 	util.heading('Deploying to production')
 
 	hooks = []
@@ -143,8 +157,10 @@ def deploy(ctx, with_uploads, dry_run, path, skip_hooks, redeploy):
 
 	else:
 		util.item('Preparing release directory')
-		c.run('mkdir -p %s/releases/%s' % (remote_path, release))
-		c.run('rsync -rogtl %s/public/ %s/releases/%s' % (remote_path, remote_path, release))
+		util.batch(c, [
+			'mkdir -p %s/releases/%s' % (remote_path, release),
+			'rsync -rogtl %s/public/ %s/releases/%s' % (remote_path, remote_path, release),
+		])
 
 	util.item('Uploading application files to production')
 
@@ -178,24 +194,62 @@ def deploy(ctx, with_uploads, dry_run, path, skip_hooks, redeploy):
 		if returncode != 0:
 			raise util.SailException('An error occurred during upload. Please try again.')
 
+	if perf_gate:
+		gate_dir = profiling._profiles_dir() / ('perf-gate-%s' % release)
+
+		# The new release is not live yet, it is removed if there's no baseline.
+		try:
+			previous = c.run('readlink %s/public' % remote_path, warn=True).stdout.strip().split('/')[-1]
+			if not previous.isdigit():
+				raise util.SailException('Could not determine current release for the --perf-gate')
+
+			util.item('Profiling %d URLs on release %s' % (len(gate_urls), previous))
+			gate_dir.mkdir()
+			baseline = profiling._measure(gate_urls, perf_runs, gate_dir, 'base')
+		except util.SailException:
+			_discard_release(c, release, gate_dir)
+			raise
+
 	util.item('Deploying release: %s' % release)
 
+	commands = []
+
 	if not redeploy:
-		util.item('Updating symlinks')
-		c.run('sudo -u www-data ln -sfn %s/uploads %s/releases/%s/wp-content/uploads' % (remote_path, remote_path, release))
-		c.run('sudo -u www-data ln -sfn %s/releases/%s %s/public' % (remote_path, release, remote_path))
+		commands += [
+			'sudo -u www-data ln -sfn %s/uploads %s/releases/%s/wp-content/uploads' % (remote_path, remote_path, release),
+			'sudo -u www-data ln -sfn %s/releases/%s %s/public' % (remote_path, release, remote_path),
+		]
+		commands += _reload_commands()
 
-		util.item('Reloading services')
-		c.run('nginx -s reload')
+	commands.append('ls %s/releases' % remote_path)
 
-		php_config = pathlib.Path(c.run('php -r "echo PHP_CONFIG_FILE_PATH;"').stdout).parent # /etc/php/8.1
-		php_version = php_config.name
-		c.run(f'kill -s USR2 $(cat /var/run/php/php{php_version}-fpm.pid)')
-	else:
+	if redeploy:
 		util.item('Nothing to update/reload in redeploy')
+	else:
+		util.item('Updating symlinks and reloading services')
 
-	releases = c.run('ls %s/releases' % remote_path)
-	releases = re.findall(r'\d+', releases.stdout)
+	releases = util.batch(c, commands)[-1]
+
+	if perf_gate:
+		util.item('Profiling %d URLs on release %s' % (len(gate_urls), release))
+		profiling._warm(gate_urls)
+
+		# A release which can't be profiled is rolled back too.
+		try:
+			results = _perf_gate(baseline, profiling._measure(gate_urls, perf_runs, gate_dir, 'new'), perf_threshold)
+		except util.SailException as e:
+			util.item('Profiling failed: %s' % e)
+			results = [{'failed': True}]
+
+		if any(result['failed'] for result in results):
+			util.item('Performance gate failed, rolling back')
+			ctx.invoke(rollback, release=int(previous))
+
+			# Profiles are kept to see what regressed.
+			_discard_release(c, release)
+			raise util.SailException('Release %s failed the performance gate and was rolled back to %s, profiles are in .profiles/%s'
+				% (release, previous, gate_dir.name))
+	releases = re.findall(r'\d+', releases['stdout'])
 	releases = [int(i) for i in releases]
 
 	keep = util.get_sail_default('keep')
@@ -209,8 +263,7 @@ def deploy(ctx, with_uploads, dry_run, path, skip_hooks, redeploy):
 	if len(releases) > keep:
 		util.item('Removing outdated releases')
 		remove = sorted(releases)[:len(releases)-keep]
-		for key in remove:
-			c.run(util.join(['rm', '-rf', '%s/releases/%s' % (remote_path, key)]))
+		c.run(util.join(['rm', '-rf'] + ['%s/releases/%s' % (remote_path, key) for key in remove]))
 
 	util.success('Successfully deployed %s' % release)
 
@@ -226,17 +279,18 @@ def rollback(release=None, releases=False):
 	if releases or not release:
 		util.heading('Fetching available releases')
 
-		_releases = c.run('ls %s/releases' % remote_path)
-		_releases = re.findall(r'\d+', _releases.stdout)
+		_releases, _current = util.batch(c, [
+			'ls %s/releases' % remote_path,
+			'readlink %s/public' % remote_path,
+		], warn=True)
+
+		_releases = re.findall(r'\d+', _releases['stdout'])
 
 		if len(_releases) < 1:
 			raise util.SailException('Could not find any releases')
 
-		try:
-			util.item('Determining current release')
-			_current = c.run('readlink %s/public' % remote_path).stdout.strip().split('/')[-1]
-		except:
-			_current = '0'
+		util.item('Determining current release')
+		_current = _current['stdout'].split('/')[-1] if _current['exited'] == 0 else '0'
 
 		click.echo()
 
@@ -259,18 +313,54 @@ def rollback(release=None, releases=False):
 	if release not in _releases:
 		raise util.SailException('Invalid release. To get a list run: sail rollback --releases')
 
-	util.item('Updating symlinks')
-	c.run('ln -sfn %s/releases/%s %s/public' % (remote_path, release, remote_path))
-
-	util.item('Reloading services')
-	c.run('nginx -s reload')
-
-	php_config = pathlib.Path(c.run('php -r "echo PHP_CONFIG_FILE_PATH;"').stdout).parent # /etc/php/8.1
-	php_version = php_config.name
-	c.run(f'kill -s USR2 $(cat /var/run/php/php{php_version}-fpm.pid)')
+	util.item('Updating symlinks and reloading services')
+	util.batch(c, ['ln -sfn %s/releases/%s %s/public' % (remote_path, release, remote_path)]
+		+ _reload_commands())
 
 	util.success('Successfully rolled back to %s' % release)
 
+def _discard_release(c, release, gate_dir=None):
+	'''Remove a release which is not live, and its performance gate profiles'''
+	util.item('Removing release %s' % release)
+	c.run('rm -rf %s/releases/%s' % (util.remote_path(), release), warn=True)
+
+	if gate_dir:
+		shutil.rmtree(gate_dir, ignore_errors=True)
+
+def _perf_gate(baseline, profiles, threshold):
+	'''Compare median wall time and query counts per URL, print the results'''
+	results = []
+
+	click.echo()
+	click.echo('{:>14}  {:>14}  {:>8}  {:>9}  {}'.format('Before (µs)', 'After (µs)', 'Change', 'Queries', 'URL'))
+
+	for url, profile in profiles.items():
+		before, after = baseline[url].totals, profile.totals
+		wt = [totals.get('wt:median', totals['wt']) for totals in (before, after)]
+		change = (wt[1] - wt[0]) / wt[0] * 100 if wt[0] else 0.0
+
+		# Query counts are mostly deterministic, a single extra query is
+		# not a regression on pages with only a few.
+		queries = [before['queries'], after['queries']]
+		more = queries[1] - queries[0]
+		failed = change > threshold or (more > 1 and more > queries[0] * threshold / 100)
+
+		results.append({'url': url, 'wt': wt, 'queries': queries, 'change': change, 'failed': failed})
+		click.echo('{:>14,}  {:>14,}  {:>+7.1f}%  {:>9}  {}{}'.format(wt[0], wt[1], change,
+			'%d→%d' % tuple(queries), url, '  FAIL' if failed else ''))
+
+	click.echo()
+	return results
+
+def _reload_commands():
+	'''Shell commands to reload nginx and gracefully reload PHP-FPM'''
+	# PHP_CONFIG_FILE_PATH is /etc/php/8.1/cli, the parent name is the version.
+	php_version = '$(basename $(dirname $(php -r "echo PHP_CONFIG_FILE_PATH;")))'
+	return [
+		'nginx -s reload',
+		f'kill -s USR2 $(cat /var/run/php/php{php_version}-fpm.pid)',
+	]
+
 @cli.command()
 @click.argument('path', nargs=-1, required=False)
 @click.option('--yes', '-y', is_flag=True, help='Force Y on overwriting local copy')
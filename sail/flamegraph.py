@@ -0,0 +1,125 @@
+import json, zlib
+from xml.sax.saxutils import escape
+
+UNITS = {'wt': 'microseconds', 'cpu': 'microseconds', 'mu': 'bytes', 'pmu': 'bytes'}
+
+WIDTH = 1200
+FRAME_HEIGHT = 16
+FONT_SIZE = 11
+MIN_WIDTH = 0.1
+
+def _name(symbol):
+	'''Symbols may contain query strings, keep them on a single stack line'''
+	return ' '.join(symbol.replace(';', ',').split())
+
+def collapsed(profile, f, key='wt'):
+	'''Write stacks in the collapsed format used by flamegraph.pl and friends'''
+	symbols = profile.symbols
+	for path, value in profile.stacks(key):
+		value = round(value)
+		if value > 0:
+			f.write('%s %d\n' % (';'.join(_name(symbols[i]) for i in path), value))
+
+def speedscope(profile, f, key='wt'):
+	'''Write a speedscope sampled profile with one weighted sample per stack'''
+	frames = {}
+	samples = []
+	weights = []
+
+	for path, value in profile.stacks(key):
+		value = round(value)
+		if value <= 0:
+			continue
+
+		samples.append([frames.setdefault(i, len(frames)) for i in path])
+		weights.append(value)
+
+	totals = profile.totals
+	json.dump({
+		'$schema': 'https://www.speedscope.app/file-format-schema.json',
+		'shared': {'frames': [{'name': profile.symbols[i]} for i in frames]},
+		'profiles': [{
+			'type': 'sampled',
+			'name': '%s %s%s' % (totals['method'], totals['host'], totals['request_uri']),
+			'unit': UNITS.get(key, 'none'),
+			'startValue': 0,
+			'endValue': sum(weights),
+			'samples': samples,
+			'weights': weights,
+		}],
+		'name': '%s%s' % (totals['host'], totals['request_uri']),
+		'exporter': 'sail',
+	}, f)
+
+def _tree(profile, key):
+	'''Merge stacks into a tree of [symbol id, inclusive value, children] nodes'''
+	root = [None, 0.0, {}]
+
+	for path, value in profile.stacks(key):
+		node = root
+		node[1] += value
+		for i in path:
+			node = node[2].setdefault(i, [i, 0.0, {}])
+			node[1] += value
+
+	return root
+
+def _color(symbol):
+	'''Warm flame graph colors, stable for a symbol across exports'''
+	h = zlib.crc32(symbol.encode('utf8'))
+	return 'rgb(%d,%d,%d)' % (205 + h % 50, (h >> 8) % 230, (h >> 16) % 55)
+
+def svg(profile, f, key='wt', title='Flame Graph'):
+	'''Write a self-contained SVG flame graph, root at the bottom'''
+	root = _tree(profile, key)
+	total = root[1]
+	unit = UNITS.get(key, '')
+	scale = (WIDTH - 20) / total if total > 0 else 0
+
+	rects = []
+	depth = 0
+
+	# Children are laid out alphabetically, like flamegraph.pl does.
+	pending = [(root, 10.0, -1)]
+	while pending:
+		node, x, level = pending.pop()
+		if level >= 0:
+			rects.append((node[0], node[1], x, level))
+			depth = max(depth, level + 1)
+
+		offset = x
+		for child in sorted(node[2].values(), key=lambda n: profile.symbols[n[0]]):
+			if child[1] * scale >= MIN_WIDTH:
+				pending.append((child, offset, level + 1))
+			offset += child[1] * scale
+
+	height = (depth + 3) * FRAME_HEIGHT
+	out = [
+		'<?xml version="1.0" standalone="no"?>',
+		'<svg version="1.1" width="%d" height="%d" xmlns="http://www.w3.org/2000/svg">' % (WIDTH, height),
+		'<style>text { font-family: Verdana, sans-serif; font-size: %dpx; fill: #000; } '
+			'g:hover rect { stroke: #000; stroke-width: 0.5; }</style>' % FONT_SIZE,
+		'<rect x="0" y="0" width="100%" height="100%" fill="#f8f8f8"/>',
+		'<text x="%d" y="%d" text-anchor="middle">%s</text>' % (WIDTH / 2, FRAME_HEIGHT, escape(title)),
+	]
+
+	for i, value, x, level in rects:
+		symbol = profile.symbols[i]
+		width = value * scale
+		y = height - (level + 1) * FRAME_HEIGHT - 4
+		label = '%s (%s %s, %.2f%%)' % (symbol, '{:,}'.format(round(value)), unit, value / total * 100)
+
+		out.append('<g><title>%s</title>' % escape(label))
+		out.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s" rx="2"/>' % (x, y,
+			width, FRAME_HEIGHT - 1, _color(symbol)))
+
+		# Roughly 0.6em per character, leave room for padding.
+		chars = int((width - 6) / (FONT_SIZE * 0.6))
+		if chars >= 3:
+			text = symbol if len(symbol) <= chars else symbol[:chars - 2] + '..'
+			out.append('<text x="%.1f" y="%d">%s</text>' % (x + 3, y + FRAME_HEIGHT - 4, escape(text)))
+
+		out.append('</g>')
+
+	out.append('</svg>')
+	f.write('\n'.join(out) + '\n')
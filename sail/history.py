@@ -0,0 +1,84 @@
+import sqlite3
+
+# Symbols stored per profile, the most expensive ones by inclusive and by
+# exclusive wall time. Trends of other symbols have gaps.
+SYMBOL_LIMIT = 2000
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS profiles (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE,
+	url TEXT,
+	method TEXT,
+	timestamp INTEGER,
+	release TEXT,
+	runs INTEGER,
+	wt INTEGER, cpu INTEGER, mu INTEGER, pmu INTEGER, ct INTEGER,
+	queries INTEGER, http_reqs INTEGER
+);
+CREATE INDEX IF NOT EXISTS profiles_url ON profiles (url, timestamp);
+CREATE TABLE IF NOT EXISTS symbols (
+	id INTEGER PRIMARY KEY,
+	name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS metrics (
+	symbol INTEGER,
+	profile INTEGER,
+	ct INTEGER, wt INTEGER, excl_wt INTEGER, mu INTEGER, excl_mu INTEGER,
+	PRIMARY KEY (symbol, profile)
+) WITHOUT ROWID;
+'''
+
+def connect(path):
+	db = sqlite3.connect(str(path))
+	db.row_factory = sqlite3.Row
+	db.executescript(_schema)
+	return db
+
+def has(db, path):
+	return db.execute('SELECT 1 FROM profiles WHERE path = ?', (path,)).fetchone() is not None
+
+def ingest(db, path, url, profile):
+	'''Add a profile and its most expensive symbols, replacing an earlier copy'''
+	totals = profile.totals
+
+	with db:
+		db.execute('DELETE FROM metrics WHERE profile IN (SELECT id FROM profiles WHERE path = ?)', (path,))
+		db.execute('DELETE FROM profiles WHERE path = ?', (path,))
+
+		cursor = db.execute('''INSERT INTO profiles (path, url, method, timestamp, release, runs,
+			wt, cpu, mu, pmu, ct, queries, http_reqs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+			(path, url, totals['method'], totals['timestamp'], profile.meta.get('release'), totals['runs'],
+			totals['wt'], totals['cpu'], totals['mu'], totals['pmu'], totals['ct'], totals['queries'], totals['http_reqs']))
+
+		profile_id = cursor.lastrowid
+		symbols = set(profile.order('wt')[:SYMBOL_LIMIT]) | set(profile.order('excl_wt')[:SYMBOL_LIMIT])
+		names = [profile.symbols[i] for i in symbols]
+
+		db.executemany('INSERT OR IGNORE INTO symbols (name) VALUES (?)', [(name,) for name in names])
+		ids = {}
+		for chunk in range(0, len(names), 500):
+			chunk = names[chunk:chunk + 500]
+			query = 'SELECT id, name FROM symbols WHERE name IN (%s)' % ','.join('?' * len(chunk))
+			ids.update((row['name'], row['id']) for row in db.execute(query, chunk))
+
+		columns = [profile.column(key) for key in ['ct', 'wt', 'excl_wt', 'mu', 'excl_mu']]
+		db.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)',
+			[(ids[profile.symbols[i]], profile_id) + tuple(column[i] for column in columns) for i in symbols])
+
+	return profile_id
+
+def trend(db, url, symbol=None, since=0):
+	'''Profiles of a URL in time order, with the metrics of a symbol if given.
+	Metrics are None for profiles in which the symbol was not stored.'''
+	if symbol is None:
+		return db.execute('''SELECT timestamp, release, path, ct, wt, mu, pmu FROM profiles
+			WHERE url = ? AND timestamp >= ? ORDER BY timestamp''', (url, since)).fetchall()
+
+	return db.execute('''SELECT p.timestamp, p.release, p.path, m.ct, m.wt, m.excl_wt, m.mu, m.excl_mu
+		FROM profiles p LEFT JOIN metrics m ON m.profile = p.id AND m.symbol = (SELECT id FROM symbols WHERE name = ?)
+		WHERE p.url = ? AND p.timestamp >= ? ORDER BY p.timestamp''', (symbol, url, since)).fetchall()
+
+def urls(db):
+	'''Profiled URLs with the number of profiles, most profiled first'''
+	return db.execute('SELECT url, COUNT(*) AS count FROM profiles GROUP BY url ORDER BY count DESC').fetchall()
@@ -63,10 +63,7 @@ def wp(command):
 	command = util.join(command)
 
 	os.execlp('ssh', 'ssh', '-tt',
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'-o', 'LogLevel=QUIET',
 		'root@%s' % config['hostname'],
 		'sudo -u www-data bash -c "cd %s; wp %s"' % (util.remote_path('/public'), command)
@@ -175,10 +172,7 @@ def logs(nginx, php, nginx_access, nginx_error, php_error, postfix, mysql, follo
 			command += ' | less -S +G'
 
 	os.execlp('ssh', 'ssh', '-tt',
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'-o', 'LogLevel=QUIET',
 		'root@%s' % config['hostname'],
 		command
@@ -38,7 +38,7 @@ def restore(ctx, path, yes, skip_db, skip_uploads, nowait):
 	config = util.config()
 
 	if not path.isnumeric() or pathlib.Path(path).exists():
-		return ctx.forward(sail.backups.restore)
+		return ctx.invoke(sail.backups.restore, path=path, yes=yes, skip_db=skip_db, skip_uploads=skip_uploads)
 
 	util.heading('Restoring backup')
 	util.item('Requesting remote backup restore')
@@ -183,6 +183,13 @@ def export(ctx, timestamp, nowait):
 	util.item('Task completed successfully')
 	ctx.invoke(info, timestamp=timestamp)
 
+# Local snapshot commands, this group replaces the one in sail.backups. The
+# local export is renamed, export is taken by remote backups.
+backup.add_command(sail.backups.export, name='snapshot-export')
+backup.add_command(sail.backups.ls)
+backup.add_command(sail.backups.prune)
+backup.add_command(sail.backups.check)
+
 @backup.command()
 @click.argument('timestamp', nargs=1, required=True)
 @click.option('--json', 'as_json', is_flag=True, help='Return results as a JSON object')
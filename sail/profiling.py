@@ -1,6 +1,7 @@
-from sail import cli, util
+import sail
+from sail import cli, util, xhprof, flamegraph, history
 
-import click, pathlib, json
+import click, pathlib, json, io
 import os, re
 import requests
 import time
@@ -8,11 +9,17 @@ import click.utils
 
 import curses
 import textwrap
+from array import array
 from urllib.parse import urlparse
-from datetime import datetime
+from datetime import datetime, timedelta
 import subprocess
 import shlex
 import shutil
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.etree import ElementTree
 
 # shortcuts:
 # sail profile .profiles/some-file.json
@@ -20,10 +27,21 @@ import shutil
 
 # sail profile open .profiles/something.json
 # sail profile run https://example.org
+# sail profile batch sitemap.xml --concurrency 8
+# sail profile export .profiles/something.json --format svg
 # sail profile curl -H 'Some: header' -XPOST https://example.org
 # sail profile key --header
 # sail profile download /var/www/profiles/filename.xhprof
 # sail profile clean
+# sail profile sampling --rate 100 --threshold 1000
+# sail profile top --hours 1
+# sail profile trend https://example.org/shop/ --symbol WC_Cart::calculate_totals
+
+# Columns reports can be sorted by.
+_sort_keys = ['ct', 'wt', 'excl_wt', 'cpu', 'excl_cpu', 'mu', 'excl_mu', 'pmu', 'excl_pmu']
+
+# Metrics the critical path can follow, with their column labels.
+_path_metrics = {'wt': 'iWT', 'cpu': 'iCPU', 'mu': 'iMEM'}
 
 class ProfilerCmd(click.Group):
 	def resolve_command(self, ctx, args):
@@ -48,87 +66,236 @@ def profile(ctx):
 @click.argument('path', nargs=1)
 def open(path):
 	'''Open the profile browser with the specified JSON file'''
-	path = pathlib.Path(path)
-	if not path.exists() or not path.is_file():
-		raise util.SailException('The profile file is invalid or does not exist')
+	profile = _load(path)
 
-	with path.open('r') as f:
-		try:
-			profile_data = json.load(f)
-			xhprof_data = profile_data['xhprof']
-		except:
-			raise util.SailException('This profile file is invalid, invalid or incomplete JSON')
+	os.environ.setdefault('ESCDELAY', '10')
+	curses.wrapper(_browser, profile=profile)
 
-	del profile_data['xhprof']
+@profile.command()
+@click.argument('path', nargs=1)
+@click.option('--top', type=click.IntRange(1), default=20, help='Number of functions to show, 20 by default')
+@click.option('--sort', type=click.Choice(_sort_keys), default='excl_wt', help='Column to sort functions by, excl_wt by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def report(path, top, sort, as_json):
+	'''Summarize a profile without the interactive browser'''
+	profile = _load(path)
 
-	totals = {'ct': 0, 'wt': 0, 'ut': 0, 'st': 0, 'cpu': 0, 'mu': 0, 'pmu': 0, 'samples': 0,
-		'queries': 0, 'http_reqs': 0, 'timestamp': profile_data['timestamp'],
-		'method': profile_data['method'], 'host': profile_data['host'],
-		'request_uri': profile_data['request_uri']}
+	if sort not in profile.columns:
+		raise util.SailException('This profile does not have %s data' % sort)
 
-	metrics = []
-	for key in totals.keys():
-		if key in xhprof_data['main()']:
-			metrics.append(key)
+	data = _report(profile, top, sort)
 
-	data = {}
+	if as_json:
+		click.echo(json.dumps(data))
+		return
 
-	# Compute inclusive times
-	for func, info in xhprof_data.items():
-		try:
-			parent, child = func.split('==>')
-		except:
-			child = func
-			parent = None
+	util.label_width(16)
+	click.echo()
 
-		if child not in data:
-			data[child] = {'ct': 0, 'wt': 0, 'ut': 0, 'st': 0, 'cpu': 0,
-				'mu': 0, 'pmu': 0, 'samples': 0, 'parents': [], 'children': []}
+	labels = {
+		'url': 'URL', 'method': 'Method', 'wt': 'Wall Time (µs)', 'cpu': 'CPU Time (µs)',
+		'pmu': 'Peak Memory', 'ct': 'Function Calls', 'queries': 'Queries', 'http_reqs': 'HTTP Reqs',
+	}
 
-		for metric in metrics:
-			data[child][metric] += info[metric]
+	if 'runs' in data:
+		labels.update({'runs': 'Runs', 'wt:median': 'Median WT (µs)', 'wt:p95': 'p95 WT (µs)', 'wt:stddev': 'Stddev WT (µs)'})
 
-		# More counts
-		func = child.split('#', 1)[0]
-		if func in ['mysqli_query', 'mysql_query', 'mysqli::query']:
-			totals['queries'] += data[child]['ct']
-		elif func in ['curl_exec']:
-			totals['http_reqs'] += data[child]['ct']
+	for key, label in labels.items():
+		value = data['totals'].get(key, data.get(key))
+		value = util.sizeof_fmt(value) if key == 'pmu' else '{:,}'.format(value) if isinstance(value, int) else value
+		click.echo('%s %s' % (util.label(label + ':'), value))
 
-	for metric in metrics:
-		totals[metric] = data['main()'][metric]
+	columns = _columns(profile)
+	for column in columns:
+		column['width'] = max([len(column['label'])] + [len('{:,}'.format(f[column['key']])) for f in data['functions']]) + 2
 
-	# Reset the calls, we'll count them again
-	totals['ct'] = 0
+	click.echo()
+	click.echo(''.join(c['label'].rjust(c['width']) for c in columns) + '  Function')
 
-	for child, info in data.items():
-		totals['ct'] += info['ct']
-		for metric in metrics:
-			data[child]['excl_' + metric] = info[metric]
+	for function in data['functions']:
+		click.echo(''.join('{:,}'.format(function[c['key']]).rjust(c['width']) for c in columns)
+			+ '  ' + function['symbol'])
 
-	for func, info in xhprof_data.items():
-		try:
-			parent, child = func.split('==>')
-		except:
-			child = func
-			parent = None
+	click.echo()
+	_echo_critical_path(data['critical_path'], 'wt')
+	click.echo()
 
-		if not parent:
-			continue
+@profile.command('critical-path')
+@click.argument('path', nargs=1)
+@click.option('--metric', type=click.Choice(list(_path_metrics)), default='wt', help='Metric to follow, wt by default')
+@click.option('--from', 'start', help='Symbol to start from instead of main()')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def critical_path(path, metric, start, as_json):
+	'''Follow the most expensive child from main() down to the hot spot'''
+	profile = _load(path)
 
-		data[child]['parents'].append(parent)
-		data[parent]['children'].append(child)
+	if metric not in profile.edge_metrics:
+		raise util.SailException('This profile does not have %s data' % metric)
 
-		for metric in metrics:
-			data[parent]['excl_' + metric] -= info[metric]
+	if start is not None and start not in profile.ids:
+		raise util.SailException('Symbol not found in profile: %s' % start)
 
-	os.environ.setdefault('ESCDELAY', '10')
-	curses.wrapper(_browser, data=data, totals=totals)
+	data = _critical_path(profile, metric, profile.ids.get(start))
+
+	if as_json:
+		click.echo(json.dumps(data))
+		return
+
+	click.echo()
+	_echo_critical_path(data, metric)
+	click.echo()
+
+def _critical_path(profile, key, start=None):
+	steps = []
+	for i, value, percent in profile.critical_path(key, start):
+		steps.append({'symbol': profile.symbols[i], key: value, 'percent': round(percent, 2)})
+
+	return steps
+
+def _echo_critical_path(steps, key):
+	click.echo('Critical path (%s, %% of parent):' % _path_metrics[key])
+
+	for depth, step in enumerate(steps):
+		click.echo('{:>14,}  {:>5.1f}%  {}{}'.format(step[key], step['percent'], ' ' * min(depth, 40), step['symbol']))
+
+@profile.command()
+@click.argument('path', nargs=1)
+@click.option('--format', 'fmt', type=click.Choice(['collapsed', 'speedscope', 'svg']), default='svg', help='Output format, svg by default')
+@click.option('--metric', type=click.Choice(['wt', 'cpu']), default='wt', help='Metric to weigh stacks by, wt by default')
+@click.option('--output', '-o', help='Output file, next to the profile by default, - for stdout')
+def export(path, fmt, metric, output):
+	'''Export a profile as collapsed stacks, speedscope JSON or an SVG flame graph'''
+	profile = _load(path)
+
+	if metric not in profile.edge_metrics:
+		raise util.SailException('This profile does not have %s data' % metric)
+
+	if output is None:
+		suffix = {'collapsed': '.collapsed.txt', 'speedscope': '.speedscope.json', 'svg': '.svg'}[fmt]
+		path = pathlib.Path(path)
+		output = path.with_name(path.name.replace('.json', '') + suffix)
+
+	title = '%s %s (%s)' % (profile.totals['method'], _request_url(profile.totals), metric)
+	writers = {
+		'collapsed': flamegraph.collapsed,
+		'speedscope': flamegraph.speedscope,
+		'svg': lambda profile, f, key: flamegraph.svg(profile, f, key, title),
+	}
+
+	if output == '-':
+		writers[fmt](profile, click.get_text_stream('stdout'), metric)
+		return
+
+	with click.open_file(str(output), 'w') as f:
+		writers[fmt](profile, f, metric)
+
+	util.success('Profile exported to %s' % output)
+
+@profile.command()
+@click.argument('path', nargs=1)
+@click.option('--top', type=click.IntRange(1), default=20, help='Number of queries to show, 20 by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def queries(path, top, as_json):
+	'''Group the SQL queries of a profile by fingerprint and flag N+1 patterns'''
+	profile = _load(path)
+	data = _queries_report(profile, top)
+
+	if as_json:
+		click.echo(json.dumps(data))
+		return
+
+	click.echo()
+	if not data:
+		click.echo('No queries found in this profile')
+		return
+
+	click.echo('{:>7}  {:>12}  {:>10}  {:>6}  {}'.format('Count', 'WT (µs)', 'Mean', '%', 'Query'))
+
+	for query in data:
+		n_plus_one = '[N+1] ' if query['n_plus_one'] else ''
+		click.echo('{:>7,}  {:>12,}  {:>10,}  {:>6.2f}  {}{}'.format(query['ct'], query['wt'], query['mean'],
+			query['percent'], n_plus_one, query['fingerprint']))
+
+		if query['n_plus_one'] and query['callers']:
+			click.echo('{:>43}called from {}'.format('', query['callers'][0]))
+
+	click.echo()
+
+@profile.command()
+@click.argument('path', nargs=1)
+@click.option('--top', type=click.IntRange(1), default=20, help='Number of endpoints to show, 20 by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def http(path, top, as_json):
+	'''Group outbound HTTP requests of a profile by host and path'''
+	profile = _load(path)
+	data = _http_report(profile, top)
+
+	if as_json:
+		click.echo(json.dumps(data))
+		return
+
+	click.echo()
+	if not data:
+		click.echo('No HTTP requests found in this profile')
+		return
+
+	click.echo('{:>7}  {:>12}  {:>10}  {:>6}  {}'.format('Count', 'WT (µs)', 'Mean', '%', 'Endpoint'))
+
+	for call in data:
+		click.echo('{:>7,}  {:>12,}  {:>10,}  {:>6.2f}  {}{}'.format(call['ct'], call['wt'], call['mean'],
+			call['percent'], call['host'], call['path']))
+
+		if call['triggers']:
+			click.echo('{:>43}called from {}'.format('', ', '.join(call['triggers'][:3])))
+
+	click.echo()
+
+@profile.command()
+@click.argument('path', nargs=1)
+@click.option('--top', type=click.IntRange(1), default=20, help='Number of plugins and hooks to show, 20 by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def plugins(path, top, as_json):
+	'''Break down hook callback time by plugin and by hook'''
+	profile = _load(path)
+	if 'hooks' not in profile.meta:
+		raise util.SailException('This profile has no hook timings. Profile with: sail profile run --hooks')
+
+	data = _plugins_report(profile, top)
+
+	if as_json:
+		click.echo(json.dumps(data))
+		return
+
+	click.echo()
+	if not data['plugins']:
+		click.echo('No hook callbacks found in this profile')
+		return
+
+	click.echo('{:>7}  {:>12}  {:>10}  {:>6}  {}'.format('Count', 'WT (µs)', 'Mean', '%', 'Component'))
+
+	for plugin in data['plugins']:
+		click.echo('{:>7,}  {:>12,}  {:>10,}  {:>6.2f}  {}'.format(plugin['ct'], plugin['wt'], plugin['mean'],
+			plugin['percent'], plugin['component']))
+		click.echo('{:>43}hooks: {}'.format('', ', '.join(plugin['hooks'][:3])))
+
+	click.echo()
+	click.echo('{:>7}  {:>12}  {:>10}  {:>6}  {}'.format('Count', 'WT (µs)', 'Mean', '%', 'Hook'))
+
+	for hook in data['hooks']:
+		click.echo('{:>7,}  {:>12,}  {:>10,}  {:>6.2f}  {}'.format(hook['ct'], hook['wt'], hook['mean'],
+			hook['percent'], hook['hook']))
+
+		for callback in hook['callbacks'][:3]:
+			click.echo('{:>43}{} ({}, {:,} µs)'.format('', callback['callback'], callback['component'], callback['wt']))
+
+	click.echo()
 
 @profile.command()
 @click.argument('url', nargs=1)
+@click.option('--repeat', type=click.IntRange(1), default=1, help='Profile the URL this many times and aggregate the results')
+@click.option('--hooks', is_flag=True, help='Time WordPress hook callbacks by plugin, see sail profile plugins')
 @click.pass_context
-def run(ctx, url):
+def run(ctx, url, repeat, hooks):
 	'''Run the profiler on a URL, download and open the results'''
 	root = util.find_root()
 	config = util.config()
@@ -137,26 +304,254 @@ def run(ctx, url):
 		raise util.SailException('Profile key not found in .sail/config.json')
 
 	url = urlparse(url)
+
+	util.heading('Profiling')
+	util.item('Server: %s' % config['hostname'])
+	util.item('Host: %s' % url.netloc)
+
+	session = requests.Session()
+
+	if repeat == 1:
+		filename = _request(session, config, url, hooks=hooks)
+		return ctx.invoke(open, path=ctx.invoke(download, path=filename))
+
+	# Runs are sequential so they don't compete for the same PHP workers.
+	filenames = []
+	for n in range(repeat):
+		util.item('Run %d of %d' % (n + 1, repeat))
+		filenames.append(_request(session, config, url, hooks=hooks))
+
+	timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+	names = ['%s-%d.xhprof.json' % (timestamp, n + 1) for n in range(repeat)]
+	paths = _fetch(filenames, _profiles_dir(), names)
+
+	click.echo()
+	return ctx.invoke(open, path=_aggregate(paths))
+
+@profile.command()
+@click.argument('source', nargs=1)
+@click.option('--concurrency', type=click.IntRange(1, 64), default=4, help='Number of requests to run at once, 4 by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def batch(source, concurrency, as_json):
+	'''Profile every URL in a file or sitemap.xml and download the results'''
+	root = util.find_root()
+	config = util.config()
+
+	if 'profile_key' not in config:
+		raise util.SailException('Profile key not found in .sail/config.json')
+
+	urls = _batch_urls(source)
+	if not urls:
+		raise util.SailException('Could not find any URLs in %s' % source)
+
+	util.heading('Profiling %d URLs' % len(urls))
+	util.item('Server: %s' % config['hostname'])
+	util.item('Concurrency: %d' % concurrency)
+
+	# Sessions are not thread-safe, each worker keeps its own connection pool.
+	local = threading.local()
+	def request(url):
+		if not hasattr(local, 'session'):
+			local.session = requests.Session()
+		return _request(local.session, config, urlparse(url), quiet=True)
+
+	filenames = {}
+	errors = {}
+	done = 0
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		futures = {executor.submit(request, url): url for url in urls}
+		for future in as_completed(futures):
+			url = futures[future]
+			done += 1
+
+			try:
+				filenames[url] = future.result()
+				util.item('[%d/%d] %s' % (done, len(urls), url))
+			except util.SailException as e:
+				errors[url] = str(e)
+				util.item('[%d/%d] %s: %s' % (done, len(urls), url, e))
+
+	if not filenames:
+		raise util.SailException('None of the profiling requests succeeded')
+
+	directory = _profiles_dir() / ('batch-%s' % datetime.now().strftime('%Y-%m-%d-%H%M%S'))
+	directory.mkdir()
+
+	captured = [url for url in urls if url in filenames]
+	names = ['%03d.xhprof.json' % (urls.index(url) + 1) for url in captured]
+	paths = dict(zip(captured, _fetch([filenames[url] for url in captured], directory, names)))
+
+	results = []
+	for url in urls:
+		if url not in paths:
+			results.append({'url': url, 'error': errors[url]})
+			continue
+
+		totals = _load(paths[url]).totals
+		results.append({
+			'url': url,
+			'path': str(paths[url].relative_to(root)),
+			'wt': totals['wt'],
+			'queries': totals['queries'],
+			'http_reqs': totals['http_reqs'],
+		})
+
+	if as_json:
+		click.echo(json.dumps(results))
+		return
+
+	click.echo()
+	click.echo('{:>10}  {:>7}  {:>5}  {}'.format('WT (ms)', 'Queries', 'HTTP', 'URL'))
+
+	for result in results:
+		if 'error' in result:
+			click.echo('{:>10}  {:>7}  {:>5}  {}'.format('-', '-', '-', result['url']))
+			continue
+
+		click.echo('{:>10,.1f}  {:>7,}  {:>5,}  {}'.format(result['wt'] / 1000, result['queries'],
+			result['http_reqs'], result['url']))
+
+	click.echo()
+	util.success('Profiles saved to %s' % directory.relative_to(root))
+
+def _measure(urls, repeat, directory, prefix):
+	'''Profile every URL a number of times, one after another, and return
+	a profile per URL, aggregated over the runs'''
+	config = util.config()
+	session = requests.Session()
+
+	filenames = []
+	names = []
+
+	for n, url in enumerate(urls):
+		util.item('Profiling %s' % url)
+		for run in range(repeat):
+			filenames.append(_request(session, config, urlparse(url), quiet=True))
+			names.append('%s-%03d-%d.xhprof.json' % (prefix, n + 1, run + 1))
+
+	paths = _fetch(filenames, directory, names)
+
+	profiles = {}
+	for n, url in enumerate(urls):
+		runs = [_load(path) for path in paths[n * repeat:(n + 1) * repeat]]
+		profiles[url] = xhprof.aggregate(runs) if repeat > 1 else runs[0]
+
+	return profiles
+
+def _warm(urls):
+	'''Request every URL once without profiling, to fill opcache and object caches'''
+	config = util.config()
+	session = requests.Session()
+
+	for url in urls:
+		url = urlparse(url)
+		try:
+			query = '?' + url.query if url.query else ''
+			session.get('%s://%s%s%s' % (url.scheme, config['hostname'], url.path or '/', query),
+				headers={'Host': url.netloc}, allow_redirects=False, timeout=60)
+		except requests.RequestException:
+			pass
+
+def _batch_urls(source):
+	'''URLs from a plain list file or a sitemap.xml, local or remote'''
+	try:
+		if re.match(r'^https?://', source):
+			response = requests.get(source, timeout=30)
+			response.raise_for_status()
+			text = response.text
+		else:
+			text = pathlib.Path(source).read_text()
+	except (OSError, requests.RequestException):
+		raise util.SailException('Could not read URLs from %s' % source)
+
+	if not text.lstrip().startswith('<'):
+		lines = [line.strip() for line in text.splitlines()]
+		return list(dict.fromkeys(line for line in lines if line and not line.startswith('#')))
+
+	try:
+		document = ElementTree.fromstring(text.lstrip())
+	except ElementTree.ParseError:
+		raise util.SailException('Could not parse sitemap %s' % source)
+
+	locations = [e.text.strip() for e in document.iter() if e.tag.split('}')[-1] == 'loc' and e.text]
+
+	# Sitemap indexes point to more sitemaps.
+	if document.tag.split('}')[-1] == 'sitemapindex':
+		return list(dict.fromkeys(url for location in locations for url in _batch_urls(location)))
+
+	return list(dict.fromkeys(locations))
+
+def _profiles_dir():
+	profiles_dir = pathlib.Path(util.find_root() + '/.profiles')
+	profiles_dir.mkdir(parents=True, exist_ok=True)
+	return profiles_dir
+
+def _fetch(filenames, directory, names):
+	'''Download remote profiles with a single rsync and delete them with a single rm'''
+	config = util.config()
+	util.item('Downloading %d profiles' % len(filenames))
+
+	with tempfile.TemporaryDirectory(dir=directory) as temp_dir, \
+		tempfile.NamedTemporaryFile('w', suffix='.txt') as files_from:
+
+		files_from.write(''.join(filename.lstrip('/') + '\n' for filename in filenames))
+		files_from.flush()
+
+		args = ['-t', '--no-relative', '--files-from=%s' % files_from.name]
+		source = 'root@%s:/' % config['hostname']
+		returncode, stdout, stderr = util.rsync(args, source, temp_dir + '/', default_filters=False)
+
+		if returncode != 0:
+			raise util.SailException('An error occurred in rsync. Please try again.')
+
+		paths = []
+		for filename, name in zip(filenames, names):
+			path = directory / name
+			os.replace(pathlib.Path(temp_dir) / os.path.basename(filename), path)
+			paths.append(path)
+
+	for path in paths:
+		_ingest(path)
+
+	util.item('Cleaning up production')
+
+	p = subprocess.Popen(['ssh',
+		*util.ssh_args(),
+		'root@%s' % config['hostname'],
+		util.join(['rm', '-f', *filenames])
+	])
+
+	while p.poll() is None:
+		util.loader()
+
+	if p.returncode != 0:
+		raise util.SailException('An error occurred in SSH. Please try again.')
+
+	return paths
+
+def _request(session, config, url, quiet=False, hooks=False):
+	'''Make a profiled request and return the remote profile filename'''
 	host = config['hostname']
 	query = url.query
-	nocache = 'SAIL_NO_CACHE=%d' % time.time()
+	nocache = 'SAIL_NO_CACHE=%d' % (time.time() * 1000000)
 	query = nocache if not query else query + '&' + nocache
 	query = '?' + query
 	url_path = url.path if url.path else '/'
 
-	util.heading('Profiling')
-	util.item('Server: %s' % host)
-	util.item('Host: %s' % url.netloc)
-	util.item('Request: GET %s%s' % (url_path, query))
+	if not quiet:
+		util.item('Request: GET %s%s' % (url_path, query))
 
 	headers = {
 		'Host': url.netloc,
 		'X-Sail-Profile': config['profile_key'],
 	}
 
+	if hooks:
+		headers['X-Sail-Profile-Hooks'] = '1'
+
 	request = requests.Request('GET', '%s://%s%s%s' % (url.scheme, host, url.path, query), headers=headers)
 	request = request.prepare()
-	session = requests.Session()
 
 	try:
 		response = session.send(request, allow_redirects=False)
@@ -166,9 +561,21 @@ def run(ctx, url):
 	if 'X-Sail-Profile' not in response.headers:
 		raise util.SailException('X-Sail-Profile header not found in response. Check your profile key.')
 
-	filename = response.headers['X-Sail-Profile']
-	profile_path = ctx.invoke(download, path=filename)
-	return ctx.invoke(open, path=profile_path)
+	return response.headers['X-Sail-Profile']
+
+def _aggregate(paths):
+	'''Merge downloaded runs into an .aggregate.xhprof.json profile'''
+	util.item('Aggregating %d profiles' % len(paths))
+
+	profile = xhprof.aggregate([_load(path) for path in paths])
+	path = paths[-1].with_name(paths[-1].name.replace('.xhprof.json', '.aggregate.xhprof.json'))
+
+	with path.open('w') as f:
+		xhprof.dump(profile, f)
+
+	util.item('Aggregated profile saved to .profiles/%s' % path.name)
+	click.echo()
+	return path
 
 @profile.command()
 @click.option('--header', is_flag=True, help="Provide the result as an HTTP header string")
@@ -237,7 +644,13 @@ def download(ctx, path):
 	profiles_dir = pathlib.Path(root + '/.profiles')
 	profiles_dir.mkdir(parents=True, exist_ok=True)
 
-	dest_filename = datetime.now().strftime('%Y-%m-%d-%H%M%S.xhprof.json')
+	timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+	dest_filename = timestamp + '.xhprof.json'
+
+	n = 1
+	while (profiles_dir / dest_filename).exists():
+		n += 1
+		dest_filename = '%s-%d.xhprof.json' % (timestamp, n)
 	util.item('Downloading profile from %s' % path)
 
 	args = ['-t']
@@ -251,10 +664,7 @@ def download(ctx, path):
 	util.item('Cleaning up production')
 
 	p = subprocess.Popen(['ssh',
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'root@%s' % config['hostname'],
 		'rm %s' % path
 	])
@@ -265,10 +675,284 @@ def download(ctx, path):
 	if p.returncode != 0:
 		raise util.SailException('An error occurred in SSH. Please try again.')
 
+	_ingest(profiles_dir / dest_filename)
+
 	util.item('Profile saved to .profiles/%s' % dest_filename)
 	click.echo()
 	return profiles_dir / dest_filename
 
+@profile.command()
+@click.option('--rate', type=click.IntRange(0), help='Profile 1 in this many requests, 0 to only keep slow ones')
+@click.option('--threshold', type=click.IntRange(0), help='Also keep every request slower than this many ms, 0 to disable')
+@click.option('--max-size', type=click.IntRange(1), help='Disk space for hourly rollups on the server in MB, 50 by default')
+@click.option('--disable', is_flag=True, help='Disable sampled profiling')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def sampling(rate, threshold, max_size, disable, as_json):
+	'''Show or configure always-on sampled profiling on the server'''
+	root = util.find_root()
+	config = util.config()
+	c = util.connection()
+
+	try:
+		remote_config = json.loads(c.run('cat /etc/sail/config.json').stdout)
+	except:
+		raise util.SailException('Could not read /etc/sail/config.json')
+
+	sample = remote_config.get('profile_sample')
+	changed = disable or any(value is not None for value in [rate, threshold, max_size])
+
+	if disable:
+		sample = None
+	elif changed:
+		sample = dict(sample or {'rate': 100, 'threshold': 0, 'max_size': 50})
+		for key, value in [('rate', rate), ('threshold', threshold), ('max_size', max_size)]:
+			if value is not None:
+				sample[key] = value
+
+		if not sample['rate'] and not sample['threshold']:
+			raise util.SailException('Set a --rate or a --threshold, or --disable sampling')
+
+	if changed:
+		if not as_json:
+			util.heading('Updating profile sampling')
+			util.item('Uploading prepend.php')
+
+		# Older servers may not have the sampling code yet.
+		c.put(sail.TEMPLATES_PATH + '/prepend.php', '/etc/sail/prepend.php')
+
+		if not as_json:
+			util.item('Updating /etc/sail/config.json')
+
+		remote_config.pop('profile_sample', None)
+		if sample:
+			remote_config['profile_sample'] = sample
+
+		c.put(io.StringIO(json.dumps(remote_config)), '/etc/sail/config.json')
+
+		# prepend.php reads this instead of config.json on every request.
+		if sample:
+			c.put(io.StringIO(_sample_php(sample)), '/etc/sail/profile-sample.php')
+		else:
+			c.run('rm -f /etc/sail/profile-sample.php')
+
+	if as_json:
+		click.echo(json.dumps(sample))
+		return
+
+	if not sample:
+		(util.success if changed else click.echo)('Sampled profiling is disabled')
+		return
+
+	message = 'Sampling 1 in %d requests' % sample['rate'] if sample['rate'] else 'Sampling slow requests only'
+	if sample['threshold']:
+		message += ', all requests over %dms' % sample['threshold']
+
+	message += ', rollups capped at %dMB' % sample['max_size']
+	(util.success if changed else click.echo)(message)
+
+def _sample_php(sample):
+	'''Sampling settings as a PHP file which returns an array'''
+	values = ', '.join("'%s' => %d" % (key, int(sample[key])) for key in ['rate', 'threshold', 'max_size'])
+	return '<?php\nreturn [ %s ];\n' % values
+
+@profile.command()
+@click.option('--hours', type=click.IntRange(1, 48), default=1, help='Number of hours to include, 1 by default')
+@click.option('--top', type=click.IntRange(1), default=20, help='Number of functions and URL patterns to show, 20 by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def top(hours, top, as_json):
+	'''Hot functions and slow URL patterns from sampled profiling on the server'''
+	root = util.find_root()
+	config = util.config()
+	c = util.connection()
+
+	# Rollups are hourly, in UTC, the current hour is partial.
+	now = datetime.utcnow()
+	directories = ['%s/profiles/rollups/%s' % (util.remote_path(), (now - timedelta(hours=n)).strftime('%Y%m%d%H'))
+		for n in range(hours + 1)]
+
+	command = ' '.join('%s/*.json' % shlex.quote(directory) for directory in directories)
+	r = c.run('cat %s 2>/dev/null' % command, warn=True)
+
+	rollups = []
+	for line in r.stdout.splitlines():
+		try:
+			rollups.append(json.loads(line))
+		except ValueError:
+			pass
+
+	data = _top(rollups, top)
+
+	if as_json:
+		click.echo(json.dumps(data))
+		return
+
+	click.echo()
+	if not data['requests']:
+		click.echo('No sampled requests found, see sail profile sampling')
+		return
+
+	click.echo('%s %s requests (%s slow) in the last %d hour%s' % (util.label('Profiled:'), '{:,}'.format(data['requests']),
+		'{:,}'.format(data['slow']), hours, 's' if hours > 1 else ''))
+
+	click.echo()
+	click.echo('{:>9}  {:>6}  {:>12}  {:>12}  {}'.format('Requests', 'Slow', 'Mean WT (µs)', 'Max WT (µs)', 'URL pattern'))
+
+	for pattern in data['patterns']:
+		click.echo('{:>9,}  {:>6,}  {:>12,}  {:>12,}  {}'.format(pattern['requests'], pattern['slow'],
+			pattern['mean_wt'], pattern['max_wt'], pattern['pattern']))
+
+	click.echo()
+	click.echo('{:>12}  {:>14}  {:>14}  {:>6}  {}'.format('Calls/req', 'iWT/req (µs)', 'eWT/req (µs)', '%', 'Function'))
+
+	for function in data['functions']:
+		click.echo('{:>12,}  {:>14,}  {:>14,}  {:>6.2f}  {}'.format(function['ct'], function['wt'],
+			function['excl_wt'], function['percent'], function['symbol']))
+
+	click.echo()
+
+def _top(rollups, top):
+	'''Merge hourly rollups into hot functions and URL patterns, per request'''
+	patterns = {}
+	functions = {}
+
+	for rollup in rollups:
+		pattern = patterns.setdefault(rollup['pattern'], {'pattern': rollup['pattern'], 'requests': 0,
+			'slow': 0, 'wt': 0, 'max_wt': 0})
+
+		for key in ['requests', 'slow', 'wt']:
+			pattern[key] += rollup[key]
+
+		pattern['max_wt'] = max(pattern['max_wt'], rollup['max_wt'])
+
+		# Empty objects are encoded as [] by PHP.
+		for symbol, values in (rollup['functions'] or {}).items():
+			totals = functions.setdefault(symbol, [0, 0, 0])
+			for i, value in enumerate(values):
+				totals[i] += value
+
+	requests = sum(pattern['requests'] for pattern in patterns.values())
+	total = sum(pattern['wt'] for pattern in patterns.values())
+
+	for pattern in patterns.values():
+		pattern['mean_wt'] = round(pattern['wt'] / pattern['requests']) if pattern['requests'] else 0
+
+	data = {
+		'requests': requests,
+		'slow': sum(pattern['slow'] for pattern in patterns.values()),
+		'patterns': sorted(patterns.values(), key=lambda pattern: pattern['wt'], reverse=True)[:top],
+		'functions': [],
+	}
+
+	for symbol in sorted(functions, key=lambda symbol: functions[symbol][2], reverse=True)[:top]:
+		ct, wt, excl_wt = functions[symbol]
+		data['functions'].append({
+			'symbol': symbol,
+			'ct': round(ct / requests) if requests else 0,
+			'wt': round(wt / requests) if requests else 0,
+			'excl_wt': round(excl_wt / requests) if requests else 0,
+			'percent': round(excl_wt / total * 100, 2) if total else 0.0,
+		})
+
+	return data
+
+@profile.command()
+@click.argument('url', nargs=1)
+@click.option('--symbol', help='Function to chart instead of the whole request')
+@click.option('--days', type=click.IntRange(1), default=30, help='Number of days to include, 30 by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format')
+def trend(url, symbol, days, as_json):
+	'''Chart wall time and memory of a URL or function across profiles'''
+	root = util.find_root()
+	db = _history()
+	key = _url_key(url)
+
+	since = int(time.time()) - days * 86400
+	rows = [dict(row) for row in history.trend(db, key, symbol, since)]
+
+	if not rows:
+		known = [row['url'] for row in history.urls(db)[:5]]
+		message = 'No profiles of %s in the last %d days' % (key or '/', days)
+		if known:
+			message += '. Profiled URLs include: %s' % ', '.join(known)
+		raise util.SailException(message)
+
+	if as_json:
+		click.echo(json.dumps(rows))
+		return
+
+	memory = 'pmu' if symbol is None else 'mu'
+	found = [row for row in rows if row['wt'] is not None]
+	if not found:
+		raise util.SailException('%s was not among the stored functions of any profile' % symbol)
+
+	high = max(row['wt'] for row in found)
+
+	click.echo()
+	click.echo('%s %s' % (util.label('URL:'), key or '/'))
+	if symbol:
+		click.echo('%s %s' % (util.label('Function:'), symbol))
+
+	click.echo()
+	click.echo('{:<16}  {:<10}  {:<30}  {:>12}  {:>10}'.format('Date', 'Release', 'Wall Time', 'µs',
+		'Peak Mem' if memory == 'pmu' else 'Memory'))
+
+	for row in rows:
+		date = datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M')
+		release = row['release'] or '-'
+
+		if row['wt'] is None:
+			click.echo('{:<16}  {:<10}  {:<30}  {:>12}  {:>10}'.format(date, release, '', '-', '-'))
+			continue
+
+		click.echo('{:<16}  {:<10}  {:<30}  {:>12,}  {:>10}'.format(date, release, _bar(row['wt'], high, 30),
+			row['wt'], util.sizeof_fmt(row[memory])))
+
+	click.echo()
+
+@profile.command()
+def index():
+	'''Add existing profiles in .profiles to the history database'''
+	root = util.find_root()
+	db = _history()
+
+	util.heading('Indexing profiles')
+	added = 0
+
+	for path in sorted(_profiles_dir().rglob('*.xhprof.json')):
+		if '.aggregate.' in path.name or history.has(db, str(path.relative_to(_profiles_dir()))):
+			continue
+
+		if _ingest(path, db):
+			added += 1
+		else:
+			util.item('Skipped invalid profile: %s' % path.relative_to(_profiles_dir()))
+
+	util.success('Added %d profiles to the history database' % added)
+
+def _history():
+	return history.connect(_profiles_dir() / 'history.sqlite')
+
+def _ingest(path, db=None):
+	'''Add a downloaded profile to the history database, failures are not fatal'''
+	try:
+		profile = _load(path)
+		url = _url_key(_request_url(profile.totals))
+		history.ingest(db or _history(), str(path.relative_to(_profiles_dir())), url, profile)
+		return True
+	except (util.SailException, sqlite3.Error, KeyError, TypeError, ValueError, OSError) as e:
+		util.dlog('Could not add %s to the history database: %r' % (path, e))
+		return False
+
+def _url_key(url):
+	'''URLs as keyed in the history database, without a trailing slash'''
+	url = urlparse(url if '://' in url else 'http://' + url)
+	return url.netloc + url.path.rstrip('/') + ('?' + url.query if url.query else '')
+
+def _bar(value, high, width):
+	'''A horizontal bar in eighths of a character'''
+	eighths = round(value / high * width * 8) if high > 0 else 0
+	return '█' * (eighths // 8) + ('', '▏', '▎', '▍', '▌', '▋', '▊', '▉')[eighths % 8]
+
 @profile.command()
 def clean():
 	'''Delete all profiling data from production and local working copy'''
@@ -283,39 +967,174 @@ def clean():
 
 	util.item('Deleting production profiles')
 	p = subprocess.Popen(['ssh',
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'root@%s' % config['hostname'],
 		'rm -rf %s/profiles/*' % util.remote_path()
 	])
 
-	while p.poll() is None:
-		pass
+	while p.poll() is None:
+		pass
+
+	if p.returncode != 0:
+		raise util.SailException('An error occurred in SSH. Please try again.')
+
+	util.success('Cleanup complete')
+
+@profile.command()
+@click.argument('base', nargs=1)
+@click.argument('new', nargs=1)
+@click.option('--top', type=click.IntRange(1), default=20, help='Number of functions to show with --json, 20 by default')
+@click.option('--sort', type=click.Choice(_sort_keys), default='excl_wt', help='Column to sort changes by, excl_wt by default')
+@click.option('--json', 'as_json', is_flag=True, help='Output in JSON format instead of opening the browser')
+def diff(base, new, top, sort, as_json):
+	'''Compare two profiles symbol by symbol, largest regressions first'''
+	base = _load(base)
+	new = _load(new)
+	profile = xhprof.diff(base, new)
+
+	if sort not in profile.columns:
+		raise util.SailException('These profiles do not have %s data' % sort)
+
+	if as_json:
+		click.echo(json.dumps(_diff_report(base, new, profile, top, sort)))
+		return
+
+	os.environ.setdefault('ESCDELAY', '10')
+	curses.wrapper(_browser, profile=profile)
+
+def _load(path):
+	'''Read a profile for the browser and reports, with its sidecar cache'''
+	path = pathlib.Path(path)
+	if not path.exists() or not path.is_file():
+		raise util.SailException('The profile file is invalid or does not exist')
+
+	try:
+		return xhprof.read(path, orders=[column['key'] for column in _columns()])
+	except (ValueError, TypeError):
+		raise util.SailException('This profile file is invalid, invalid or incomplete JSON')
+
+def _request_url(totals):
+	request_uri = totals['request_uri']
+	request_uri = re.sub(r'&?SAIL_NO_CACHE=[0-9]+', '', request_uri)
+	request_uri = request_uri.rstrip('?')
+	if request_uri == '/':
+		request_uri = ''
+
+	return totals['host'] + request_uri
+
+def _report(profile, top, sort):
+	'''Hot functions, totals and the critical path of a profile'''
+	totals = profile.totals
+	data = {
+		'url': _request_url(totals),
+		'method': totals['method'],
+		'timestamp': totals['timestamp'],
+		'totals': {key: totals[key] for key in ['wt', 'cpu', 'mu', 'pmu', 'ct', 'queries', 'http_reqs']},
+		'functions': [],
+		'critical_path': [],
+	}
+
+	if totals.get('runs', 1) > 1:
+		data['runs'] = totals['runs']
+		for stat in xhprof.STATS:
+			data['totals']['wt:' + stat] = totals['wt:' + stat]
+
+	for i in profile.order(sort)[:top]:
+		function = {'symbol': profile.symbols[i]}
+		for key in _sort_keys + [key for key in profile.columns if ':' in key]:
+			if key in profile.columns:
+				function[key] = profile.column(key)[i]
+
+		data['functions'].append(function)
+
+	if 'wt' in profile.edge_metrics:
+		data['critical_path'] = _critical_path(profile, 'wt')
+
+	return data
+
+def _diff_report(base, new, profile, top, sort):
+	'''Per-symbol and total changes between two profiles'''
+	def value(p, symbol, key):
+		i = p.ids.get(symbol)
+		return p.column(key)[i] if i is not None and key in p.columns else 0
+
+	data = {
+		'base': {'url': _request_url(base.totals), 'timestamp': base.totals['timestamp']},
+		'new': {'url': _request_url(new.totals), 'timestamp': new.totals['timestamp']},
+		'totals': {},
+		'functions': [],
+	}
+
+	for key in ['wt', 'cpu', 'mu', 'pmu', 'ct', 'queries', 'http_reqs']:
+		data['totals'][key] = {'base': base.totals[key], 'new': new.totals[key],
+			'delta': new.totals[key] - base.totals[key]}
+
+	for i in profile.order(sort)[:top]:
+		symbol = profile.symbols[i]
+		function = {'symbol': symbol, 'status': {1: 'added', -1: 'removed'}.get(profile.status[i])}
+
+		for key in _sort_keys:
+			if key in profile.columns:
+				function[key] = {'base': value(base, symbol, key), 'new': value(new, symbol, key),
+					'delta': profile.column(key)[i]}
+
+		data['functions'].append(function)
+
+	return data
+
+def _queries_report(profile, top):
+	'''Query fingerprints with symbol names instead of ids'''
+	data = []
+	for query in profile.queries()[:top]:
+		query = dict(query, percent=round(query['percent'], 2))
+		query['symbols'] = [profile.symbols[i] for i in query['symbols']]
+		query['callers'] = [profile.symbols[i] for i in query['callers']]
+		data.append(query)
 
-	if p.returncode != 0:
-		raise util.SailException('An error occurred in SSH. Please try again.')
+	return data
 
-	util.success('Cleanup complete')
+def _http_report(profile, top):
+	'''HTTP endpoints with symbol names instead of ids'''
+	data = []
+	for call in profile.http_calls()[:top]:
+		call = dict(call, percent=round(call['percent'], 2))
+		call['symbols'] = [profile.symbols[i] for i in call['symbols']]
+		call['triggers'] = [profile.symbols[i] for i in call['triggers']]
+		data.append(call)
+
+	return data
+
+def _plugins_report(profile, top):
+	'''Plugins and hooks by hook callback time, with callbacks as dicts'''
+	data = {'plugins': [], 'hooks': []}
+	for plugin in profile.plugins()[:top]:
+		data['plugins'].append(dict(plugin, percent=round(plugin['percent'], 2)))
+
+	for hook in profile.hooks()[:top]:
+		hook = dict(hook, percent=round(hook['percent'], 2))
+		hook['callbacks'] = [{'component': component, 'callback': callback, 'wt': wt}
+			for component, callback, wt in hook['callbacks']]
+		data['hooks'].append(hook)
+
+	return data
 
 def _render_summary(pad, totals):
+	if 'base' in totals:
+		return _render_diff_summary(pad, totals['base'], totals)
+
 	run_id = datetime.fromtimestamp(totals['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
 
 	pad.addstr(0, 0, 'Run: ', curses.color_pair(1))
 	pad.addstr(run_id, curses.color_pair(2))
 	pad.addstr(' Wall Time: ', curses.color_pair(1))
 	pad.addstr('{:,} µs'.format(totals['wt']), curses.color_pair(2))
+	if totals.get('runs', 1) > 1:
+		pad.addstr(' (mean of {}, ±{:,} p95 {:,})'.format(totals['runs'], totals['wt:stddev'], totals['wt:p95']),
+			curses.color_pair(1))
 	pad.addstr(' Peak Memory: ', curses.color_pair(1))
 	pad.insstr('{:,.2f} MiB'.format(totals['pmu']/1024/1024), curses.color_pair(2))
 
-	request_uri = totals['request_uri']
-	request_uri = re.sub(r'&?SAIL_NO_CACHE=[0-9]+', '', request_uri)
-	request_uri = request_uri.rstrip('?')
-	if request_uri == '/':
-		request_uri = ''
-
-	url = totals['host'] + request_uri
+	url = _request_url(totals)
 	pad.addstr(1, 0, 'URL: ', curses.color_pair(1))
 	pad.addstr(1, 5, url, curses.color_pair(2))
 
@@ -329,16 +1148,36 @@ def _render_summary(pad, totals):
 	pad.addstr(' HTTP Reqs: ', curses.color_pair(1))
 	pad.addstr('{:,}'.format(totals['http_reqs']), curses.color_pair(2))
 
-def _render_listview(pad, columns, data, cols, selected=0, lines=None):
-	y = -1
+def _render_diff_summary(pad, base, new):
+	rows, cols = pad.getmaxyx()
+	runs = [datetime.fromtimestamp(t['timestamp']).strftime('%Y-%m-%d %H:%M:%S') for t in [base, new]]
+
+	def change(key, fmt='{:,}'):
+		delta = new[key] - base[key]
+		return '%s → %s (%s%s)' % (fmt.format(base[key]), fmt.format(new[key]), '+' if delta >= 0 else '-', fmt.format(abs(delta)))
+
+	lines = [
+		[('Diff: ', 1), ('%s → %s' % tuple(runs), 2), (' Wall Time: ', 1), (change('wt') + ' µs', 2)],
+		[('URL: ', 1), (_request_url(base), 2), (' → ', 1), (_request_url(new), 2)],
+		[('Function Calls: ', 1), (change('ct'), 2), (' Queries: ', 1), (change('queries'), 2),
+			(' HTTP Reqs: ', 1), (change('http_reqs'), 2)],
+	]
 
-	if lines:
-		offset_y, visible = lines
-		y += offset_y
-		data = data[offset_y:visible+1]
+	for y, parts in enumerate(lines):
+		x = 0
+		for text, color in parts:
+			text = text[:max(cols - x - 1, 0)]
+			pad.addstr(y, x, text, curses.color_pair(color))
+			x += len(text)
 
-	for entry in data:
-		y += 1
+def _render_listview(pad, columns, data, cols, selected=0, lines=None):
+	'''Render the rows of data between lines (first, last) into a pad of that height'''
+	offset_y, last = lines if lines else (0, len(data) - 1)
+	pad.erase()
+
+	for y in range(offset_y, min(last, len(data) - 1) + 1):
+		entry = data[y]
+		row = y - offset_y
 
 		if y == selected:
 			pad.attron(curses.color_pair(4) if curses.has_colors() else curses.A_REVERSE)
@@ -347,20 +1186,20 @@ def _render_listview(pad, columns, data, cols, selected=0, lines=None):
 
 		if 'header' in entry:
 			pad.attron(curses.color_pair(3) if curses.has_colors() else curses.A_REVERSE)
-			pad.hline(y, 0, ' ', cols)
-			pad.addstr(y, 0, '  ' + entry['header'])
+			pad.hline(row, 0, ' ', cols)
+			pad.addstr(row, 0, '  ' + entry['header'])
 			pad.attroff(curses.color_pair(3) if curses.has_colors() else curses.A_REVERSE)
 			continue
 
 		if 'space' in entry:
-			pad.hline(y, 0, ' ', cols)
+			pad.hline(row, 0, ' ', cols)
 			continue
 
 		if 'meta' in entry:
 			if y != selected:
 				pad.attron(curses.color_pair(5))
-			pad.hline(y, 0, ' ', cols)
-			pad.insstr(y, 0, '  ' + entry['meta'])
+			pad.hline(row, 0, ' ', cols)
+			pad.insstr(row, 0, '  ' + entry['meta'])
 			if y != selected:
 				pad.attroff(curses.color_pair(5))
 
@@ -369,8 +1208,11 @@ def _render_listview(pad, columns, data, cols, selected=0, lines=None):
 		label = entry['label']
 		args = entry.get('args')
 
-		pad.hline(y, 0, ' ', cols)
-		pad.addstr(y, 0, '  ' + label)
+		pad.hline(row, 0, ' ', cols)
+		if entry.get('warning') and y != selected and curses.has_colors():
+			pad.addstr(row, 0, ('  ' + label)[:cols - 1], curses.color_pair(6))
+		else:
+			pad.addstr(row, 0, ('  ' + label)[:cols - 1])
 		if args:
 			if y != selected:
 				pad.attron(curses.color_pair(5))
@@ -378,21 +1220,26 @@ def _render_listview(pad, columns, data, cols, selected=0, lines=None):
 			if y != selected:
 				pad.attroff(curses.color_pair(5))
 		for column in reversed(columns):
-			pad.insstr(y, cols - sum([i['width'] for i in columns]) - 2, '{:,}'.format(entry[column['key']]).rjust(column['width']))
+			pad.insstr(row, cols - sum([i['width'] for i in columns]) - 2, '{:,}'.format(entry[column['key']]).rjust(column['width']))
 
-		pad.insstr(y, cols-2, '  ')
+		pad.insstr(row, cols-2, '  ')
 
 def _render_footer(pad, selected, max, cols):
 	max -= 1 # selected is 0-based
 	pad.attron(curses.color_pair(1))
 	pad.hline(0, 0, '-', cols)
-	label = ' %d/%d %d%% ' % (selected, max, selected/max * 100)
+	label = ' %d/%d %d%% ' % (selected, max, selected/max * 100 if max else 0)
 	pad.insstr(0, cols - len(label) - 1, label )
 	pad.attroff(curses.color_pair(1))
 
 def _render_sticky_header(pad, columns, data, cols, offset_y):
 	header = None
 	i = offset_y
+
+	# Lazy rows have no headers after their static entries.
+	if isinstance(data, _Rows):
+		i = min(i, len(data.entries) - 1)
+
 	while not header and i >= 0:
 		if 'header' in data[i]:
 			header = data[i]
@@ -418,20 +1265,18 @@ def _render_sticky_header(pad, columns, data, cols, offset_y):
 
 	pad.attroff(curses.color_pair(3) if curses.has_colors() else curses.A_REVERSE)
 
-def _render_view_symbol(stdscr, data, totals, symbol, selected=1, sort=2):
+def _render_view_symbol(stdscr, profile, symbol, selected=1, sort=2):
 	rows, cols = stdscr.getmaxyx()
+	totals = profile.totals
 
-	columns = _columns();
-	for column in columns:
-		column['width'] = max(len(column['label']), len('{:,}'.format(max([i[column['key']] for _, i in data.items()])))) + 2
+	columns = _columns(profile)
 
 	sort_key = columns[sort]['key']
 	columns[sort]['sort'] = True
 	listview_data = [{'header': 'Function'}]
 
-	entry = data[symbol]
-
-	item = {'function': symbol, 'label': symbol}
+	name = profile.symbols[symbol]
+	item = {'function': symbol, 'label': name}
 
 	meta = None
 	expand_meta_for = [
@@ -441,8 +1286,8 @@ def _render_view_symbol(stdscr, data, totals, symbol, selected=1, sort=2):
 		'mysqli::query',
 	]
 
-	if '#' in symbol:
-		item['label'], args = symbol.split('#', 1)
+	if '#' in name:
+		item['label'], args = name.split('#', 1)
 
 		expand = True if item['label'] in expand_meta_for else False
 		if item['label'].endswith('{closure}'):
@@ -456,51 +1301,27 @@ def _render_view_symbol(stdscr, data, totals, symbol, selected=1, sort=2):
 			item['args'] = args
 
 	for col in columns:
-		item[col['key']] = entry[col['key']]
+		item[col['key']] = profile.column(col['key'])[symbol]
 
 	listview_data.append(item)
 	if meta:
 		listview_data.append({'space': ''})
 		listview_data.extend(meta)
 
-	if len(set(entry['parents'])):
+	parents = [profile.edge_parent[e] for e in profile.parents(symbol) if profile.edge_parent[e] >= 0]
+	if parents:
 		listview_data.append({'space': ''})
 		listview_data.append({'header': 'Parent functions'})
-		parents = []
-
-		for parent in entry['parents']:
-			item = {'function': parent, 'label': parent}
-
-			if '#' in parent:
-				item['label'], item['args'] = parent.split('#', 1)
-
-			for col in columns:
-				item[col['key']] = data[parent][col['key']]
-
-			parents.append(item)
-
-		listview_data.extend(sorted(parents, key=lambda x: x[sort_key], reverse=True))
+		listview_data.extend(_list_items(profile, columns, parents, sort_key))
 
-	if len(set(entry['children'])):
+	children = [profile.edge_child[e] for e in profile.children(symbol)]
+	if children:
 		listview_data.append({'space': ''})
 		listview_data.append({'header': 'Child functions'})
-		children = []
-
-		for child in entry['children']:
-			item = {'function': child, 'label': child}
-
-			if '#' in child:
-				item['label'], item['args'] = child.split('#', 1)
-
-			for col in columns:
-				item[col['key']] = data[child][col['key']]
-
-			children.append(item)
-
-		listview_data.extend(sorted(children, key=lambda x: x[sort_key], reverse=True))
+		listview_data.extend(_list_items(profile, columns, children, sort_key))
 
 	summary = curses.newpad(3, cols)
-	listview = curses.newpad(len(listview_data), cols)
+	listview = curses.newpad(rows - 5, cols)
 	sticky_header = curses.newpad(1, cols)
 	footer = curses.newpad(1, cols)
 
@@ -520,13 +1341,14 @@ def _render_view_symbol(stdscr, data, totals, symbol, selected=1, sort=2):
 		if refresh:
 			lines = (offset_y, offset_y + visible)
 			_render_listview(listview, columns, listview_data, cols, selected, lines)
-			listview.refresh(offset_y,0, 4,0, rows-2,cols-1)
+			listview.refresh(0,0, 4,0, rows-2,cols-1)
 
 			_render_sticky_header(sticky_header, columns, listview_data, cols, offset_y)
 			sticky_header.refresh(0,0, 4,0, 6,cols-1)
 
 			_render_footer(footer, selected, len(listview_data), cols)
 			footer.refresh(0,0, rows-1,0, rows-1,cols-1)
+			refresh = False
 
 		c = stdscr.getch()
 		selected, refresh = _handle_scroll(c, listview_data, visible, selected, refresh)
@@ -562,39 +1384,271 @@ def _render_view_symbol(stdscr, data, totals, symbol, selected=1, sort=2):
 
 			return ('view_symbol', listview_data[selected]['function'], selected)
 
+		elif c == ord('c'):
+			return ('view_critical', symbol, 'wt')
+
 		elif c == ord('q'):
 			return 'exit'
 
 		elif c == curses.KEY_RESIZE:
 			return 'resize'
 
-def _render_view_main(stdscr, data, totals, selected=1, sort=2):
-	rows, cols = stdscr.getmaxyx()
+def _render_view_queries(stdscr, profile, selected=1, sort=2):
+	'''Queries grouped by fingerprint, N+1 patterns highlighted'''
+	queries = profile.queries()
+	n_plus_one = len([query for query in queries if query['n_plus_one']])
 
-	columns = _columns()
-	for column in columns:
-		column['width'] = max(len(column['label']), len('{:,}'.format(max([i[column['key']] for _, i in data.items()])))) + 2
+	header = 'Queries: %d fingerprints' % len(queries)
+	if n_plus_one:
+		header += ', %d repeated %d+ times (N+1)' % (n_plus_one, xhprof.N_PLUS_ONE)
+
+	items = []
+	for query in queries:
+		item = {key: query[key] for key in ['ct', 'wt', 'mean']}
+		item['percent'] = round(query['percent'], 1)
+		item['function'] = query['symbols'][0]
+		item['label'] = ('[N+1] ' if query['n_plus_one'] else '') + query['fingerprint']
+		item['warning'] = query['n_plus_one']
+
+		if query['n_plus_one'] and query['callers']:
+			item['args'] = profile.symbols[query['callers'][0]]
+
+		items.append(item)
+
+	return _render_view_grouped(stdscr, profile, header, items, 'No queries found in this profile', selected, sort)
+
+def _render_view_http(stdscr, profile, selected=1, sort=2):
+	'''Outbound HTTP requests grouped by host and path, with their trigger'''
+	calls = profile.http_calls()
+	header = 'HTTP requests: %d to %d hosts' % (sum(call['ct'] for call in calls),
+		len({call['host'] for call in calls}))
+
+	items = []
+	for call in calls:
+		item = {key: call[key] for key in ['ct', 'wt', 'mean']}
+		item['percent'] = round(call['percent'], 1)
+		item['function'] = call['symbols'][0]
+		item['label'] = call['host'] + call['path']
+
+		if call['triggers']:
+			item['args'] = profile.symbols[call['triggers'][0]]
 
-	listview_data = [
-		{'header': 'Functions'},
+		items.append(item)
+
+	return _render_view_grouped(stdscr, profile, header, items, 'No HTTP requests found in this profile', selected, sort)
+
+def _render_view_plugins(stdscr, profile, selected=1, sort=2):
+	'''Hook callback time by plugin, with the slowest hook of each'''
+	plugins = profile.plugins()
+	header = 'Plugins: %d components' % len(plugins)
+
+	items = []
+	for plugin in plugins:
+		item = {key: plugin[key] for key in ['ct', 'wt', 'mean']}
+		item['percent'] = round(plugin['percent'], 1)
+		item['label'] = plugin['component']
+
+		if plugin['hooks']:
+			item['args'] = plugin['hooks'][0]
+
+		items.append(item)
+
+	empty = 'No hook timings in this profile, use sail profile run --hooks'
+	return _render_view_grouped(stdscr, profile, header, items, empty, selected, sort)
+
+def _render_view_grouped(stdscr, profile, header, items, empty, selected=1, sort=2):
+	'''List view of grouped calls (queries, HTTP requests) with count, mean,
+	total and percent columns. Enter opens the slowest symbol of a group.'''
+	rows, cols = stdscr.getmaxyx()
+
+	# Total time lines up with eWT, the default sort column.
+	columns = [
+		{'key': 'ct', 'label': 'Count'},
+		{'key': 'mean', 'label': 'Mean'},
+		{'key': 'wt', 'label': 'iWT'},
+		{'key': 'percent', 'label': '%'},
 	]
 
-	sort_key = columns[sort]['key']
+	for column in columns:
+		column['width'] = max([len(column['label'])] + [len('{:,}'.format(i[column['key']])) for i in items]) + 2
+
+	sort = min(sort, len(columns) - 1)
 	columns[sort]['sort'] = True
+	items.sort(key=lambda item: item[columns[sort]['key']], reverse=True)
+
+	listview_data = [{'header': header}] + items
+	if not items:
+		listview_data.append({'space': ''})
+		listview_data.append({'meta': empty})
+
+	summary = curses.newpad(3, cols)
+	listview = curses.newpad(rows - 5, cols)
+	sticky_header = curses.newpad(1, cols)
+	footer = curses.newpad(1, cols)
+
+	_render_summary(summary, profile.totals)
+	summary.refresh(0,0, 0,0, 4, cols - 1)
+
+	visible = rows - 6
+	offset_y = 0
+	refresh = True
+
+	while True:
+		if selected > visible + offset_y:
+			offset_y = selected - visible
+		elif selected <= offset_y:
+			offset_y = max(selected - 1, 0)
+
+		if refresh:
+			lines = (offset_y, offset_y + visible)
+			_render_listview(listview, columns, listview_data, cols, selected, lines)
+			listview.refresh(0,0, 4,0, rows-2,cols-1)
+
+			_render_sticky_header(sticky_header, columns, listview_data, cols, offset_y)
+			sticky_header.refresh(0,0, 4,0, 6,cols-1)
+
+			_render_footer(footer, selected, len(listview_data), cols)
+			footer.refresh(0,0, rows-1,0, rows-1,cols-1)
+			refresh = False
+
+		c = stdscr.getch()
+		selected, refresh = _handle_scroll(c, listview_data, visible, selected, refresh)
+
+		# Sorting
+		if c == curses.KEY_RIGHT or c == ord('>'):
+			next = min(sort + 1, len(columns) - 1)
+			if next == sort:
+				continue
+
+			return ('sort', next)
+
+		elif c == curses.KEY_LEFT or c == ord('<'):
+			prev = max(sort - 1, 0)
+			if prev == sort:
+				continue
+
+			return ('sort', prev)
+
+		elif c == 27:
+			return 'view_main'
+
+		elif c == curses.KEY_BACKSPACE or c == 127 or c == '\b':
+			return 'pop'
+
+		elif c == curses.KEY_ENTER or c == 13 or c == 10:
+			if 'function' not in listview_data[selected]:
+				continue
+
+			return ('view_symbol', listview_data[selected]['function'], selected)
+
+		elif c == ord('q'):
+			return 'exit'
 
-	for func, info in sorted(data.items(), key=lambda x: x[1][sort_key], reverse=True):
-		item = {'function': func, 'label': func}
+		elif c == curses.KEY_RESIZE:
+			return 'resize'
 
-		if '#' in func:
-			item['label'], item['args'] = func.split('#', 1)
+def _render_view_critical(stdscr, profile, selected=1, sort=2, symbol=None, metric='wt'):
+	'''Critical path from main() or a symbol, m switches the metric'''
+	rows, cols = stdscr.getmaxyx()
+	metrics = [key for key in _path_metrics if key in profile.edge_metrics]
+	if metrics and metric not in metrics:
+		metric = metrics[0]
+
+	columns = [
+		{'key': 'ct', 'label': 'Count'},
+		{'key': 'value', 'label': _path_metrics[metric]},
+		{'key': 'percent', 'label': '% parent'},
+	]
 
-		for col in columns:
-			item[col['key']] = info[col['key']]
+	start = 'main()' if symbol is None else profile.symbols[symbol]
+	listview_data = [{'header': 'Critical path from %s by %s (m to switch)' % (start, _path_metrics[metric])}]
 
+	steps = profile.critical_path(metric, symbol) if metrics else []
+	for depth, (i, value, percent) in enumerate(steps):
+		item = _item(profile, [columns[0]], i)
+		item['label'] = ' ' * min(depth, 40) + item['label']
+		item['value'] = value
+		item['percent'] = round(percent, 1)
 		listview_data.append(item)
 
+	for column in columns:
+		column['width'] = max([len(column['label'])] + [len('{:,}'.format(i[column['key']])) for i in listview_data[1:]]) + 2
+
+	if not metrics:
+		listview_data.append({'space': ''})
+		listview_data.append({'meta': 'No wall time, CPU or memory data in this profile'})
+
 	summary = curses.newpad(3, cols)
-	listview = curses.newpad(len(listview_data), cols)
+	listview = curses.newpad(rows - 5, cols)
+	sticky_header = curses.newpad(1, cols)
+	footer = curses.newpad(1, cols)
+
+	_render_summary(summary, profile.totals)
+	summary.refresh(0,0, 0,0, 4, cols - 1)
+
+	visible = rows - 6
+	offset_y = 0
+	refresh = True
+
+	while True:
+		if selected > visible + offset_y:
+			offset_y = selected - visible
+		elif selected <= offset_y:
+			offset_y = max(selected - 1, 0)
+
+		if refresh:
+			lines = (offset_y, offset_y + visible)
+			_render_listview(listview, columns, listview_data, cols, selected, lines)
+			listview.refresh(0,0, 4,0, rows-2,cols-1)
+
+			_render_sticky_header(sticky_header, columns, listview_data, cols, offset_y)
+			sticky_header.refresh(0,0, 4,0, 6,cols-1)
+
+			_render_footer(footer, selected, len(listview_data), cols)
+			footer.refresh(0,0, rows-1,0, rows-1,cols-1)
+			refresh = False
+
+		c = stdscr.getch()
+		selected, refresh = _handle_scroll(c, listview_data, visible, selected, refresh)
+
+		if c == ord('m') and metrics:
+			metric = metrics[(metrics.index(metric) + 1) % len(metrics)]
+			return ('view_critical', symbol, metric)
+
+		elif c == 27:
+			return 'view_main'
+
+		elif c == curses.KEY_BACKSPACE or c == 127 or c == '\b':
+			return 'pop'
+
+		elif c == curses.KEY_ENTER or c == 13 or c == 10:
+			if 'function' not in listview_data[selected]:
+				continue
+
+			return ('view_symbol', listview_data[selected]['function'], selected)
+
+		elif c == ord('q'):
+			return 'exit'
+
+		elif c == curses.KEY_RESIZE:
+			return 'resize'
+
+def _render_view_main(stdscr, profile, selected=1, sort=2, query=None):
+	rows, cols = stdscr.getmaxyx()
+	totals = profile.totals
+
+	columns = _columns(profile)
+
+	sort_key = columns[sort]['key']
+	columns[sort]['sort'] = True
+
+	header = 'Functions matching: %s' % query if query else 'Functions'
+	order = _filtered(profile, sort_key, query)
+	listview_data = _Rows(profile, columns, [{'header': header}], order)
+	positions = profile.rank(sort_key) if not query else _positions(profile, order)
+
+	summary = curses.newpad(3, cols)
+	listview = curses.newpad(rows - 5, cols)
 	sticky_header = curses.newpad(1, cols)
 	footer = curses.newpad(1, cols)
 
@@ -605,25 +1659,77 @@ def _render_view_main(stdscr, data, totals, selected=1, sort=2):
 	visible = rows - 6
 	refresh = True
 
+	# Incremental search and filter prompts, as (mode, text).
+	prompt = None
+	matches = None
+
 	while True:
 		if selected > visible + offset_y:
 			offset_y = selected - visible
 		elif selected <= offset_y:
-			offset_y = selected - 1
+			offset_y = max(selected - 1, 0)
 
 		if refresh:
 			lines = (offset_y, offset_y + visible)
 			_render_listview(listview, columns, listview_data, cols, selected, lines)
-			listview.refresh(offset_y,0, 4,0, rows-2,cols-1)
+			listview.refresh(0,0, 4,0, rows-2,cols-1)
 
 			_render_sticky_header(sticky_header, columns, listview_data, cols, offset_y)
 			sticky_header.refresh(0,0, 4,0, 6,cols-1)
 
-			_render_footer(footer, selected, len(listview_data), cols)
+			if prompt:
+				count = len(matches) if prompt[0] == 'search' else len(order)
+				_render_prompt(footer, prompt, count, cols)
+			else:
+				_render_footer(footer, selected, len(listview_data), cols)
+
 			footer.refresh(0,0, rows-1,0, rows-1,cols-1)
 			refresh = False
 
 		c = stdscr.getch()
+
+		if prompt:
+			mode, text = prompt
+			refresh = True
+
+			if c == 27:
+				prompt = None
+				if mode == 'filter':
+					return ('filter', query)
+				continue
+
+			elif c == curses.KEY_ENTER or c == 13 or c == 10:
+				prompt = None
+				if mode == 'filter':
+					return ('filter', text)
+				continue
+
+			elif c == curses.KEY_BACKSPACE or c == 127 or c == 8:
+				text = text[:-1]
+				previous = None
+
+			elif 32 <= c < 127:
+				previous = matches if mode == 'search' and text else None
+				text += chr(c)
+
+			else:
+				continue
+
+			prompt = (mode, text)
+
+			if mode == 'search':
+				matches = profile.search(text, within=previous) if text else []
+				found = _next_match(positions, matches, -1)
+				if found is not None:
+					selected = found + 1
+
+			else:
+				order = _filtered(profile, sort_key, text)
+				listview_data = _Rows(profile, columns, [{'header': 'Functions matching: %s' % text}], order)
+				selected = 1
+
+			continue
+
 		selected, refresh = _handle_scroll(c, listview_data, visible, selected, refresh)
 
 		# Sorting
@@ -641,8 +1747,42 @@ def _render_view_main(stdscr, data, totals, selected=1, sort=2):
 
 			return ('sort', prev)
 
+		elif c == ord('/'):
+			prompt = ('search', '')
+			matches = []
+			refresh = True
+
+		elif c == ord('f'):
+			prompt = ('filter', query or '')
+			refresh = True
+
+		elif c == ord('s'):
+			return 'view_queries'
+
+		elif c == ord('h'):
+			return 'view_http'
+
+		elif c == ord('p'):
+			return 'view_plugins'
+
+		elif c == ord('c'):
+			return ('view_critical', None, 'wt')
+
+		elif c == ord('n') or c == ord('N'):
+			if not matches:
+				continue
+
+			found = _next_match(positions, matches, selected - 1, -1 if c == ord('N') else 1)
+			if found is not None:
+				selected = found + 1
+				refresh = True
+
+		elif c == 27:
+			if query:
+				return ('filter', None)
+
 		elif c == curses.KEY_ENTER or c == 13 or c == 10:
-			if 'header' in listview_data[selected] or 'space' in listview_data[selected]:
+			if selected >= len(listview_data) or not _is_valid(listview_data, selected):
 				continue
 
 			return ('view_symbol', listview_data[selected]['function'], selected)
@@ -653,14 +1793,62 @@ def _render_view_main(stdscr, data, totals, selected=1, sort=2):
 		elif c == curses.KEY_RESIZE:
 			return 'resize'
 
-def _browser(stdscr, data, totals):
+def _filtered(profile, sort_key, expression):
+	'''Symbol ids matching a filter expression, in sort order'''
+	order = profile.order(sort_key)
+	if not expression:
+		return order
+
+	try:
+		matches = profile.filter(expression)
+	except ValueError:
+		return []
+
+	mask = bytearray(len(profile))
+	for i in matches:
+		mask[i] = 1
+
+	return [i for i in order if mask[i]]
+
+def _positions(profile, order):
+	'''Position of every symbol id in a (filtered) order, -1 if not in it'''
+	positions = array('i', [-1]) * len(profile)
+	for position, i in enumerate(order):
+		positions[i] = position
+
+	return positions
+
+def _next_match(positions, matches, current, step=1):
+	'''Closest list position of a search match after (or before) the current one'''
+	if step > 0:
+		found = [positions[i] for i in matches if positions[i] > current]
+		return min(found) if found else None
+
+	found = [positions[i] for i in matches if 0 <= positions[i] < current]
+	return max(found) if found else None
+
+def _render_prompt(pad, prompt, count, cols):
+	mode, text = prompt
+	label = '/' if mode == 'search' else 'Filter: '
+
+	pad.erase()
+	pad.attron(curses.color_pair(2))
+	pad.addstr(0, 0, (label + text)[:cols - 20])
+	pad.attroff(curses.color_pair(2))
+
+	status = ' %d matches ' % count
+	pad.attron(curses.color_pair(1))
+	pad.insstr(0, cols - len(status) - 1, status)
+	pad.attroff(curses.color_pair(1))
+
+def _browser(stdscr, profile):
 	try:
 		curses.curs_set(False)
 	except curses.error:
 		pass
 
 	current_view = _render_view_main
-	args = [stdscr, data, totals]
+	args = [stdscr, profile]
 	kwargs = {'selected': 1}
 	sort = 2
 	view_stack = []
@@ -671,6 +1859,7 @@ def _browser(stdscr, data, totals):
 		curses.init_pair(3, 0, 245)
 		curses.init_pair(4, 0, 255)
 		curses.init_pair(5, 247, curses.COLOR_BLACK)
+		curses.init_pair(6, curses.COLOR_RED, curses.COLOR_BLACK)
 
 	while True:
 		stdscr.refresh()
@@ -697,7 +1886,7 @@ def _browser(stdscr, data, totals):
 				continue
 
 			current_view = _render_view_main
-			args = [stdscr, data, totals]
+			args = [stdscr, profile]
 			kwargs = {}
 			continue
 
@@ -707,7 +1896,7 @@ def _browser(stdscr, data, totals):
 			# Pop back to the main view
 			if len(view_stack) < 1:
 				current_view = _render_view_main
-				args = [stdscr, data, totals]
+				args = [stdscr, profile]
 				continue
 
 			# Pop back to the previous symbol
@@ -723,6 +1912,36 @@ def _browser(stdscr, data, totals):
 			kwargs['selected'] = 1
 			continue
 
+		if r[0] == 'filter':
+			_, query = r
+			kwargs['query'] = query
+			kwargs['selected'] = 1
+			stdscr.erase()
+			continue
+
+		if r in ('view_queries', 'view_http', 'view_plugins'):
+			view_stack.append((current_view, args, kwargs))
+
+			current_view = {'view_queries': _render_view_queries, 'view_http': _render_view_http,
+				'view_plugins': _render_view_plugins}[r]
+			args = [stdscr, profile]
+			kwargs = {}
+			stdscr.erase()
+			continue
+
+		if r[0] == 'view_critical':
+			_, symbol, metric = r
+
+			# Switching metrics replaces the current critical path view.
+			if current_view != _render_view_critical:
+				view_stack.append((current_view, args, kwargs))
+
+			current_view = _render_view_critical
+			args = [stdscr, profile]
+			kwargs = {'symbol': symbol, 'metric': metric}
+			stdscr.erase()
+			continue
+
 		# Enter symbol view
 		if r[0] == 'view_symbol':
 			view, symbol, selected = r
@@ -732,7 +1951,7 @@ def _browser(stdscr, data, totals):
 			view_stack.append((current_view, args, kwargs))
 
 			current_view = _render_view_symbol
-			args = [stdscr, data, totals]
+			args = [stdscr, profile]
 			kwargs = {'symbol': symbol}
 			stdscr.erase()
 			continue
@@ -743,8 +1962,8 @@ def _browser(stdscr, data, totals):
 		stdscr.getch()
 		break
 
-def _columns():
-	return [
+def _columns(profile=None):
+	columns = [
 		{'key': 'ct', 'label': 'Count', 'width': 10},
 		{'key': 'wt', 'label': 'iWT', 'width': 10},
 		{'key': 'excl_wt', 'label': 'eWT', 'width': 10},
@@ -752,6 +1971,63 @@ def _columns():
 		{'key': 'excl_mu', 'label': 'eMEM', 'width': 10},
 	]
 
+	# Spread over runs for aggregated profiles.
+	if profile and 'excl_wt:stddev' in profile.columns:
+		columns += [
+			{'key': 'excl_wt:stddev', 'label': '±eWT', 'width': 10},
+			{'key': 'excl_wt:p95', 'label': 'p95 eWT', 'width': 10},
+		]
+
+	if profile:
+		for column in columns:
+			low, high = profile.extent(column['key'])
+			column['width'] = max(len(column['label']), len('{:,}'.format(low)), len('{:,}'.format(high))) + 2
+
+	return columns
+
+def _item(profile, columns, i):
+	'''List view entry for a symbol id'''
+	name = profile.symbols[i]
+	item = {'function': i, 'label': name}
+
+	if '#' in name:
+		item['label'], item['args'] = name.split('#', 1)
+
+	# Symbols added or removed in a diff.
+	if profile.status is not None and profile.status[i]:
+		item['label'] = ('[+] ' if profile.status[i] > 0 else '[-] ') + item['label']
+
+	for col in columns:
+		item[col['key']] = profile.column(col['key'])[i]
+
+	return item
+
+def _list_items(profile, columns, symbols, sort_key):
+	'''List view entries for symbol ids, sorted by a column'''
+	rank = profile.rank(sort_key)
+	return [_item(profile, columns, i) for i in sorted(set(symbols), key=rank.__getitem__)]
+
+class _Rows:
+	'''List view data with static entries followed by symbol entries, which are
+	only built when rendered, so views stay fast regardless of profile size.'''
+	def __init__(self, profile, columns, entries, order):
+		self.profile = profile
+		self.columns = columns
+		self.entries = entries
+		self.order = order
+
+	def __len__(self):
+		return len(self.entries) + len(self.order)
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+
+		if i < len(self.entries):
+			return self.entries[i]
+
+		return _item(self.profile, self.columns, self.order[i - len(self.entries)])
+
 def _is_valid(items, i):
 	return 'header' not in items[i] and 'space' not in items[i]
 
@@ -518,65 +518,70 @@ def _install(passwords):
 
 	# Prepare release directories
 	remote_path = util.remote_path()
-	c.run('mkdir -p %s/releases/1337' % remote_path)
-	c.run('mkdir -p %s/uploads' % remote_path)
-	c.run('mkdir -p %s/profiles' % remote_path)
-	c.run('chown -R www-data:www-data %s' % remote_path)
+	util.batch(c, [
+		'mkdir -p %s/releases/1337' % remote_path,
+		'mkdir -p %s/uploads' % remote_path,
+		'mkdir -p %s/profiles' % remote_path,
+		'chown -R www-data:www-data %s' % remote_path,
+	])
 
 	# Create a MySQL database
 	util.item('Setting up the MySQL database')
 
-	c.run('mysql -e "CREATE DATABASE \\`wordpress_%s\\`;"' % config['namespace'])
-	c.run('mysql -e "CREATE USER \\`wordpress_%s\\`@localhost IDENTIFIED BY \'%s\'"' % (config['namespace'], passwords['mysql']))
-	c.run('mysql -e "GRANT ALL PRIVILEGES ON \\`wordpress_%s\\`.* TO \\`wordpress_%s\\`@localhost;"' % (config['namespace'], config['namespace']))
+	util.batch(c, [
+		'mysql -e "CREATE DATABASE \\`wordpress_%s\\`;"' % config['namespace'],
+		'mysql -e "CREATE USER \\`wordpress_%s\\`@localhost IDENTIFIED BY \'%s\'"' % (config['namespace'], passwords['mysql']),
+		'mysql -e "GRANT ALL PRIVILEGES ON \\`wordpress_%s\\`.* TO \\`wordpress_%s\\`@localhost;"' % (config['namespace'], config['namespace']),
+	], redact=[passwords['mysql']])
 
 	util.item('Downloading and installing WordPress')
 	wp = f'cd {remote_path} && sudo -u www-data wp --path={remote_path}/releases/1337 '
 	admin_user = config['email'].split('@')[0]
 
-	c.run(wp + 'core download')
-	c.run(wp + util.join([
-		'config', 'create',
-		'--dbname=wordpress_%s' % config['namespace'],
-		'--dbuser=wordpress_%s' % config['namespace'],
-		'--dbpass=%s' % passwords['mysql']
-	]))
-	c.run(wp + util.join([
-		'core', 'install',
-		'--url=%s' % util.primary_url(),
-		'--title=Sailed',
-		'--admin_user=%s' % admin_user,
-		'--admin_password=%s' % passwords['wp'],
-		'--admin_email=%s' % config['email'],
-		'--skip-email'
-	]))
-	c.run(wp + util.join([
-		'rewrite', 'structure', '/%postname%/'
-	]))
-
-	# Disable standard wp-cron (will spawn via system cron).
-	c.run(wp + util.join([
-		'config', 'set', 'DISABLE_WP_CRON', 'true', '--raw'
-	]))
-
-	# Run any outstanding events (like the cron check).
-	c.run(wp + util.join([
-		'cron', 'event', 'run', '--due-now'
-	]))
+	util.batch(c, [
+		wp + 'core download',
+		wp + util.join([
+			'config', 'create',
+			'--dbname=wordpress_%s' % config['namespace'],
+			'--dbuser=wordpress_%s' % config['namespace'],
+			'--dbpass=%s' % passwords['mysql']
+		]),
+		wp + util.join([
+			'core', 'install',
+			'--url=%s' % util.primary_url(),
+			'--title=Sailed',
+			'--admin_user=%s' % admin_user,
+			'--admin_password=%s' % passwords['wp'],
+			'--admin_email=%s' % config['email'],
+			'--skip-email'
+		]),
+		wp + util.join([
+			'rewrite', 'structure', '/%postname%/'
+		]),
+
+		# Disable standard wp-cron (will spawn via system cron).
+		wp + util.join([
+			'config', 'set', 'DISABLE_WP_CRON', 'true', '--raw'
+		]),
+
+		# Run any outstanding events (like the cron check).
+		wp + util.join([
+			'cron', 'event', 'run', '--due-now'
+		]),
+	], redact=[passwords['mysql'], passwords['wp']])
 
 	# Do da deploy.
 	util.item('Cleaning up')
-	c.run('rm -rf %s/public' % remote_path)
-	c.run('ln -sfn %s/releases/1337 %s/public' % (remote_path, remote_path))
-	c.run('rm -rf %s/public/wp-content/uploads && ln -sfn %s/uploads %s/public/wp-content/uploads' % (
-		remote_path, remote_path, remote_path))
-
-	# Reload services
-	c.run('systemctl reload nginx.service')
-
-	php_config = pathlib.Path(c.run('php -r "echo PHP_CONFIG_FILE_PATH;"').stdout).parent # /etc/php/8.1
-	php_version = php_config.name
-	c.run(f'systemctl reload php{php_version}-fpm.service')
+	util.batch(c, [
+		'rm -rf %s/public' % remote_path,
+		'ln -sfn %s/releases/1337 %s/public' % (remote_path, remote_path),
+		'rm -rf %s/public/wp-content/uploads && ln -sfn %s/uploads %s/public/wp-content/uploads' % (
+			remote_path, remote_path, remote_path),
+
+		# Reload services
+		'systemctl reload nginx.service',
+		'systemctl reload php$(basename $(dirname $(php -r "echo PHP_CONFIG_FILE_PATH;")))-fpm.service',
+	])
 
 @cli.command()
 @click.option('--yes', '-y', is_flag=True, help='Force yes on the are-you-sure prompt')
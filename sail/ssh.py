@@ -210,10 +210,7 @@ def shell(root):
 	extra_args = '-vtt' if util.debug() else '-tt'
 
 	os.execlp('ssh', 'ssh', extra_args,
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'-o', 'LogLevel=QUIET',
 		'root@%s' % config['hostname'],
 		command
@@ -239,10 +236,7 @@ def run(command, root):
 	extra_args = '-vtt' if util.debug() else '-tt'
 
 	os.execlp('ssh', 'ssh', extra_args,
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+		*util.ssh_args(),
 		'-o', 'LogLevel=QUIET',
 		'root@%s' % config['hostname'],
 		command
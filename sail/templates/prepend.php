@@ -2,6 +2,14 @@
 class Sail_Profiler {
 	private static $filename;
 	private static $key;
+	private static $sample;
+
+	// Hourly rollups keep up to this many URL patterns and functions each.
+	const ROLLUP_PATTERNS = 200;
+	const ROLLUP_FUNCTIONS = 500;
+
+	// Sampling settings, written by sail profile sampling.
+	const SAMPLE_CONFIG = '/etc/sail/profile-sample.php';
 
 	public static function init() {
 		// Load premium modules if any.
@@ -16,6 +24,11 @@ class Sail_Profiler {
 		}
 
 		if ( empty( self::$key ) ) {
+			// Only exists while sampling is enabled, the include is cached by opcache.
+			if ( PHP_SAPI !== 'cli' && is_file( self::SAMPLE_CONFIG ) && function_exists( 'xhprof_enable' ) ) {
+				self::sample( include self::SAMPLE_CONFIG );
+			}
+
 			return;
 		}
 
@@ -48,6 +61,10 @@ class Sail_Profiler {
 
 		self::$filename = tempnam( $target, 'xhprof.' );
 		header( 'X-Sail-Profile: ' . self::$filename );
+
+		if ( ! empty( $_SERVER['HTTP_X_SAIL_PROFILE_HOOKS'] ) ) {
+			Sail_Hook_Timer::init();
+		}
 	}
 
 	public static function shutdown() {
@@ -61,12 +78,391 @@ class Sail_Profiler {
 			'method' => $_SERVER['REQUEST_METHOD'],
 			'host' => $_SERVER['HTTP_HOST'],
 			'request_uri' => str_replace( 'SAIL_PROFILE=' . self::$key, '', $_SERVER['REQUEST_URI'] ),
+			'release' => self::release(),
 		];
 
+		if ( Sail_Hook_Timer::enabled() ) {
+			$data['hooks'] = Sail_Hook_Timer::results();
+		}
+
 		$data = json_encode( $data, JSON_PARTIAL_OUTPUT_ON_ERROR );
 		file_put_contents( self::$filename, $data, LOCK_EX );
 		self::$filename = null;
 	}
+
+	/**
+	 * The deployed release, public is a symlink to releases/<release>.
+	 */
+	public static function release() {
+		$path = empty( $_SERVER['DOCUMENT_ROOT'] ) ? false : realpath( $_SERVER['DOCUMENT_ROOT'] );
+		if ( $path && basename( dirname( $path ) ) === 'releases' ) {
+			return basename( $path );
+		}
+
+		return null;
+	}
+
+	/**
+	 * Profile 1 in rate requests, or every request when a latency threshold
+	 * (ms) is set, keeping only the slow ones. Wall time only, no CPU or
+	 * memory flags, to keep the overhead low.
+	 */
+	public static function sample( $config ) {
+		$rate = empty( $config['rate'] ) ? 0 : max( 1, (int) $config['rate'] );
+		$threshold = empty( $config['threshold'] ) ? 0 : (int) $config['threshold'];
+		$sampled = $rate && mt_rand( 1, $rate ) === 1;
+
+		if ( ! $sampled && ! $threshold ) {
+			return;
+		}
+
+		self::$sample = [
+			'sampled' => $sampled,
+			'rate' => $rate,
+			'threshold' => $threshold,
+			'max_size' => empty( $config['max_size'] ) ? 50 : (int) $config['max_size'],
+		];
+
+		xhprof_enable();
+		register_shutdown_function( [ __CLASS__, 'rollup' ] );
+	}
+
+	/**
+	 * Merge a sampled request into the hourly rollup of its URL pattern.
+	 * Rollups keep per function calls, inclusive and exclusive wall time.
+	 */
+	public static function rollup() {
+		$data = xhprof_disable();
+		$sample = self::$sample;
+		$wt = isset( $data['main()']['wt'] ) ? $data['main()']['wt'] : 0;
+		$slow = $sample['threshold'] && $wt >= $sample['threshold'] * 1000;
+
+		if ( empty( $data ) || ( ! $sample['sampled'] && ! $slow ) ) {
+			return;
+		}
+
+		if ( empty( $_SERVER['DOCUMENT_ROOT'] ) ) {
+			return;
+		}
+
+		// Arguments and recursion depth are dropped, recursive frames are
+		// already part of the inclusive time of the outer frame.
+		$functions = [];
+		foreach ( $data as $edge => $info ) {
+			$edge = explode( '==>', $edge, 2 );
+			$child = preg_replace( '/(#.*|@\d+)$/s', '', end( $edge ) );
+			$recursive = (bool) preg_match( '/^[^#]*@\d+$/', end( $edge ) );
+
+			if ( ! isset( $functions[ $child ] ) ) {
+				$functions[ $child ] = [ 0, 0, 0 ];
+			}
+
+			$functions[ $child ][0] += $info['ct'];
+			$functions[ $child ][1] += $recursive ? 0 : $info['wt'];
+			$functions[ $child ][2] += $info['wt'];
+
+			if ( count( $edge ) > 1 ) {
+				$parent = preg_replace( '/(#.*|@\d+)$/s', '', $edge[0] );
+				if ( ! isset( $functions[ $parent ] ) ) {
+					$functions[ $parent ] = [ 0, 0, 0 ];
+				}
+
+				$functions[ $parent ][2] -= $info['wt'];
+			}
+		}
+
+		$root = dirname( $_SERVER['DOCUMENT_ROOT'] ) . '/profiles/rollups';
+		$dir = $root . '/' . gmdate( 'YmdH' );
+
+		if ( ! is_dir( $dir ) ) {
+			if ( ! @mkdir( $dir, 0755, true ) ) {
+				return;
+			}
+
+			self::prune( $root, $sample['max_size'] * 1024 * 1024 );
+		}
+
+		$pattern = self::pattern();
+		$filename = $dir . '/' . md5( $pattern ) . '.json';
+
+		if ( ! file_exists( $filename ) && count( glob( $dir . '/*.json' ) ) >= self::ROLLUP_PATTERNS ) {
+			$pattern = 'other';
+			$filename = $dir . '/' . md5( $pattern ) . '.json';
+		}
+
+		$f = @fopen( $filename, 'c+' );
+		if ( ! $f ) {
+			return;
+		}
+
+		flock( $f, LOCK_EX );
+
+		$rollup = json_decode( stream_get_contents( $f ), true );
+		if ( empty( $rollup ) ) {
+			$rollup = [
+				'pattern' => $pattern,
+				'rate' => $sample['rate'],
+				'requests' => 0,
+				'sampled' => 0,
+				'slow' => 0,
+				'wt' => 0,
+				'max_wt' => 0,
+				'functions' => [],
+			];
+		}
+
+		$rollup['requests'] += 1;
+		$rollup['sampled'] += $sample['sampled'] ? 1 : 0;
+		$rollup['slow'] += $slow ? 1 : 0;
+		$rollup['wt'] += $wt;
+		$rollup['max_wt'] = max( $rollup['max_wt'], $wt );
+
+		foreach ( $functions as $symbol => $values ) {
+			if ( ! isset( $rollup['functions'][ $symbol ] ) ) {
+				$rollup['functions'][ $symbol ] = [ 0, 0, 0 ];
+			}
+
+			foreach ( $values as $i => $value ) {
+				$rollup['functions'][ $symbol ][ $i ] += $value;
+			}
+		}
+
+		// Keep the most expensive functions by exclusive time.
+		uasort( $rollup['functions'], function( $a, $b ) {
+			return $b[2] - $a[2];
+		} );
+
+		$rollup['functions'] = array_slice( $rollup['functions'], 0, self::ROLLUP_FUNCTIONS, true );
+
+		ftruncate( $f, 0 );
+		rewind( $f );
+		fwrite( $f, json_encode( $rollup, JSON_PARTIAL_OUTPUT_ON_ERROR ) . "\n" );
+		fflush( $f );
+		flock( $f, LOCK_UN );
+		fclose( $f );
+	}
+
+	/**
+	 * Group URLs by method and the first path segments, numeric segments and
+	 * admin-ajax actions are kept apart.
+	 */
+	public static function pattern() {
+		$path = parse_url( $_SERVER['REQUEST_URI'], PHP_URL_PATH );
+		$segments = array_values( array_filter( explode( '/', (string) $path ), 'strlen' ) );
+		$keep = isset( $segments[0] ) && $segments[0] === 'wp-json' ? 3 : 1;
+
+		foreach ( $segments as $i => $segment ) {
+			if ( ctype_digit( $segment ) ) {
+				$segments[ $i ] = ':id';
+			}
+		}
+
+		$pattern = '/' . implode( '/', array_slice( $segments, 0, $keep ) );
+		if ( count( $segments ) > $keep ) {
+			$pattern .= '/*';
+		}
+
+		if ( $path === '/wp-admin/admin-ajax.php' && ! empty( $_REQUEST['action'] ) ) {
+			$pattern .= '?action=' . substr( preg_replace( '/[^\w-]/', '', $_REQUEST['action'] ), 0, 64 );
+		}
+
+		return $_SERVER['REQUEST_METHOD'] . ' ' . $pattern;
+	}
+
+	/**
+	 * Remove hourly rollups older than two days, then the oldest ones until
+	 * the rest fit in max_size bytes.
+	 */
+	public static function prune( $root, $max_size ) {
+		$dirs = glob( $root . '/[0-9]*', GLOB_ONLYDIR );
+		sort( $dirs );
+
+		$sizes = [];
+		$cutoff = gmdate( 'YmdH', time() - 2 * 86400 );
+
+		foreach ( $dirs as $dir ) {
+			$size = 0;
+			foreach ( glob( $dir . '/*.json' ) as $filename ) {
+				$size += filesize( $filename );
+			}
+
+			$sizes[ $dir ] = $size;
+		}
+
+		foreach ( $sizes as $dir => $size ) {
+			if ( count( $sizes ) < 2 || ( basename( $dir ) >= $cutoff && array_sum( $sizes ) <= $max_size ) ) {
+				break;
+			}
+
+			array_map( 'unlink', glob( $dir . '/*.json' ) );
+			@rmdir( $dir );
+			unset( $sizes[ $dir ] );
+		}
+	}
+}
+
+/**
+ * Times every WordPress hook callback and attributes it to the plugin, theme
+ * or core file it is defined in. Callbacks are wrapped the first time their
+ * hook fires, array keys are kept so remove_action() still works.
+ */
+class Sail_Hook_Timer {
+	private static $enabled = false;
+	private static $callbacks = [];
+	private static $stack = [];
+
+	public static function init() {
+		self::$enabled = true;
+
+		// Runs before the callbacks of every hook.
+		$GLOBALS['wp_filter']['all'][ PHP_INT_MIN ]['sail-hook-timer'] = [
+			'function' => [ __CLASS__, 'wrap' ],
+			'accepted_args' => 1,
+		];
+	}
+
+	public static function enabled() {
+		return self::$enabled;
+	}
+
+	public static function wrap( $hook ) {
+		global $wp_filter;
+
+		if ( $hook === 'all' || ! isset( $wp_filter[ $hook ] ) || ! $wp_filter[ $hook ] instanceof WP_Hook ) {
+			return;
+		}
+
+		foreach ( $wp_filter[ $hook ]->callbacks as $priority => $callbacks ) {
+			foreach ( $callbacks as $key => $callback ) {
+				if ( $callback['function'] instanceof Sail_Hook_Timer_Callback ) {
+					continue;
+				}
+
+				$id = $hook . '|' . $key;
+				if ( ! isset( self::$callbacks[ $id ] ) ) {
+					list( $component, $name ) = self::describe( $callback['function'] );
+					self::$callbacks[ $id ] = [ $hook, $component, $name, 0, 0, 0 ];
+				}
+
+				$wp_filter[ $hook ]->callbacks[ $priority ][ $key ]['function'] = new Sail_Hook_Timer_Callback( $callback['function'], $id );
+			}
+		}
+	}
+
+	public static function start() {
+		self::$stack[] = 0;
+		return hrtime( true );
+	}
+
+	/**
+	 * Exclusive time leaves out the callbacks of hooks fired from within.
+	 */
+	public static function stop( $id, $start ) {
+		$elapsed = hrtime( true ) - $start;
+		$nested = array_pop( self::$stack );
+
+		self::$callbacks[ $id ][3] += 1;
+		self::$callbacks[ $id ][4] += $elapsed;
+		self::$callbacks[ $id ][5] += $elapsed - $nested;
+
+		if ( self::$stack ) {
+			self::$stack[ count( self::$stack ) - 1 ] += $elapsed;
+		}
+	}
+
+	/**
+	 * Component (plugin:name, mu-plugin:name, theme:name, core, other or php)
+	 * and a readable name of a callback.
+	 */
+	public static function describe( $callback ) {
+		try {
+			if ( is_string( $callback ) && strpos( $callback, '::' ) ) {
+				$callback = explode( '::', $callback, 2 );
+			}
+
+			if ( is_array( $callback ) ) {
+				$class = is_object( $callback[0] ) ? get_class( $callback[0] ) : $callback[0];
+				$name = $class . '::' . $callback[1];
+				$reflection = new ReflectionMethod( $callback[0], $callback[1] );
+			} elseif ( is_object( $callback ) && ! $callback instanceof Closure ) {
+				$name = get_class( $callback ) . '::__invoke';
+				$reflection = new ReflectionMethod( $callback, '__invoke' );
+			} else {
+				$reflection = new ReflectionFunction( $callback );
+				$name = $reflection->getName();
+			}
+		} catch ( Throwable $e ) {
+			return [ 'other', is_string( $callback ) ? $callback : '{unknown}' ];
+		}
+
+		$filename = $reflection->getFileName();
+		if ( ! $filename ) {
+			return [ 'php', $name ];
+		}
+
+		if ( $reflection instanceof ReflectionFunction && $reflection->isClosure() ) {
+			$name = '{closure} ' . basename( $filename ) . ':' . $reflection->getStartLine();
+		}
+
+		if ( preg_match( '#/wp-content/(plugins|mu-plugins|themes)/([^/]+)#', $filename, $matches ) ) {
+			$types = [ 'plugins' => 'plugin', 'mu-plugins' => 'mu-plugin', 'themes' => 'theme' ];
+			return [ $types[ $matches[1] ] . ':' . preg_replace( '/\.php$/', '', $matches[2] ), $name ];
+		}
+
+		if ( preg_match( '#/(wp-includes|wp-admin)/#', $filename ) ) {
+			return [ 'core', $name ];
+		}
+
+		return [ 'other', $name ];
+	}
+
+	/**
+	 * Callbacks which ran, with times in microseconds like xhprof.
+	 */
+	public static function results() {
+		$results = [];
+		foreach ( self::$callbacks as $callback ) {
+			if ( ! $callback[3] ) {
+				continue;
+			}
+
+			$results[] = [
+				'hook' => $callback[0],
+				'component' => $callback[1],
+				'callback' => $callback[2],
+				'ct' => $callback[3],
+				'wt' => (int) ( $callback[4] / 1000 ),
+				'excl_wt' => (int) ( $callback[5] / 1000 ),
+			];
+		}
+
+		return $results;
+	}
+}
+
+/**
+ * A timed hook callback. Arguments are taken by reference, so references
+ * from do_action_ref_array() and apply_filters_ref_array() reach callbacks
+ * that take them by reference.
+ */
+class Sail_Hook_Timer_Callback {
+	public $callback;
+	public $id;
+
+	public function __construct( $callback, $id ) {
+		$this->callback = $callback;
+		$this->id = $id;
+	}
+
+	public function __invoke( &...$args ) {
+		$start = Sail_Hook_Timer::start();
+
+		try {
+			return call_user_func_array( $this->callback, $args );
+		} finally {
+			Sail_Hook_Timer::stop( $this->id, $start );
+		}
+	}
 }
 
 class Sail_Remote_Login {
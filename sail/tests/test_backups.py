@@ -0,0 +1,183 @@
+from sail import backups, cli, util
+
+import io, json, os, pathlib, subprocess
+import tarfile, tempfile
+import unittest
+from unittest import mock
+from click.testing import CliRunner
+
+def _dump(rows):
+	return b''.join(b"INSERT INTO `wp_postmeta` VALUES (%d,'%s');\n" % (i, value) for i, value in rows)
+
+class TestChunks(unittest.TestCase):
+	def setUp(self):
+		self.rows = [(i, os.urandom(40).hex().encode()) for i in range(40000)]
+
+	def test_roundtrip(self):
+		data = _dump(self.rows)
+		chunks = list(backups._chunks(io.BytesIO(data)))
+		self.assertEqual(b''.join(chunks), data)
+		self.assertGreater(len(chunks), 1)
+
+		for chunk in chunks[:-1]:
+			self.assertGreaterEqual(len(chunk), backups.CHUNK_MIN)
+			self.assertLessEqual(len(chunk), backups.CHUNK_MAX)
+
+	def test_insert_dedupe(self):
+		before = list(backups._chunks(io.BytesIO(_dump(self.rows))))
+		self.rows.insert(20000, (999999, b'new'))
+		after = list(backups._chunks(io.BytesIO(_dump(self.rows))))
+
+		# Only the chunk around the new row changes.
+		self.assertLessEqual(len(set(after) - set(before)), 2)
+
+class TestInsertBatcher(unittest.TestCase):
+	def test_batching(self):
+		data = (b"-- Dump\nINSERT INTO `a` VALUES (1,'x');\nINSERT INTO `a` VALUES (2,'y');\n"
+			+ b"INSERT INTO `b` VALUES (1);\nUNLOCK TABLES;\n")
+
+		out = io.BytesIO()
+		batcher = backups._InsertBatcher(out)
+
+		# Feed in odd sizes to split lines across writes.
+		for i in range(0, len(data), 7):
+			batcher.write(data[i:i+7])
+
+		batcher.close()
+
+		self.assertEqual(out.getvalue(), b"-- Dump\nINSERT INTO `a` VALUES (1,'x'),(2,'y');\n"
+			+ b"INSERT INTO `b` VALUES (1);\nUNLOCK TABLES;\n")
+
+class TestArchive(unittest.TestCase):
+	def test_seekable(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			temp_dir = pathlib.Path(temp_dir)
+			snapshot = temp_dir / 'snapshot'
+			(snapshot / 'www/wp-content/plugins/foo').mkdir(parents=True)
+			(snapshot / 'uploads').mkdir()
+			(snapshot / 'www/index.php').write_bytes(b'<?php')
+			(snapshot / 'www/wp-content/plugins/foo/foo.php').write_bytes(os.urandom(1024 * 1024))
+
+			database_file = temp_dir / 'database.sql'
+			database_file.write_bytes(b"-- Dump\n--\n-- Table structure for table `a`\n--\nCREATE TABLE `a`;\n"
+				+ b"--\n-- Table structure for table `b`\n--\nCREATE TABLE `b`;\n/*!40101 SET x */;\n")
+
+			target = temp_dir / 'backup.tar.gz'
+			backups._archive(snapshot, target, 'gzip', database_file=database_file)
+
+			# Still a regular tarball.
+			with tarfile.open(target) as tar:
+				self.assertIn('www/wp-content/plugins/foo/foo.php', tar.getnames())
+
+			index = backups._load_archive_index(target)
+			destination = temp_dir / 'restore'
+			backups._extract_members(target, index, ['www/wp-content/plugins/foo'], destination)
+			self.assertEqual((destination / 'www/wp-content/plugins/foo/foo.php').read_bytes(),
+				(snapshot / 'www/wp-content/plugins/foo/foo.php').read_bytes())
+			self.assertFalse((destination / 'www/index.php').exists())
+
+			member = [m for m in index['members'] if m['name'] == 'database.sql'][0]
+			reader = backups._ArchiveReader(target, index)
+			backups._write_tables(lambda start, length, f: reader.read(member['data'] + start, length, f),
+				index['tables'], ['b'], temp_dir / 'b.sql')
+			reader.close()
+
+			self.assertEqual((temp_dir / 'b.sql').read_bytes(), b"-- Dump\n--\n-- Table structure for table `b`\n"
+				+ b"--\nCREATE TABLE `b`;\n/*!40101 SET x */;\n")
+
+	def test_restore_table_without_index(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			temp_dir = pathlib.Path(temp_dir)
+			snapshot = temp_dir / 'snapshot'
+			(snapshot / 'www').mkdir(parents=True)
+			(snapshot / 'uploads').mkdir()
+
+			database_file = temp_dir / 'database.sql'
+			database_file.write_bytes(b"-- Dump\n--\n-- Table structure for table `a`\n--\nCREATE TABLE `a`;\n"
+				+ b"--\n-- Table structure for table `b`\n--\nCREATE TABLE `b`;\n/*!40101 SET x */;\n")
+
+			target = temp_dir / 'backup.tar.gz'
+			backups._archive(snapshot, target, 'gzip', database_file=database_file)
+			backups._index_path(target).unlink()
+
+			uploaded = []
+			def rsync(args, source, destination, **kwargs):
+				compression = util.detect_compression(source)
+				self.assertIsNotNone(compression)
+				uploaded.append(subprocess.run(util.decompress_command(compression).split(),
+					input=pathlib.Path(source).read_bytes(), stdout=subprocess.PIPE).stdout)
+				return 0, '', ''
+
+			with mock.patch.object(util, 'find_root', return_value=str(temp_dir)), \
+				mock.patch.object(util, 'config', return_value={'hostname': 'example.org', 'namespace': 'test'}), \
+				mock.patch.object(util, 'remote_path', return_value='/var/www'), \
+				mock.patch.object(util, 'rsync', side_effect=rsync):
+				backups._restore_partial(mock.Mock(), target, [], ['b'], 1)
+
+			self.assertFalse((temp_dir / '.backups' / 'repository').exists())
+
+			self.assertEqual(uploaded, [b"-- Dump\n--\n-- Table structure for table `b`\n"
+				+ b"--\nCREATE TABLE `b`;\n/*!40101 SET x */;\n"])
+
+class TestPrune(unittest.TestCase):
+	def test_orphans(self):
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			os.makedirs('.sail')
+			snapshot = pathlib.Path('.backups/snapshots/2024-01-01-000000')
+			snapshot.mkdir(parents=True)
+
+			kept, unreferenced, orphan = 'aa' + '1' * 62, 'bb' + '2' * 62, 'cc' + '3' * 62
+			with open(snapshot / 'database.sql.manifest.json', 'w') as f:
+				json.dump({'chunks': [kept]}, f)
+
+			# An indexed chunk no snapshot uses, an unindexed chunk and a .tmp
+			# file left by interrupted runs.
+			chunks = pathlib.Path('.backups/repository/chunks')
+			for h in [kept, unreferenced, orphan, kept + '.tmp']:
+				(chunks / h[:2]).mkdir(parents=True, exist_ok=True)
+				(chunks / h[:2] / h).write_bytes(b'x' * 10)
+
+			with open('.backups/repository/index.json', 'w') as f:
+				json.dump({kept: [10, 10], unreferenced: [10, 10]}, f)
+
+			result = runner.invoke(cli, ['backup', 'prune', '--keep', '1', '--dry-run'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertIn('Removing 3 unreferenced chunks', result.output)
+			self.assertEqual(len(list(chunks.glob('*/*'))), 4)
+
+			result = runner.invoke(cli, ['backup', 'check', '--quick'])
+			self.assertIn('Found 3 unreferenced chunk files', result.output)
+
+			result = runner.invoke(cli, ['backup', 'prune', '--keep', '1'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual([path.name for path in chunks.glob('*/*')], [kept])
+
+			with open('.backups/repository/index.json') as f:
+				self.assertEqual(json.load(f), {kept: [10, 10]})
+
+class TestPremium(unittest.TestCase):
+	def test_local_commands(self):
+		# The premium backup group replaces the local one when imported.
+		with mock.patch.dict(cli.commands):
+			from sail.premium import backups as premium_backups
+			self.assertIs(cli.commands['backup'], premium_backups.backup)
+
+			runner = CliRunner()
+			result = runner.invoke(cli, ['backup', '--help'])
+			for command in ['snapshot-export', 'ls', 'prune', 'check']:
+				self.assertIn(command, result.output)
+
+			with runner.isolated_filesystem():
+				os.makedirs('.sail')
+				with open('.sail/config.json', 'w') as f:
+					json.dump({'hostname': 'example.org', 'ip': '192.0.2.1'}, f)
+
+				result = runner.invoke(cli, ['backup', 'snapshot-export'])
+				self.assertIn('No backup snapshots found', result.output)
+
+				# Archive paths fall through to the local restore.
+				with mock.patch.object(backups, 'restore') as restore:
+					result = runner.invoke(cli, ['backup', 'restore', 'backup.tar.gz', '--yes'])
+					self.assertEqual(result.exit_code, 0, result.output)
+					restore.assert_called_once_with(path='backup.tar.gz', yes=True, skip_db=False, skip_uploads=False)
@@ -0,0 +1,99 @@
+from sail import cli, deploy, profiling, util, xhprof
+
+import io, json, os, time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from click.testing import CliRunner
+
+from sail.tests.test_xhprof import _profile
+
+def _load(wt=1000, queries=0):
+	edges = {'main()': {'ct': 1, 'wt': wt}}
+	for n in range(queries):
+		edges['main()==>mysqli_query#SELECT %d' % n] = {'ct': 1, 'wt': 1}
+
+	return xhprof.load(io.StringIO(_profile(edges)))
+
+class _Connection:
+	'''Records remote commands, the live release is 1000'''
+	def __init__(self):
+		self.commands = []
+
+	def run(self, command, **kwargs):
+		self.commands.append(command)
+		stdout = {'readlink': '/var/www/releases/1000\n', 'ls': '1000\n2000\n'}.get(command.split()[0], '')
+		return SimpleNamespace(stdout=stdout, stderr='', exited=0, ok=True)
+
+class TestPerfGate(unittest.TestCase):
+	def test_gate(self):
+		baseline = {'/': _load(1000), '/shop/': _load(1000), '/cart/': _load(1000, 10)}
+		profiles = {'/': _load(1150), '/shop/': _load(1300), '/cart/': _load(1000, 14)}
+
+		results = deploy._perf_gate(baseline, profiles, 20)
+		self.assertEqual([(r['url'], r['failed']) for r in results], [('/', False), ('/shop/', True), ('/cart/', True)])
+		self.assertAlmostEqual(results[1]['change'], 30.0)
+
+		# Medians are compared for aggregated runs, a single slow run passes.
+		runs = [_load(wt) for wt in [1000, 1050, 5000]]
+		results = deploy._perf_gate({'/': _load(1000)}, {'/': xhprof.aggregate(runs)}, 20)
+		self.assertFalse(results[0]['failed'])
+
+	def deploy(self, measure):
+		'''Run sail deploy --perf-gate, returns the result, remote and batched commands'''
+		runner = CliRunner()
+		c = _Connection()
+		batches = []
+
+		def batch(c, commands, **kwargs):
+			batches.append(commands)
+			return [{'stdout': '1000\n2000\n', 'exited': 0} for command in commands]
+
+		with runner.isolated_filesystem():
+			os.makedirs('.sail')
+			with open('.sail/config.json', 'w') as f:
+				json.dump({'hostname': 'example.org', 'ip': '192.0.2.1', 'profile_key': 'key'}, f)
+			with open('urls.txt', 'w') as f:
+				f.write('https://example.org/\n')
+
+			with mock.patch.object(util, 'connection', return_value=c), \
+				mock.patch.object(util, 'batch', side_effect=batch), \
+				mock.patch.object(util, 'rsync', return_value=(0, '', '')), \
+				mock.patch.object(profiling, '_measure', side_effect=measure), \
+				mock.patch.object(profiling, '_warm'), \
+				mock.patch.object(time, 'time', return_value=2000):
+				result = runner.invoke(cli, ['deploy', '--skip-hooks', '--perf-gate', 'urls.txt'])
+
+			gate_dir = os.path.exists('.profiles/perf-gate-2000')
+
+		return result, c.commands, [command for commands in batches for command in commands], gate_dir
+
+	def test_rollback(self):
+		profiles = iter([{'https://example.org/': _load(1000)}, {'https://example.org/': _load(2000)}])
+		result, commands, batched, gate_dir = self.deploy(lambda *args: next(profiles))
+
+		self.assertNotEqual(result.exit_code, 0)
+		self.assertIn('failed the performance gate and was rolled back to 1000', result.output)
+		self.assertIn('ln -sfn /var/www/releases/1000 /var/www/public', batched)
+		self.assertIn('rm -rf /var/www/releases/2000', commands)
+		self.assertTrue(gate_dir)
+
+	def test_pass(self):
+		result, commands, batched, gate_dir = self.deploy(lambda *args: {'https://example.org/': _load(1000)})
+
+		self.assertEqual(result.exit_code, 0, result.output)
+		self.assertNotIn('ln -sfn /var/www/releases/1000 /var/www/public', batched)
+		self.assertNotIn('rm -rf /var/www/releases/2000', commands)
+
+	def test_baseline_failure(self):
+		def measure(*args):
+			raise util.SailException('Could not make profiling request.')
+
+		result, commands, batched, gate_dir = self.deploy(measure)
+
+		# The new release never went live and is removed.
+		self.assertNotEqual(result.exit_code, 0)
+		self.assertIn('Could not make profiling request.', result.output)
+		self.assertFalse(any('/var/www/public' in command and 'ln' in command for command in batched))
+		self.assertIn('rm -rf /var/www/releases/2000', commands)
+		self.assertFalse(gate_dir)
@@ -0,0 +1,60 @@
+from sail import cli, history, xhprof
+
+import io, json, os, time
+import unittest
+from click.testing import CliRunner
+
+from sail.tests.test_xhprof import _profile
+
+class TestHistory(unittest.TestCase):
+	def test_trend(self):
+		db = history.connect(':memory:')
+
+		for n, wt in enumerate([300, 250, 400]):
+			edges = {
+				'main()': {'ct': 1, 'wt': 1000, 'mu': 4000, 'pmu': 5000},
+				'main()==>curl_exec': {'ct': 1, 'wt': wt, 'mu': 300, 'pmu': 0},
+			}
+			profile = xhprof.load(io.StringIO(_profile(edges, timestamp=1700000000 + n, release=str(n))))
+			history.ingest(db, '%d.xhprof.json' % n, 'example.org/shop', profile)
+
+		# Ingesting a profile again replaces it.
+		history.ingest(db, '2.xhprof.json', 'example.org/shop', profile)
+		self.assertTrue(history.has(db, '2.xhprof.json'))
+
+		rows = history.trend(db, 'example.org/shop', 'curl_exec')
+		self.assertEqual([(row['release'], row['wt']) for row in rows], [('0', 300), ('1', 250), ('2', 400)])
+
+		rows = history.trend(db, 'example.org/shop', since=1700000001)
+		self.assertEqual([row['pmu'] for row in rows], [5000, 5000])
+
+		self.assertEqual(history.trend(db, 'example.org/shop', 'nothing')[0]['wt'], None)
+		self.assertEqual([tuple(row) for row in history.urls(db)], [('example.org/shop', 3)])
+
+class TestIndex(unittest.TestCase):
+	def test_skips_invalid(self):
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			os.makedirs('.sail')
+			os.makedirs('.profiles')
+
+			now = int(time.time())
+			for n, wt in enumerate([300, 400]):
+				with open('.profiles/%d.xhprof.json' % n, 'w') as f:
+					f.write(_profile({'main()': {'ct': 1, 'wt': wt}}, timestamp=now - 60 + n, request_uri='/shop/'))
+
+			# No request metadata, and not JSON at all.
+			with open('.profiles/2.xhprof.json', 'w') as f:
+				f.write(json.dumps({'xhprof': {'main()': {'ct': 1, 'wt': 100}}}))
+			with open('.profiles/3.xhprof.json', 'w') as f:
+				f.write('<html>')
+
+			result = runner.invoke(cli, ['profile', 'index'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertIn('Added 2 profiles', result.output)
+			self.assertIn('Skipped invalid profile: 2.xhprof.json', result.output)
+			self.assertIn('Skipped invalid profile: 3.xhprof.json', result.output)
+
+			result = runner.invoke(cli, ['profile', 'trend', 'example.org/shop/', '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual([row['wt'] for row in json.loads(result.output)], [300, 400])
@@ -0,0 +1,324 @@
+from sail import cli, profiling, util, xhprof
+
+import io, json, os, pathlib, tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from click.testing import CliRunner
+
+from sail.tests.test_xhprof import _profile, EDGES
+
+def _edge(ct, wt):
+	return {'ct': ct, 'wt': wt, 'cpu': wt, 'mu': 100, 'pmu': 0}
+
+def _project():
+	'''A minimal project in the current directory, for commands which need one'''
+	os.makedirs('.sail')
+	with open('.sail/config.json', 'w') as f:
+		json.dump({'hostname': 'example.org', 'ip': '192.0.2.1', 'profile_key': 'key'}, f)
+
+def _invoke(args):
+	result = CliRunner().invoke(cli, ['profile'] + args)
+	return result, json.loads(result.output) if result.exit_code == 0 and '--json' in args else None
+
+class _Connection:
+	'''Records remote commands and uploads, answers cat with stdout'''
+	def __init__(self, stdout=''):
+		self.stdout = stdout
+		self.commands = []
+		self.uploads = {}
+
+	def run(self, command, **kwargs):
+		self.commands.append(command)
+		return SimpleNamespace(stdout=self.stdout if command.startswith('cat ') else '', stderr='', exited=0, ok=True)
+
+	def put(self, f, remote):
+		self.uploads[remote] = f.getvalue() if hasattr(f, 'getvalue') else f
+
+class TestReport(unittest.TestCase):
+	def test_json(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = pathlib.Path(temp_dir) / 'test.xhprof.json'
+			path.write_text(_profile(EDGES, request_uri='/?SAIL_NO_CACHE=123'))
+
+			result = CliRunner().invoke(cli, ['profile', 'report', str(path), '--top', '2', '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+
+			data = json.loads(result.output)
+			self.assertEqual(data['url'], 'example.org')
+			self.assertEqual(data['totals']['queries'], 4)
+			self.assertEqual([f['symbol'] for f in data['functions']], ['mysqli_query#SELECT 1', 'curl_exec'])
+			self.assertEqual(data['critical_path'][1]['symbol'], 'do_action')
+
+class TestSearch(unittest.TestCase):
+	def test_top_row(self):
+		profile = xhprof.load(io.StringIO(_profile(EDGES)))
+		positions = profile.rank('wt')
+
+		# main() is the first row and the only match.
+		matches = profile.search('main')
+		self.assertEqual(profiling._next_match(positions, matches, -1), 0)
+		self.assertIsNone(profiling._next_match(positions, matches, 0))
+
+class TestCriticalPath(unittest.TestCase):
+	def test_json(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = pathlib.Path(temp_dir) / 'test.xhprof.json'
+			path.write_text(_profile(EDGES))
+
+			args = ['profile', 'critical-path', str(path), '--metric', 'cpu', '--from', 'do_action', '--json']
+			result = CliRunner().invoke(cli, args)
+			self.assertEqual(result.exit_code, 0, result.output)
+
+			data = json.loads(result.output)
+			self.assertEqual([step['symbol'] for step in data], ['do_action', 'mysqli_query#SELECT 1'])
+			self.assertEqual(data[1]['cpu'], 100)
+
+			result = CliRunner().invoke(cli, ['profile', 'critical-path', str(path), '--from', 'nothing'])
+			self.assertNotEqual(result.exit_code, 0)
+
+	def test_no_metrics(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = pathlib.Path(temp_dir) / 'test.xhprof.json'
+			path.write_text(_profile({'main()': {'ct': 1}, 'main()==>do_action': {'ct': 2}}))
+
+			result = CliRunner().invoke(cli, ['profile', 'critical-path', str(path)])
+			self.assertNotEqual(result.exit_code, 0)
+			self.assertIn('This profile does not have wt data', result.output)
+
+			result = CliRunner().invoke(cli, ['profile', 'report', str(path), '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual(json.loads(result.output)['critical_path'], [])
+
+class TestExport(unittest.TestCase):
+	def test_collapsed(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = pathlib.Path(temp_dir) / 'test.xhprof.json'
+			path.write_text(_profile(EDGES))
+
+			result = CliRunner().invoke(cli, ['profile', 'export', str(path), '--format', 'collapsed', '-o', '-'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertIn('main();do_action;curl_exec 250\n', result.output)
+
+			result = CliRunner().invoke(cli, ['profile', 'export', str(path)])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertTrue((pathlib.Path(temp_dir) / 'test.xhprof.svg').exists())
+
+class TestTop(unittest.TestCase):
+	def test_top(self):
+		rollups = [
+			{'pattern': 'GET /shop/*', 'rate': 100, 'requests': 3, 'sampled': 1, 'slow': 2, 'wt': 9000, 'max_wt': 5000,
+				'functions': {'main()': [3, 9000, 1000], 'WC_Cart::calculate_totals': [6, 6000, 6000], 'mysqli_query': [30, 2000, 2000]}},
+			{'pattern': 'GET /', 'rate': 100, 'requests': 1, 'sampled': 1, 'slow': 0, 'wt': 1000, 'max_wt': 1000,
+				'functions': {'main()': [1, 1000, 600], 'mysqli_query': [10, 400, 400]}},
+			{'pattern': 'GET /', 'rate': 100, 'requests': 1, 'sampled': 1, 'slow': 0, 'wt': 2000, 'max_wt': 2000,
+				'functions': []},
+		]
+
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			_project()
+			c = _Connection(''.join(json.dumps(rollup) + '\n' for rollup in rollups) + 'cat: No such file\n')
+
+			with mock.patch.object(util, 'connection', return_value=c):
+				result, data = _invoke(['top', '--hours', '2', '--top', '2', '--json'])
+
+		self.assertEqual(result.exit_code, 0, result.output)
+		self.assertEqual(len(c.commands[0].split()), 5)
+		self.assertEqual((data['requests'], data['slow']), (5, 2))
+		self.assertEqual([(p['pattern'], p['requests'], p['mean_wt'], p['max_wt']) for p in data['patterns']],
+			[('GET /shop/*', 3, 3000, 5000), ('GET /', 2, 1500, 2000)])
+		self.assertEqual(data['functions'], [
+			{'symbol': 'WC_Cart::calculate_totals', 'ct': 1, 'wt': 1200, 'excl_wt': 1200, 'percent': 50.0},
+			{'symbol': 'mysqli_query', 'ct': 8, 'wt': 480, 'excl_wt': 480, 'percent': 20.0},
+		])
+
+class TestBatch(unittest.TestCase):
+	def test_urls(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			urls = pathlib.Path(temp_dir) / 'urls.txt'
+			urls.write_text('# Landing pages\nhttps://example.org/\n\nhttps://example.org/shop/\nhttps://example.org/\n')
+			self.assertEqual(profiling._batch_urls(str(urls)), ['https://example.org/', 'https://example.org/shop/'])
+
+			sitemap = pathlib.Path(temp_dir) / 'sitemap-posts.xml'
+			sitemap.write_text('<?xml version="1.0" encoding="UTF-8"?>\n'
+				'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+				'<url><loc>https://example.org/hello-world/</loc></url>'
+				'<url><loc> https://example.org/about/ </loc><lastmod>2024-01-01</lastmod></url>'
+				'</urlset>')
+
+			index = pathlib.Path(temp_dir) / 'sitemap.xml'
+			index.write_text('<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+				'<sitemap><loc>%s</loc></sitemap></sitemapindex>' % sitemap)
+
+			self.assertEqual(profiling._batch_urls(str(index)),
+				['https://example.org/hello-world/', 'https://example.org/about/'])
+
+class TestDiff(unittest.TestCase):
+	def test_json(self):
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			with open('base.xhprof.json', 'w') as f:
+				f.write(_profile({'main()': _edge(1, 1000), 'main()==>curl_exec': _edge(1, 200)}))
+			with open('new.xhprof.json', 'w') as f:
+				f.write(_profile({'main()': _edge(1, 1300), 'main()==>curl_exec': _edge(1, 500),
+					'main()==>sleep': _edge(1, 10)}))
+
+			result, data = _invoke(['diff', 'base.xhprof.json', 'new.xhprof.json', '--sort', 'wt', '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual(data['totals']['wt'], {'base': 1000, 'new': 1300, 'delta': 300})
+			self.assertEqual([(f['symbol'], f['status']) for f in data['functions']],
+				[('main()', None), ('curl_exec', None), ('sleep', 'added')])
+
+class TestQueries(unittest.TestCase):
+	def test_json(self):
+		edges = {'main()': _edge(1, 1000), 'main()==>WC_Product::get_meta': _edge(12, 600)}
+		for n in range(12):
+			edges['WC_Product::get_meta==>mysqli_query#SELECT * FROM wp_postmeta WHERE post_id = %d' % n] = _edge(1, 40)
+
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			with open('test.xhprof.json', 'w') as f:
+				f.write(_profile(edges))
+
+			result, data = _invoke(['queries', 'test.xhprof.json', '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual([(q['fingerprint'], q['ct'], q['wt'], q['n_plus_one']) for q in data],
+				[('SELECT * FROM wp_postmeta WHERE post_id = ?', 12, 480, True)])
+			self.assertEqual(data[0]['callers'], ['WC_Product::get_meta'])
+
+			result, data = _invoke(['queries', 'test.xhprof.json'])
+			self.assertIn('[N+1] SELECT * FROM wp_postmeta', result.output)
+
+class TestHTTP(unittest.TestCase):
+	def test_json(self):
+		edges = {
+			'main()': _edge(1, 1000),
+			'main()==>Acme::check': _edge(1, 700),
+			'Acme::check==>wp_remote_get': _edge(1, 690),
+			'wp_remote_get==>curl_exec#https://api.acme.com/v1/check?key=1': _edge(1, 650),
+		}
+
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			with open('test.xhprof.json', 'w') as f:
+				f.write(_profile(edges))
+
+			result, data = _invoke(['http', 'test.xhprof.json', '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual([(c['host'], c['path'], c['wt'], c['percent']) for c in data],
+				[('api.acme.com', '/v1/check', 650, 65.0)])
+			self.assertEqual(data[0]['triggers'], ['Acme::check'])
+
+class TestPlugins(unittest.TestCase):
+	def test_json(self):
+		hooks = [
+			{'hook': 'init', 'component': 'plugin:acme', 'callback': 'Acme::init', 'ct': 1, 'wt': 400, 'excl_wt': 300},
+			{'hook': 'wp_head', 'component': 'plugin:acme', 'callback': 'Acme::head', 'ct': 1, 'wt': 100, 'excl_wt': 100},
+			{'hook': 'init', 'component': 'core', 'callback': 'create_initial_post_types', 'ct': 1, 'wt': 50, 'excl_wt': 50},
+		]
+
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			with open('hooks.xhprof.json', 'w') as f:
+				f.write(_profile({'main()': _edge(1, 1000)}, hooks=hooks))
+			with open('plain.xhprof.json', 'w') as f:
+				f.write(_profile({'main()': _edge(1, 1000)}))
+
+			result, data = _invoke(['plugins', 'hooks.xhprof.json', '--json'])
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual([(p['component'], p['wt'], p['percent'], p['hooks']) for p in data['plugins']],
+				[('plugin:acme', 400, 40.0, ['init', 'wp_head']), ('core', 50, 5.0, ['init'])])
+			self.assertEqual([(h['hook'], h['wt']) for h in data['hooks']], [('init', 350), ('wp_head', 100)])
+			self.assertEqual(data['hooks'][0]['callbacks'][0], {'component': 'plugin:acme', 'callback': 'Acme::init', 'wt': 300})
+
+			result, data = _invoke(['plugins', 'plain.xhprof.json'])
+			self.assertNotEqual(result.exit_code, 0)
+			self.assertIn('sail profile run --hooks', result.output)
+
+def _fake_fetch(wts):
+	'''A _fetch which writes profiles with these wall times instead of downloading'''
+	def fetch(filenames, directory, names):
+		paths = []
+		for filename, name in zip(filenames, names):
+			path = directory / name
+			path.write_text(_profile({'main()': _edge(1, wts[filename])}, request_uri='/'))
+			paths.append(path)
+		return paths
+	return fetch
+
+class TestRun(unittest.TestCase):
+	def test_repeat_hooks(self):
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			_project()
+			filenames = iter(['/var/www/profiles/xhprof.1', '/var/www/profiles/xhprof.2'])
+			request = mock.Mock(side_effect=lambda *args, **kwargs: next(filenames))
+			fetch = _fake_fetch({'/var/www/profiles/xhprof.1': 1000, '/var/www/profiles/xhprof.2': 3000})
+
+			with mock.patch.object(profiling, '_request', request), \
+				mock.patch.object(profiling, '_fetch', side_effect=fetch), \
+				mock.patch.object(profiling, 'open') as browser:
+				result = runner.invoke(cli, ['profile', 'run', 'https://example.org/', '--repeat', '2', '--hooks'])
+
+			self.assertEqual(result.exit_code, 0, result.output)
+			self.assertEqual([call.kwargs['hooks'] for call in request.call_args_list], [True, True])
+
+			# The browser opens the aggregate of both runs.
+			path = browser.call_args.kwargs['path']
+			self.assertTrue(path.name.endswith('.aggregate.xhprof.json'))
+			self.assertEqual(profiling._load(path).totals['wt'], 2000)
+
+class TestBatchCommand(unittest.TestCase):
+	def test_json(self):
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			_project()
+			with open('urls.txt', 'w') as f:
+				f.write('https://example.org/\nhttps://example.org/shop/\nhttps://example.org/broken/\n')
+
+			def request(session, config, url, quiet=False):
+				if url.path == '/broken/':
+					raise util.SailException('X-Sail-Profile header not found in response.')
+				return '/var/www/profiles/xhprof.' + url.path.strip('/')
+
+			fetch = _fake_fetch({'/var/www/profiles/xhprof.': 1000, '/var/www/profiles/xhprof.shop': 2500})
+			with mock.patch.object(profiling, '_request', side_effect=request), \
+				mock.patch.object(profiling, '_fetch', side_effect=fetch):
+				result = runner.invoke(cli, ['profile', 'batch', 'urls.txt', '--concurrency', '2', '--json'])
+
+			self.assertEqual(result.exit_code, 0, result.output)
+			data = json.loads(result.output.splitlines()[-1])
+			self.assertEqual([(r['url'], r.get('wt'), r.get('error')) for r in data], [
+				('https://example.org/', 1000, None),
+				('https://example.org/shop/', 2500, None),
+				('https://example.org/broken/', None, 'X-Sail-Profile header not found in response.'),
+			])
+			self.assertTrue(data[1]['path'].endswith('/002.xhprof.json'))
+
+class TestSampling(unittest.TestCase):
+	def test_enable_disable(self):
+		runner = CliRunner()
+		with runner.isolated_filesystem():
+			_project()
+			c = _Connection(json.dumps({'profile_key': 'key'}))
+
+			with mock.patch.object(util, 'connection', return_value=c):
+				result = runner.invoke(cli, ['profile', 'sampling', '--rate', '50', '--threshold', '800', '--json'])
+				self.assertEqual(result.exit_code, 0, result.output)
+				self.assertEqual(json.loads(result.output), {'rate': 50, 'threshold': 800, 'max_size': 50})
+
+				self.assertEqual(json.loads(c.uploads['/etc/sail/config.json']),
+					{'profile_key': 'key', 'profile_sample': {'rate': 50, 'threshold': 800, 'max_size': 50}})
+				self.assertEqual(c.uploads['/etc/sail/profile-sample.php'],
+					"<?php\nreturn [ 'rate' => 50, 'threshold' => 800, 'max_size' => 50 ];\n")
+
+				c.stdout = c.uploads['/etc/sail/config.json']
+				result = runner.invoke(cli, ['profile', 'sampling', '--disable'])
+				self.assertEqual(result.exit_code, 0, result.output)
+				self.assertEqual(json.loads(c.uploads['/etc/sail/config.json']), {'profile_key': 'key'})
+				self.assertIn('rm -f /etc/sail/profile-sample.php', c.commands)
+
+				c.stdout = c.uploads['/etc/sail/config.json']
+				result = runner.invoke(cli, ['profile', 'sampling', '--rate', '0'])
+				self.assertNotEqual(result.exit_code, 0)
@@ -0,0 +1,86 @@
+from sail import util
+
+import os, subprocess, tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+def _run_side_effect(command, **kwargs):
+	p = subprocess.run(command, shell=True, capture_output=True, encoding='utf8')
+	return SimpleNamespace(stdout=p.stdout, stderr=p.stderr, exited=p.returncode)
+
+class TestBatch(unittest.TestCase):
+	def setUp(self):
+		self.c = Mock()
+		self.c.run = Mock(side_effect=_run_side_effect)
+
+	def test_single_exec(self):
+		results = util.batch(self.c, ['echo one', 'printf two', 'echo three; echo four'])
+		self.c.run.assert_called_once()
+
+		self.assertEqual([r['stdout'] for r in results], ['one', 'two', 'three\nfour'])
+		self.assertEqual([r['exited'] for r in results], [0, 0, 0])
+		for r in results:
+			self.assertGreaterEqual(r['time'], 0)
+
+	def test_failure(self):
+		with self.assertRaises(util.SailException) as e:
+			util.batch(self.c, ['echo ok >&2', 'echo out; echo "bad secret" >&2; exit 3', 'echo unreachable'],
+				redact=['secret'])
+
+		message = str(e.exception)
+		self.assertIn('bad ********\nout', message)
+		self.assertNotIn('secret', message)
+		self.assertNotIn('ok', message)
+
+	def test_warn(self):
+		results = util.batch(self.c, ['true', 'echo failed >&2; false', 'echo reached'], warn=True)
+		self.assertEqual([r['exited'] for r in results], [0, 1, 0])
+		self.assertEqual([r['stderr'] for r in results], ['', 'failed', ''])
+		self.assertEqual(results[2]['stdout'], 'reached')
+
+class TestControlMaster(unittest.TestCase):
+	def test_stale_socket(self):
+		with tempfile.TemporaryDirectory() as root:
+			config = {'hostname': 'example.org', 'ip': '192.0.2.1'}
+			commands = []
+
+			def run(command, **kwargs):
+				commands.append(command)
+				return SimpleNamespace(returncode=255)
+
+			with patch.object(util, 'find_root', return_value=root), \
+				patch.object(util, 'config', return_value=config), \
+				patch.object(util, '_control_master_failed', False), \
+				patch.dict(util._handshakes, {'made': 0, 'saved': 0}), \
+				patch('subprocess.run', side_effect=run):
+				socket = util.control_path()
+				os.makedirs(os.path.dirname(socket), exist_ok=True)
+				open(socket, 'w').close()
+
+				util.ssh_args()
+
+				# A dead master is not a saved handshake, a new one is started.
+				self.assertEqual(util._handshakes, {'made': 1, 'saved': 0})
+				self.assertFalse(os.path.exists(socket))
+				self.assertEqual([command[-2] for command in commands], ['check', 'BatchMode=yes'])
+
+class TestCompression(unittest.TestCase):
+	def test_commands(self):
+		self.assertEqual(util.compress_command('gzip'), 'gzip -c9')
+		self.assertEqual(util.compress_command('zstd', 3, 2), 'zstd -q -c -3 -T2')
+		self.assertEqual(util.decompress_command(None), 'cat')
+
+		with self.assertRaises(util.SailException):
+			util.compress_command('gzip', 12)
+
+		with self.assertRaises(util.SailException):
+			util.compress_command('bzip2')
+
+	def test_detect(self):
+		for compression, data in [('gzip', b'\x1f\x8b\x08\x00'), ('zstd', b'\x28\xb5\x2f\xfd\x00'), (None, b'-- SQL')]:
+			with tempfile.NamedTemporaryFile(delete=False) as f:
+				f.write(data)
+
+			self.assertEqual(util.detect_compression(f.name), compression)
+			os.unlink(f.name)
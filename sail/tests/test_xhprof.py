@@ -0,0 +1,297 @@
+from sail import xhprof
+
+import io, json, os
+import pathlib, tempfile
+import unittest
+
+def _profile(edges, **meta):
+	data = {'xhprof': edges, 'timestamp': 1700000000, 'method': 'GET', 'host': 'example.org', 'request_uri': '/'}
+	data.update(meta)
+	return json.dumps(data)
+
+EDGES = {
+	'main()==>do_action': {'ct': 2, 'wt': 700, 'cpu': 600, 'mu': 2000, 'pmu': 2500},
+	'do_action==>mysqli_query#SELECT 1': {'ct': 3, 'wt': 300, 'cpu': 100, 'mu': 500, 'pmu': 0},
+	'main()==>mysqli_query#SELECT 1': {'ct': 1, 'wt': 100, 'cpu': 50, 'mu': 100, 'pmu': 0},
+	'do_action==>curl_exec': {'ct': 1, 'wt': 250, 'cpu': 10, 'mu': 300, 'pmu': 0},
+	'main()': {'ct': 1, 'wt': 1000, 'cpu': 800, 'mu': 4000, 'pmu': 5000},
+}
+
+class TestLoad(unittest.TestCase):
+	def test_metrics(self):
+		profile = xhprof.load(io.StringIO(_profile(EDGES)))
+
+		self.assertEqual(profile.metrics, ['ct', 'wt', 'cpu', 'mu', 'pmu'])
+		self.assertEqual(profile.meta['host'], 'example.org')
+
+		query = profile.ids['mysqli_query#SELECT 1']
+		do_action = profile.ids['do_action']
+		self.assertEqual(profile.column('ct')[query], 4)
+		self.assertEqual(profile.column('wt')[query], 400)
+		self.assertEqual(profile.column('excl_wt')[do_action], 150)
+		self.assertEqual(profile.column('excl_wt')[profile.ids['main()']], 200)
+
+		self.assertEqual(profile.totals['wt'], 1000)
+		self.assertEqual(profile.totals['queries'], 4)
+		self.assertEqual(profile.totals['http_reqs'], 1)
+		self.assertEqual(profile.totals['ct'], 8)
+
+	def test_adjacency(self):
+		profile = xhprof.load(io.StringIO(_profile(EDGES)))
+		query = profile.ids['mysqli_query#SELECT 1']
+
+		parents = sorted(profile.symbols[profile.edge_parent[e]] for e in profile.parents(query))
+		self.assertEqual(parents, ['do_action', 'main()'])
+
+		children = sorted(profile.symbols[profile.edge_child[e]] for e in profile.children(profile.ids['main()']))
+		self.assertEqual(children, ['do_action', 'mysqli_query#SELECT 1'])
+
+	def test_critical_path(self):
+		edges = dict(EDGES)
+		edges['mysqli_query#SELECT 1==>do_action'] = {'ct': 1, 'wt': 290, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		profile = xhprof.load(io.StringIO(_profile(edges)))
+
+		path = [(profile.symbols[i], value, round(percent)) for i, value, percent in profile.critical_path()]
+		self.assertEqual(path, [('main()', 1000, 100), ('do_action', 700, 70), ('mysqli_query#SELECT 1', 300, 43)])
+
+	def test_stacks(self):
+		profile = xhprof.load(io.StringIO(_profile(EDGES)))
+		stacks = {';'.join(profile.symbols[i] for i in path): round(value) for path, value in profile.stacks()}
+
+		self.assertEqual(stacks, {
+			'main()': 200,
+			'main();do_action': 150,
+			'main();do_action;mysqli_query#SELECT 1': 300,
+			'main();do_action;curl_exec': 250,
+			'main();mysqli_query#SELECT 1': 100,
+		})
+
+		# Cycles are cut, the values still add up to main().
+		edges = dict(EDGES)
+		edges['mysqli_query#SELECT 1==>do_action'] = {'ct': 1, 'wt': 290, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		profile = xhprof.load(io.StringIO(_profile(edges)))
+		stacks = list(profile.stacks())
+
+		self.assertAlmostEqual(sum(value for path, value in stacks), 1000)
+		self.assertTrue(all(len(set(path)) == len(path) for path, value in stacks))
+
+	def test_small_reads(self):
+		edges = dict(EDGES)
+		edges['main()==>{closure}#},"x},'] = {'ct': 1, 'wt': 1}
+
+		reader = xhprof._Reader(io.StringIO(_profile(edges, extra={'a': {'b': [1, 2]}})), size=3)
+		profile = xhprof.Profile()
+
+		for key in reader.items():
+			if key == 'xhprof':
+				for batch in reader.batches():
+					for edge, info in batch:
+						profile.add_edge(edge, info)
+			else:
+				profile.meta[key] = reader.value()
+
+		profile.build()
+		self.assertEqual(profile.meta['extra'], {'a': {'b': [1, 2]}})
+		self.assertIn('{closure}#},"x},', profile.ids)
+		self.assertEqual(profile.column('wt')[profile.ids['curl_exec']], 250)
+
+	def test_invalid(self):
+		with self.assertRaises(ValueError):
+			xhprof.load(io.StringIO(_profile(EDGES)[:-20]))
+
+class TestDiff(unittest.TestCase):
+	def test_diff(self):
+		edges = dict(EDGES)
+		edges['main()'] = dict(edges['main()'], wt=1500)
+		edges['main()==>do_action'] = dict(edges['main()==>do_action'], wt=1100)
+		del edges['do_action==>curl_exec']
+		edges['do_action==>wp_remote_get'] = {'ct': 1, 'wt': 600, 'cpu': 1, 'mu': 1, 'pmu': 0}
+
+		base = xhprof.load(io.StringIO(_profile(EDGES)))
+		new = xhprof.load(io.StringIO(_profile(edges)))
+		diff = xhprof.diff(base, new)
+
+		def delta(symbol, key):
+			return diff.column(key)[diff.ids[symbol]]
+
+		self.assertEqual(delta('main()', 'wt'), 500)
+		self.assertEqual(delta('do_action', 'wt'), 400)
+		self.assertEqual(delta('do_action', 'excl_wt'), 50)
+		self.assertEqual(delta('curl_exec', 'wt'), -250)
+		self.assertEqual(delta('wp_remote_get', 'wt'), 600)
+
+		self.assertEqual(diff.status[diff.ids['wp_remote_get']], 1)
+		self.assertEqual(diff.status[diff.ids['curl_exec']], -1)
+		self.assertEqual(diff.status[diff.ids['do_action']], 0)
+
+		self.assertEqual(diff.symbols[diff.order('excl_wt')[0]], 'wp_remote_get')
+		self.assertEqual(diff.totals['base']['http_reqs'], 1)
+		self.assertEqual(diff.totals['http_reqs'], 0)
+
+class TestAggregate(unittest.TestCase):
+	def test_aggregate(self):
+		runs = []
+		for wt in [1000, 1200, 1100, 5000]:
+			edges = dict(EDGES)
+			edges['main()'] = dict(edges['main()'], wt=wt)
+			runs.append(xhprof.load(io.StringIO(_profile(edges))))
+
+		# A symbol only seen in one run.
+		edges['main()==>wp_cron'] = {'ct': 1, 'wt': 40, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		runs[-1] = xhprof.load(io.StringIO(_profile(edges)))
+
+		profile = xhprof.aggregate(runs)
+		main = profile.ids['main()']
+		cron = profile.ids['wp_cron']
+
+		self.assertEqual(profile.column('wt')[main], 2075)
+		self.assertEqual(profile.column('wt:median')[main], 1150)
+		self.assertEqual(profile.column('wt:p95')[main], 5000)
+		self.assertEqual(profile.column('wt:stddev')[main], 1690)
+		self.assertEqual(profile.column('wt')[cron], 10)
+		self.assertEqual(profile.totals['runs'], 4)
+
+		# Stats survive a round trip through the JSON format.
+		f = io.StringIO()
+		xhprof.dump(profile, f)
+		loaded = xhprof.load(io.StringIO(f.getvalue()))
+		self.assertEqual(loaded.column('wt:stddev')[loaded.ids['main()']], 1690)
+		self.assertEqual(loaded.column('excl_wt')[loaded.ids['main()']], profile.column('excl_wt')[main])
+		self.assertEqual(loaded.totals['wt:p95'], 5000)
+
+class TestQueries(unittest.TestCase):
+	def test_fingerprint(self):
+		self.assertEqual(xhprof.fingerprint("SELECT * FROM wp_posts WHERE ID = 12 AND post_status = 'it''s' /* 1 */"),
+			'SELECT * FROM wp_posts WHERE ID = ? AND post_status = ?')
+		self.assertEqual(xhprof.fingerprint('SELECT meta_value FROM wp_2_postmeta WHERE post_id IN (1, 2,3);'),
+			'SELECT meta_value FROM wp_2_postmeta WHERE post_id IN (?+)')
+		self.assertEqual(xhprof.fingerprint("INSERT INTO t (a, b) VALUES (1, 'x'), (-2.5, \"y\")"),
+			'INSERT INTO t (a, b) VALUES (?+)')
+
+	def test_queries(self):
+		edges = dict(EDGES)
+		edges['main()==>get_post_meta'] = {'ct': 12, 'wt': 200, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		for i in range(12):
+			edges['get_post_meta==>mysqli_query#SELECT * FROM wp_postmeta WHERE post_id = %d' % i] = {
+				'ct': 1, 'wt': 10 + i, 'cpu': 1, 'mu': 1, 'pmu': 0}
+
+		profile = xhprof.load(io.StringIO(_profile(edges)))
+		queries = profile.queries()
+
+		self.assertEqual([q['fingerprint'] for q in queries],
+			['SELECT ?', 'SELECT * FROM wp_postmeta WHERE post_id = ?'])
+
+		query = queries[1]
+		self.assertEqual((query['ct'], query['wt'], query['mean']), (12, 186, 16))
+		self.assertAlmostEqual(query['percent'], 18.6)
+		self.assertTrue(query['n_plus_one'])
+		self.assertFalse(queries[0]['n_plus_one'])
+		self.assertEqual(profile.symbols[query['symbols'][0]], 'mysqli_query#SELECT * FROM wp_postmeta WHERE post_id = 11')
+		self.assertEqual([profile.symbols[i] for i in query['callers']], ['get_post_meta'])
+
+class TestHTTP(unittest.TestCase):
+	def test_http_calls(self):
+		edges = dict(EDGES)
+		edges['do_action==>Acme_License::check'] = {'ct': 1, 'wt': 900, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		edges['Acme_License::check==>wp_remote_get'] = {'ct': 2, 'wt': 880, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		edges['wp_remote_get==>WP_Http::request'] = {'ct': 2, 'wt': 870, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		for n, wt in [(1, 500), (2, 300)]:
+			edges['WP_Http::request==>curl_exec#https://license.acme.com/check?key=%d' % n] = {
+				'ct': 1, 'wt': wt, 'cpu': 1, 'mu': 1, 'pmu': 0}
+
+		profile = xhprof.load(io.StringIO(_profile(edges)))
+		calls = profile.http_calls()
+
+		self.assertEqual([(c['host'], c['path'], c['ct'], c['wt']) for c in calls],
+			[('license.acme.com', '/check', 2, 800), ('(unknown)', '', 1, 250)])
+		self.assertEqual([profile.symbols[i] for i in calls[0]['triggers']], ['Acme_License::check'])
+		self.assertEqual([profile.symbols[i] for i in calls[1]['triggers']], ['do_action'])
+		self.assertEqual(calls[0]['mean'], 400)
+
+class TestPlugins(unittest.TestCase):
+	def test_plugins(self):
+		hooks = [
+			{'hook': 'init', 'component': 'plugin:woocommerce', 'callback': 'WC_Post_Types::register', 'ct': 1, 'wt': 300, 'excl_wt': 300},
+			{'hook': 'init', 'component': 'core', 'callback': 'wp_widgets_init', 'ct': 1, 'wt': 250, 'excl_wt': 50},
+			{'hook': 'widgets_init', 'component': 'plugin:woocommerce', 'callback': 'wc_register_widgets', 'ct': 1, 'wt': 200, 'excl_wt': 200},
+			{'hook': 'the_content', 'component': 'theme:acme', 'callback': '{closure} functions.php:12', 'ct': 4, 'wt': 100, 'excl_wt': 100},
+		]
+		profile = xhprof.load(io.StringIO(_profile(EDGES, hooks=hooks)))
+
+		plugins = profile.plugins()
+		self.assertEqual([(p['component'], p['ct'], p['wt'], p['hooks']) for p in plugins], [
+			('plugin:woocommerce', 2, 500, ['init', 'widgets_init']),
+			('theme:acme', 4, 100, ['the_content']),
+			('core', 1, 50, ['init'])])
+		self.assertAlmostEqual(plugins[0]['percent'], 50.0)
+
+		hooks = profile.hooks()
+		self.assertEqual([(h['hook'], h['wt']) for h in hooks], [('init', 350), ('widgets_init', 200), ('the_content', 100)])
+		self.assertEqual(hooks[0]['callbacks'][0], ('plugin:woocommerce', 'WC_Post_Types::register', 300))
+		self.assertEqual(hooks[2]['mean'], 25)
+
+		self.assertEqual(xhprof.load(io.StringIO(_profile(EDGES))).plugins(), [])
+
+class TestSearch(unittest.TestCase):
+	def setUp(self):
+		edges = dict(EDGES)
+		edges['do_action==>WC_Cart::calculate_totals'] = {'ct': 1, 'wt': 50, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		edges['do_action==>{closure}'] = {'ct': 1, 'wt': 20, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		edges['main()==>mysqli_query#' + 'x' * 300 + 'needle'] = {'ct': 1, 'wt': 1, 'cpu': 1, 'mu': 1, 'pmu': 0}
+		self.profile = xhprof.load(io.StringIO(_profile(edges)))
+
+	def names(self, ids):
+		return sorted(self.profile.symbols[i] for i in ids)
+
+	def test_search(self):
+		self.assertEqual(self.names(self.profile.search('CART::calc')), ['WC_Cart::calculate_totals'])
+		self.assertEqual(self.names(self.profile.search('{closure}')), ['{closure}'])
+		self.assertEqual(self.profile.search('nothing here'), [])
+
+		# Long symbols are searched past the indexed prefix.
+		self.assertEqual(len(self.profile.search('needle')), 1)
+
+		within = self.profile.search('do')
+		self.assertEqual(self.names(self.profile.search('do_a', within=within)), ['do_action'])
+
+	def test_filter(self):
+		self.assertEqual(self.names(self.profile.filter('wc_*')), ['WC_Cart::calculate_totals'])
+		self.assertEqual(self.names(self.profile.filter('>150')), ['curl_exec', 'main()', 'mysqli_query#SELECT 1'])
+		self.assertEqual(self.names(self.profile.filter('mysqli ct>1')), ['mysqli_query#SELECT 1'])
+
+		with self.assertRaises(ValueError):
+			self.profile.filter('foo>1')
+
+class TestCache(unittest.TestCase):
+	def test_roundtrip(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = pathlib.Path(temp_dir) / 'test.xhprof.json'
+			path.write_text(_profile(EDGES))
+
+			profile = xhprof.read(path)
+			self.assertTrue(xhprof._cache_path(path).exists())
+
+			cached = xhprof.read_cache(path)
+			self.assertIsNotNone(cached)
+			self.assertEqual(cached.symbols, profile.symbols)
+			self.assertEqual(cached.totals, profile.totals)
+
+			for key, values in profile.columns.items():
+				self.assertEqual(list(cached.column(key)), list(values))
+
+			main = profile.ids['main()']
+			self.assertEqual(list(cached.children(main)), list(profile.children(main)))
+
+			# Sort orders are added to the sidecar on request.
+			self.assertEqual(cached.orders, {})
+			profile = xhprof.read(path, orders=['excl_wt'])
+			cached = xhprof.read_cache(path)
+			self.assertEqual(list(cached.orders['excl_wt']), list(profile.order('excl_wt')))
+			self.assertEqual(cached.symbols[cached.order('excl_wt')[0]], 'mysqli_query#SELECT 1')
+			self.assertEqual(cached.rank('excl_wt')[cached.ids['mysqli_query#SELECT 1']], 0)
+
+			# Modified profiles invalidate the cache.
+			path.write_text(_profile(EDGES, host='example.com'))
+			os.utime(path, ns=(0, 0))
+			self.assertIsNone(xhprof.read_cache(path))
+			self.assertEqual(xhprof.read(path).meta['host'], 'example.com')
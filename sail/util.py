@@ -4,6 +4,7 @@ import time, pathlib, os
 import json, click, requests, shlex, subprocess
 import fabric, paramiko
 import jinja2
+import atexit, hashlib, tempfile
 
 class SailException(click.ClickException):
 	def show(self, file=None):
@@ -219,14 +220,7 @@ def rsync(args, source, destination, default_filters=True, extend_filters=[]):
 	filters.insert(0, '- .*')
 
 	args.insert(0, 'rsync')
-	ssh_args = ['ssh',
-		'-i', '%s/.sail/ssh.key' % root,
-		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
-		'-o', 'IdentitiesOnly=yes',
-		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
-	]
-
-	args.extend(['-e', join(ssh_args)])
+	args.extend(['-e', join(['ssh'] + ssh_args())])
 
 	# Add all filters in order
 	for filter in filters:
@@ -256,12 +250,117 @@ def rsync(args, source, destination, default_filters=True, extend_filters=[]):
 
 	return (p.returncode, stdout, stderr)
 
+# Pooled fabric connections and OpenSSH multiplexing stats, per process.
+_connections = {}
+_handshakes = {'made': 0, 'saved': 0}
+
+def control_path():
+	'''Path to the OpenSSH ControlMaster socket for the current project'''
+	_config = config()
+	root = find_root()
+
+	digest = hashlib.sha256(('root@%s/%s' % (_config['hostname'], _config['ip'])).encode('utf8')).hexdigest()[:8]
+	path = '%s/.sail/ssh-%s.sock' % (root, digest)
+
+	# Unix socket paths are limited to ~104 bytes on some platforms.
+	if len(path) > 100:
+		digest = hashlib.sha256(path.encode('utf8')).hexdigest()[:16]
+		path = '%s/sail-ssh-%s.sock' % (tempfile.gettempdir(), digest)
+
+	return path
+
+def ssh_args():
+	'''Common OpenSSH arguments, multiplexed through a shared ControlMaster'''
+	root = find_root()
+	socket = control_path()
+
+	args = [
+		'-i', '%s/.sail/ssh.key' % root,
+		'-o', 'UserKnownHostsFile="%s/.sail/known_hosts"' % root,
+		'-o', 'IdentitiesOnly=yes',
+		'-o', 'IdentityFile="%s/.sail/ssh.key"' % root,
+	]
+
+	if os.path.exists(socket) and _control_master_alive(args, socket):
+		_handshakes['saved'] += 1
+	else:
+		_handshakes['made'] += 1
+		_control_master(args, socket)
+
+	# Clients never become a master themselves, a backgrounded master would
+	# hold on to their stdout/stderr pipes. Without a socket ssh connects directly.
+	return args + ['-o', 'ControlMaster=no', '-o', 'ControlPath="%s"' % socket]
+
+def _control_master_alive(args, socket):
+	'''Whether a ControlMaster answers on the socket, stale sockets are removed'''
+	_config = config()
+	command = ['ssh', *args, '-o', 'ControlPath="%s"' % socket, '-O', 'check', 'root@%s' % _config['hostname']]
+
+	try:
+		r = subprocess.run(command, stdin=subprocess.DEVNULL,
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+		if r.returncode == 0:
+			return True
+	except Exception as e:
+		dlog('Exception: %s' % repr(e))
+
+	dlog('Removing stale SSH ControlMaster socket: %s' % socket)
+	try:
+		os.unlink(socket)
+	except OSError:
+		pass
+
+	return False
+
+_control_master_failed = False
+def _control_master(args, socket):
+	'''Start a detached OpenSSH ControlMaster which persists for a minute'''
+	global _control_master_failed
+
+	if _control_master_failed:
+		return
+
+	_config = config()
+	command = ['ssh', '-M', '-N', '-f', *args,
+		'-o', 'ControlPath="%s"' % socket,
+		'-o', 'ControlPersist=60',
+		'-o', 'BatchMode=yes',
+		'root@%s' % _config['hostname'],
+	]
+
+	dlog('Starting SSH ControlMaster: %s' % socket)
+
+	try:
+		r = subprocess.run(command, stdin=subprocess.DEVNULL,
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+		_control_master_failed = r.returncode != 0
+	except Exception as e:
+		dlog('Exception: %s' % repr(e))
+		_control_master_failed = True
+
+	if _control_master_failed:
+		dlog('Could not start SSH ControlMaster, falling back to direct connections')
+
 def connection():
 	_config = config()
 	root = find_root()
 
 	ip = _config['ip']
-	with open('%s/.sail/ssh.key' % root, 'r') as f:
+	key_file = pathlib.Path(root) / '.sail/ssh.key'
+	known_hosts = pathlib.Path(root) / '.sail/known_hosts'
+
+	# Reuse an existing connection unless the key or known hosts changed.
+	pool_key = (root, ip,
+		key_file.stat().st_mtime if key_file.exists() else None,
+		known_hosts.stat().st_mtime if known_hosts.exists() else None)
+
+	if pool_key in _connections:
+		_handshakes['saved'] += 1
+		return _connections[pool_key]
+
+	_handshakes['made'] += 1
+
+	with open(key_file, 'r') as f:
 		pkey = paramiko.RSAKey.from_private_key(f)
 
 	ssh_config = fabric.Config()
@@ -274,13 +373,12 @@ def connection():
 	c = fabric.Connection(ip, config=ssh_config)
 
 	# Load known_hosts if it exists
-	known_hosts = pathlib.Path(root) / '.sail/known_hosts'
 	if known_hosts.exists() and known_hosts.is_file():
 		c.client.load_host_keys(known_hosts)
 
 	def _run(func):
-		def run(*args, **kwargs):
-			dlog('Fabric: %s, %s' % (repr(args), repr(kwargs)))
+		def run(*args, redact=(), **kwargs):
+			dlog(_redact('Fabric: %s, %s' % (repr(args), repr(kwargs)), redact))
 			kwargs['hide'] = True
 
 			# Run it
@@ -288,19 +386,202 @@ def connection():
 
 			stdout = r.stdout.strip()
 			if stdout:
-				dlog('Fabric stdout: %s' % stdout)
+				dlog(_redact('Fabric stdout: %s' % stdout, redact))
 
 			stderr = r.stderr.strip()
 			if stderr:
-				dlog('Fabric stderr: %s' % stderr)
+				dlog(_redact('Fabric stderr: %s' % stderr, redact))
 
 			return r
 		return run
 
 	# Decorate it
 	c.run = _run(c.run)
+	_connections[pool_key] = c
 	return c
 
+def batch(c, commands, warn=False, redact=()):
+	'''Run a list of shell commands in a single remote exec.
+
+	Returns a list of dicts with the command, exit code, stdout, stderr and
+	wall time in seconds for every step that ran. Stops at the first failing
+	step and raises a SailException with its output unless warn is set.
+	Strings in redact, like passwords, are masked in logs and errors.
+	'''
+	marker = '__SAIL_STEP_%s' % hashlib.sha256(os.urandom(32)).hexdigest()[:8]
+	script = ['export LC_NUMERIC=C']
+
+	for i, command in enumerate(commands):
+		script.append(f'_t=$EPOCHREALTIME; {{\n{command}\n}}; _r=$?')
+		script.append(f'printf "\\n{marker} %d %d %s %s\\n" {i} $_r $_t $EPOCHREALTIME')
+		script.append(f'printf "\\n{marker} %d\\n" {i} >&2')
+		if not warn:
+			script.append('[ $_r -eq 0 ] || exit $_r')
+
+	r = c.run(join(['bash', '-c', '\n'.join(script)]), warn=True, redact=redact)
+
+	results = []
+	stdout = []
+	for line in r.stdout.splitlines():
+		if not line.startswith(marker + ' '):
+			stdout.append(line)
+			continue
+
+		i, exited, start, end = line.split()[1:]
+		results.append({
+			'command': commands[int(i)],
+			'exited': int(exited),
+			'stdout': '\n'.join(stdout).strip(),
+			'time': float(end) - float(start),
+		})
+		stdout = []
+
+	# Stderr is split by the same markers, output after the last one belongs
+	# to a step which did not finish.
+	stderr = [[]]
+	for line in r.stderr.splitlines():
+		if line.startswith(marker + ' '):
+			stderr.append([])
+		else:
+			stderr[-1].append(line)
+
+	for i, result in enumerate(results):
+		result['stderr'] = '\n'.join(stderr[i]).strip() if i < len(stderr) else ''
+		dlog('Batch: step %d of %d exited %d in %.3fs' % (i + 1, len(commands), result['exited'], result['time']))
+
+	if not warn:
+		failed = [result for result in results if result['exited'] != 0]
+		if failed or len(results) < len(commands):
+			i = results.index(failed[0]) if failed else len(results)
+			output = [failed[0]['stderr'], failed[0]['stdout']] if failed else [
+				'\n'.join(stderr[i]).strip() if i < len(stderr) else '', '\n'.join(stdout).strip()]
+
+			message = 'Remote command failed: %s' % commands[i]
+			output = '\n'.join(o for o in output if o)
+			if output:
+				message += '\n' + output
+
+			raise SailException(_redact(message, redact))
+
+	return results
+
+def _redact(text, secrets):
+	for secret in secrets:
+		if secret:
+			text = text.replace(secret, '********')
+
+	return text
+
+@atexit.register
+def _close_connections():
+	for c in _connections.values():
+		try:
+			c.close()
+		except:
+			pass
+
+	_connections.clear()
+
+	if _handshakes['saved']:
+		dlog('SSH handshakes: %d made, %d saved by connection reuse' % (_handshakes['made'], _handshakes['saved']))
+
+def ssh_stream(command, f, progress=True):
+	'''Run a remote command and stream its stdout into a local binary file object.
+
+	Returns the number of bytes written, raises a SailException if the remote
+	command fails. Shows live throughput unless progress is False.
+	'''
+	_config = config()
+	args = ['ssh', *ssh_args(), 'root@%s' % _config['hostname'],
+		join(['bash', '-c', 'set -o pipefail; ' + command])]
+
+	dlog('SSH stream: %s' % repr(args))
+
+	with tempfile.TemporaryFile() as stderr:
+		p = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+
+		start = last = time.time()
+		written = 0
+
+		while True:
+			chunk = p.stdout.read(1024 * 1024)
+			if not chunk:
+				break
+
+			f.write(chunk)
+			written += len(chunk)
+
+			if progress and not silent() and time.time() - last > .5:
+				last = time.time()
+				rate = written / max(last - start, .001)
+				click.secho('  Received %s (%s/s)   \r' % (sizeof_fmt(written), sizeof_fmt(rate)),
+					fg='bright_black', nl=False)
+
+		p.wait()
+		stderr.seek(0)
+		stderr = stderr.read().decode('utf8', errors='replace').strip()
+
+	elapsed = max(time.time() - start, .001)
+	if progress and not silent() and written:
+		click.secho('  Received %s in %.1fs (%s/s)   ' % (sizeof_fmt(written), elapsed,
+			sizeof_fmt(written / elapsed)), fg='bright_black')
+
+	if stderr:
+		dlog('SSH stream stderr: %s' % stderr)
+
+	if p.returncode != 0:
+		raise SailException('An error occurred in SSH. Please try again.')
+
+	return written
+
+## Compression:
+compressors = {
+	'zstd': {'ext': '.zst', 'magic': b'\x28\xb5\x2f\xfd', 'levels': (1, 19), 'default_level': 6},
+	'gzip': {'ext': '.gz', 'magic': b'\x1f\x8b', 'levels': (1, 9), 'default_level': 9},
+}
+
+def compress_command(compression='zstd', level=None, threads=0):
+	'''Shell command which compresses stdin to stdout. Threads 0 means all cores.'''
+	if compression not in compressors:
+		raise SailException('Unsupported compression: %s' % compression)
+
+	low, high = compressors[compression]['levels']
+	if level is None:
+		level = compressors[compression]['default_level']
+
+	if not low <= level <= high:
+		raise SailException('Compression level for %s must be between %d and %d' % (compression, low, high))
+
+	if compression == 'zstd':
+		return 'zstd -q -c -%d -T%d' % (level, threads)
+
+	return 'gzip -c%d' % level
+
+def decompress_command(compression):
+	'''Shell command which decompresses stdin to stdout, cat for plain files'''
+	return {'zstd': 'zstd -q -dc', 'gzip': 'gzip -dc'}.get(compression, 'cat')
+
+def detect_compression(path):
+	'''Detect the compression format of a local file by its magic bytes'''
+	with open(path, 'rb') as f:
+		head = f.read(4)
+
+	for name, compressor in compressors.items():
+		if head.startswith(compressor['magic']):
+			return name
+
+	return None
+
+def ensure_command(c, command, package=None):
+	'''Install a package on production if a command is not available'''
+	if c.run('command -v %s' % shlex.quote(command), warn=True).ok:
+		return
+
+	package = package or command
+	item('Installing %s' % package)
+	wait = 'while fuser /var/{lib/{dpkg,apt/lists},cache/apt/archives}/{lock,lock-frontend} >/dev/null 2>&1; do sleep 1; done && '
+	c.run(wait + 'apt update && DEBIAN_FRONTEND=noninteractive apt install -y %s' % shlex.quote(package), timeout=300)
+
 def template(filename, data):
 	e = jinja2.Environment(loader=jinja2.FileSystemLoader(sail.TEMPLATES_PATH))
 	template = e.get_template(filename)
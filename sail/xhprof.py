@@ -0,0 +1,931 @@
+import json, os, re, sys
+import fnmatch, math
+import mmap, struct
+from array import array
+from urllib.parse import urlparse
+
+# Metrics recorded by xhprof, in column order. Profiles only have some of these,
+# depending on the flags passed to xhprof_enable().
+METRICS = ['ct', 'wt', 'ut', 'st', 'cpu', 'mu', 'pmu', 'samples']
+
+QUERY_FUNCTIONS = ['mysqli_query', 'mysql_query', 'mysqli::query']
+HTTP_FUNCTIONS = ['curl_exec']
+
+# Callers of HTTP functions which are part of the HTTP API rather than the
+# code that triggered a request.
+HTTP_PLUMBING = ('curl_', 'WP_Http', 'Requests', 'WpOrg\\Requests\\', 'wp_remote_', 'wp_safe_remote_',
+	'_wp_http_', 'download_url')
+
+# Only the start of very long symbols (SQL queries) is indexed for search,
+# the rest are always checked in full.
+TRIGRAM_LIMIT = 256
+
+# Queries with the same fingerprint run this many times in a request are
+# flagged as N+1 patterns.
+N_PLUS_ONE = 10
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+_sql_literals = re.compile(r'''
+	(?P<comment>/\*.*?(?:\*/|$)|(?:--|\#)[^\n]*)
+	| '(?:[^'\\]|\\.|'')*'? | "(?:[^"\\]|\\.|"")*"?
+	| (?<![\w.$])(?:0x[0-9a-f]+|-?\d+(?:\.\d+)?(?:e[+-]?\d+)?)\b
+''', re.VERBOSE | re.IGNORECASE | re.DOTALL)
+_sql_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+
+def fingerprint(sql):
+	'''Normalize a query: comments removed, literals replaced with ? and
+	lists of values (IN, VALUES) collapsed, so similar queries group together.'''
+	sql = _sql_literals.sub(lambda m: ' ' if m.group('comment') else '?', sql)
+	sql = _sql_lists.sub('(?+)', sql)
+	return ' '.join(sql.split()).rstrip('; ')
+
+class _Reader:
+	'''Incremental JSON reader, yields object keys one at a time so large
+	objects can be consumed without decoding them in full.'''
+	def __init__(self, f, size=1024 * 1024):
+		self.f = f
+		self.size = size
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder()
+
+	def _fill(self):
+		data = self.f.read(self.size)
+		if not data:
+			self.eof = True
+
+		self.buf = self.buf[self.pos:] + data
+		self.pos = 0
+
+	def peek(self):
+		while True:
+			self.pos = _whitespace.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+
+			if self.eof:
+				raise ValueError('Unexpected end of JSON')
+
+			self._fill()
+
+	def expect(self, char):
+		if self.peek() != char:
+			raise ValueError('Expected %s at position %d' % (char, self.pos))
+
+		self.pos += 1
+
+	def value(self):
+		self.peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buf, self.pos)
+
+				# A number at the end of the buffer may continue in the next read.
+				if end < len(self.buf) or self.eof:
+					self.pos = end
+					return value
+			except ValueError:
+				if self.eof:
+					raise
+
+			self._fill()
+
+	def items(self):
+		'''Iterate over the keys of an object, the caller reads each value'''
+		self.expect('{')
+		if self.peek() == '}':
+			self.pos += 1
+			return
+
+		while True:
+			key = self.value()
+			if not isinstance(key, str):
+				raise ValueError('Expected an object key at position %d' % self.pos)
+
+			self.expect(':')
+			yield key
+
+			c = self.peek()
+			self.pos += 1
+
+			if c == '}':
+				return
+
+			if c != ',':
+				raise ValueError('Expected , or } at position %d' % (self.pos - 1))
+
+	def batches(self):
+		'''Iterate over an object whose values are objects, like the xhprof edge
+		map, in decoded batches of (key, value) pairs. Batches are cut after a
+		"}," in the buffer, a cut inside a key string fails to decode and an
+		earlier one is tried instead.'''
+		self.expect('{')
+
+		while True:
+			batch = None
+			cut = len(self.buf)
+
+			for attempt in range(3):
+				cut = self.buf.rfind('},', self.pos, cut)
+				if cut < 0:
+					break
+
+				try:
+					batch = json.loads('{' + self.buf[self.pos:cut + 1] + '}')
+					break
+				except ValueError:
+					pass
+
+			if batch is not None:
+				self.pos = cut + 2
+				yield batch.items()
+				continue
+
+			# No complete batch in the buffer, this may be the last one.
+			try:
+				batch, end = self.decoder.raw_decode('{' + self.buf[self.pos:])
+			except ValueError:
+				if self.eof:
+					raise
+
+				self._fill()
+				continue
+
+			self.pos += end - 1
+			yield batch.items()
+			return
+
+class Profile:
+	'''An xhprof call graph. Symbols are interned to integer ids, metrics are
+	stored in arrays indexed by symbol id and edges in CSR adjacency arrays.'''
+	def __init__(self):
+		self.symbols = []
+		self.ids = {}
+		self.meta = {}
+		self.metrics = []
+		self.columns = {}
+		self.totals = {}
+		self.orders = {}
+		self.ranks = {}
+		self.extents = {}
+
+		# For diffs, 1 for symbols only in the new profile, -1 only in the base.
+		self.status = None
+
+		# Trigram search index, see index_trigrams().
+		self.trigrams = None
+		self.trigram_offsets = array('i')
+		self.trigram_postings = array('i')
+		self._lower = None
+		self._long = None
+
+		# Edges in file order, the root edge has no parent (-1).
+		self.edge_parent = array('i')
+		self.edge_child = array('i')
+		self.edge_metrics = {}
+
+		# Edge ids grouped by parent and by child.
+		self.child_offsets = array('i')
+		self.child_edges = array('i')
+		self.parent_offsets = array('i')
+		self.parent_edges = array('i')
+
+	def __len__(self):
+		return len(self.symbols)
+
+	def intern(self, symbol):
+		i = self.ids.get(symbol)
+		if i is None:
+			i = self.ids[symbol] = len(self.symbols)
+			self.symbols.append(symbol)
+
+		return i
+
+	def column(self, key):
+		return self.columns[key]
+
+	def order(self, key):
+		'''Symbol ids sorted by a column, descending'''
+		if key not in self.orders:
+			values = self.columns[key]
+			self.orders[key] = array('i', sorted(range(len(self.symbols)), key=values.__getitem__, reverse=True))
+
+		return self.orders[key]
+
+	def rank(self, key):
+		'''Position of every symbol id in order(key)'''
+		if key not in self.ranks:
+			order = self.order(key)
+			ranks = array('i', bytes(4 * len(order)))
+			for position, i in enumerate(order):
+				ranks[i] = position
+
+			self.ranks[key] = ranks
+
+		return self.ranks[key]
+
+	def index_trigrams(self):
+		'''Build the trigram index: for every lowercase trigram in a symbol
+		name, the sorted ids of the symbols which contain it.'''
+		postings = {}
+		for i, name in enumerate(self.symbols):
+			name = name[:TRIGRAM_LIMIT].lower()
+			for trigram in {name[j:j + 3] for j in range(len(name) - 2)}:
+				if trigram in postings:
+					postings[trigram].append(i)
+				else:
+					postings[trigram] = [i]
+
+		self.trigrams = {}
+		self.trigram_offsets = array('i', [0])
+		self.trigram_postings = array('i')
+
+		for k, trigram in enumerate(sorted(postings)):
+			self.trigrams[trigram] = k
+			self.trigram_postings.extend(postings[trigram])
+			self.trigram_offsets.append(len(self.trigram_postings))
+
+	def _candidates(self, text):
+		'''Symbol ids which may contain the lowercase text'''
+		if len(text) < 3:
+			return range(len(self.symbols))
+
+		if self.trigrams is None:
+			self.index_trigrams()
+
+		if self._long is None:
+			self._long = [i for i, name in enumerate(self.symbols) if len(name) > TRIGRAM_LIMIT]
+
+		smallest = None
+		for trigram in {text[j:j + 3] for j in range(len(text) - 2)}:
+			k = self.trigrams.get(trigram)
+			if k is None:
+				return self._long
+
+			postings = self.trigram_postings[self.trigram_offsets[k]:self.trigram_offsets[k + 1]]
+			if smallest is None or len(postings) < len(smallest):
+				smallest = postings
+
+		return list(smallest) + self._long
+
+	def lower(self, i):
+		if self._lower is None:
+			self._lower = [name.lower() for name in self.symbols]
+
+		return self._lower[i]
+
+	def search(self, text, within=None):
+		'''Ids of symbols containing text, case-insensitive. Results of a previous
+		search for a prefix of text can be passed in to narrow them down.'''
+		text = text.lower()
+		candidates = self._candidates(text)
+
+		if within is not None and len(within) < len(candidates):
+			candidates = within
+
+		return [i for i in candidates if text in self.lower(i)]
+
+	def filter(self, expression):
+		'''Ids of symbols matching every space-separated term of an expression.
+		Terms are substrings, globs like WC_* or metric conditions like >1000,
+		which default to exclusive wall time in µs, or ct>100.'''
+		matches = None
+
+		for term in expression.split():
+			condition = re.match(r'^(\w+)?([<>])(-?\d+)$', term)
+
+			if condition:
+				key, op, value = condition.group(1) or 'excl_wt', condition.group(2), int(condition.group(3))
+				if key not in self.columns:
+					raise ValueError('Unknown metric: %s' % key)
+
+				values = self.columns[key]
+				candidates = matches if matches is not None else range(len(self.symbols))
+				if op == '>':
+					matches = [i for i in candidates if values[i] > value]
+				else:
+					matches = [i for i in candidates if values[i] < value]
+
+			elif '*' in term or '?' in term:
+				pattern = re.compile(fnmatch.translate(term.lower()))
+				literal = max(re.split(r'[*?\[\]]', term.lower()), key=len)
+				candidates = self.search(literal, within=matches)
+				matches = [i for i in candidates if pattern.match(self.lower(i))]
+
+			else:
+				matches = self.search(term, within=matches)
+
+		return matches if matches is not None else list(range(len(self.symbols)))
+
+	def extent(self, key):
+		'''Smallest and largest value of a column'''
+		if key not in self.extents:
+			values = self.columns[key]
+			self.extents[key] = (min(values, default=0), max(values, default=0))
+
+		return self.extents[key]
+
+	def critical_path(self, key='wt', start=None):
+		'''Walk from main(), or the start symbol id, to the child with the
+		largest edge metric at every step. Returns (symbol id, edge value,
+		percent of parent) tuples. Every symbol is visited at most once, so
+		recursion ends the path and the walk is linear in the edges.'''
+		if key not in self.edge_metrics:
+			raise ValueError('Profile does not have %s data' % key)
+
+		values = self.edge_metrics[key]
+		i = self.ids['main()'] if start is None else start
+		path = [(i, self.columns[key][i], 100.0)]
+		seen = {i}
+
+		while True:
+			best = None
+			for e in self.children(i):
+				if self.edge_child[e] in seen:
+					continue
+
+				if best is None or values[e] > values[best]:
+					best = e
+
+			if best is None or values[best] <= 0:
+				break
+
+			i = self.edge_child[best]
+			parent = path[-1][1]
+			path.append((i, values[best], values[best] / parent * 100 if parent else 0.0))
+			seen.add(i)
+
+		return path
+
+	def queries(self):
+		'''Queries grouped by fingerprint, slowest first. Returns dicts with the
+		call count, total and mean wall time, percent of the request, the
+		symbol ids of the raw queries and their callers by number of calls.'''
+		ct = self.columns['ct']
+		wt = self.columns['wt']
+		total = self.totals['wt']
+		groups = {}
+
+		for i, symbol in enumerate(self.symbols):
+			func, sep, sql = symbol.partition('#')
+			if not sep or func not in QUERY_FUNCTIONS:
+				continue
+
+			key = fingerprint(sql)
+			group = groups.setdefault(key, {'fingerprint': key, 'ct': 0, 'wt': 0, 'symbols': [], 'callers': {}})
+			group['ct'] += ct[i]
+			group['wt'] += wt[i]
+			group['symbols'].append(i)
+
+			for e in self.parents(i):
+				parent = self.edge_parent[e]
+				if parent >= 0:
+					group['callers'][parent] = group['callers'].get(parent, 0) + self.edge_metrics['ct'][e]
+
+		queries = sorted(groups.values(), key=lambda group: group['wt'], reverse=True)
+		for group in queries:
+			group['mean'] = round(group['wt'] / group['ct']) if group['ct'] else 0
+			group['percent'] = group['wt'] / total * 100 if total else 0.0
+			group['symbols'].sort(key=wt.__getitem__, reverse=True)
+			group['callers'] = sorted(group['callers'], key=group['callers'].get, reverse=True)
+			group['n_plus_one'] = group['ct'] >= N_PLUS_ONE
+
+		return queries
+
+	def http_calls(self):
+		'''Outbound HTTP requests grouped by host and path, slowest first.
+		Returns dicts like queries(), with the symbols which triggered the
+		requests, the first callers outside of the WordPress HTTP API, by
+		their estimated share of the time.'''
+		ct = self.columns['ct']
+		wt = self.columns['wt']
+		total = self.totals['wt']
+		groups = {}
+
+		for i, symbol in enumerate(self.symbols):
+			func, sep, url = symbol.partition('#')
+			if func not in HTTP_FUNCTIONS:
+				continue
+
+			url = urlparse(url.strip()) if sep else None
+			host = url.netloc if url and url.netloc else '(unknown)'
+			path = url.path or '/' if url and url.netloc else ''
+
+			group = groups.setdefault((host, path), {'host': host, 'path': path, 'ct': 0, 'wt': 0,
+				'symbols': [], 'triggers': {}})
+			group['ct'] += ct[i]
+			group['wt'] += wt[i]
+			group['symbols'].append(i)
+
+			for trigger, share in self._triggers(i).items():
+				group['triggers'][trigger] = group['triggers'].get(trigger, 0.0) + share * wt[i]
+
+		calls = sorted(groups.values(), key=lambda group: group['wt'], reverse=True)
+		for group in calls:
+			group['mean'] = round(group['wt'] / group['ct']) if group['ct'] else 0
+			group['percent'] = group['wt'] / total * 100 if total else 0.0
+			group['symbols'].sort(key=wt.__getitem__, reverse=True)
+			group['triggers'] = sorted(group['triggers'], key=group['triggers'].get, reverse=True)
+
+		return calls
+
+	def plugins(self):
+		'''Hook callback time grouped by component (plugin:name, theme:name,
+		core, ...) from the hook timer in prepend.php, slowest first. Times are
+		exclusive of nested hooks, so they add up. Each component lists its
+		hooks, slowest first. Empty for profiles without hook timings.'''
+		total = self.totals['wt']
+		groups = {}
+
+		for row in self.meta.get('hooks') or []:
+			group = groups.setdefault(row['component'], {'component': row['component'], 'ct': 0, 'wt': 0, 'hooks': {}})
+			group['ct'] += row['ct']
+			group['wt'] += row['excl_wt']
+			group['hooks'][row['hook']] = group['hooks'].get(row['hook'], 0) + row['excl_wt']
+
+		plugins = sorted(groups.values(), key=lambda group: group['wt'], reverse=True)
+		for group in plugins:
+			group['mean'] = round(group['wt'] / group['ct']) if group['ct'] else 0
+			group['percent'] = group['wt'] / total * 100 if total else 0.0
+			group['hooks'] = sorted(group['hooks'], key=group['hooks'].get, reverse=True)
+
+		return plugins
+
+	def hooks(self):
+		'''Hook callback time grouped by hook, like plugins(). Each hook lists
+		its callbacks as (component, callback, exclusive time), slowest first.'''
+		total = self.totals['wt']
+		groups = {}
+
+		for row in self.meta.get('hooks') or []:
+			group = groups.setdefault(row['hook'], {'hook': row['hook'], 'ct': 0, 'wt': 0, 'callbacks': []})
+			group['ct'] += row['ct']
+			group['wt'] += row['excl_wt']
+			group['callbacks'].append((row['component'], row['callback'], row['excl_wt']))
+
+		hooks = sorted(groups.values(), key=lambda group: group['wt'], reverse=True)
+		for group in hooks:
+			group['mean'] = round(group['wt'] / group['ct']) if group['ct'] else 0
+			group['percent'] = group['wt'] / total * 100 if total else 0.0
+			group['callbacks'].sort(key=lambda callback: callback[2], reverse=True)
+
+		return hooks
+
+	def _triggers(self, i, limit=32):
+		'''Callers of symbol i outside of the HTTP plumbing, with their share of
+		its calls. Edges don't say which caller a call came through, so shares
+		are split between parents by wall time at every level.'''
+		wt = self.edge_metrics.get('wt')
+		triggers = {}
+		frontier = {i: 1.0}
+		seen = {i}
+
+		for depth in range(limit):
+			parents = {}
+			for j, share in frontier.items():
+				edges = [e for e in self.parents(j) if self.edge_parent[e] >= 0 and self.edge_parent[e] not in seen]
+				total = sum(wt[e] for e in edges) if wt else 0
+
+				for e in edges:
+					parent = self.edge_parent[e]
+					part = share * (wt[e] / total if total else 1 / len(edges))
+					found = parents if self.symbols[parent].startswith(HTTP_PLUMBING) else triggers
+					found[parent] = found.get(parent, 0.0) + part
+
+			if not parents:
+				break
+
+			seen.update(parents)
+			frontier = parents
+
+		return triggers
+
+	def stacks(self, key='wt', min_fraction=0.0001, max_depth=256):
+		'''Rebuild approximate call stacks from the edge map, depth first.
+
+		Yields (tuple of symbol ids, self value) pairs. A symbol's value on a
+		stack is split between its children in proportion to its edges, the
+		same way for every caller. Children already on the stack, past
+		max_depth or worth less than min_fraction of the total are folded
+		into the self value of their parent, so values always add up.'''
+		if key not in self.edge_metrics:
+			raise ValueError('Profile does not have %s data' % key)
+
+		values = self.edge_metrics[key]
+		incl = self.columns[key]
+		excl = self.columns['excl_' + key]
+		edge_child = self.edge_child
+
+		main = self.ids['main()']
+		threshold = incl[main] * min_fraction
+		pending = [((main,), float(incl[main]))]
+
+		while pending:
+			path, value = pending.pop()
+			i = path[-1]
+			share = value / incl[i] if incl[i] > 0 else 0.0
+			own = share * max(excl[i], 0)
+			children = []
+
+			for e in self.children(i):
+				child = edge_child[e]
+				child_value = share * values[e]
+
+				if child in path or len(path) >= max_depth or child_value < threshold:
+					own += max(child_value, 0)
+				else:
+					children.append((path + (child,), child_value))
+
+			yield path, own
+
+			# Reversed, so children come out in edge order.
+			pending.extend(reversed(children))
+
+	def children(self, i):
+		'''Edge ids from symbol i to its children'''
+		return self.child_edges[self.child_offsets[i]:self.child_offsets[i + 1]]
+
+	def parents(self, i):
+		'''Edge ids from the parents of symbol i'''
+		return self.parent_edges[self.parent_offsets[i]:self.parent_offsets[i + 1]]
+
+	def add_edge(self, edge, info):
+		if not self.metrics:
+			self.metrics = [m for m in METRICS if m in info]
+			self.edge_metrics = {m: array('q') for m in self.metrics}
+
+		parent, sep, child = edge.partition('==>')
+		if not sep:
+			parent, child = None, edge
+
+		self.edge_parent.append(-1 if parent is None else self.intern(parent))
+		self.edge_child.append(self.intern(child))
+
+		for metric in self.metrics:
+			self.edge_metrics[metric].append(info.get(metric, 0))
+
+	def build(self):
+		'''Compute inclusive and exclusive metrics, adjacency and totals'''
+		n = len(self.symbols)
+		edge_parent = self.edge_parent
+		edge_child = self.edge_child
+
+		if 'main()' not in self.ids:
+			raise ValueError('Profile does not contain main()')
+
+		# Inclusive metrics of a symbol are the sum over the edges into it,
+		# exclusive metrics subtract the edges out of it.
+		for metric in self.metrics:
+			values = self.edge_metrics[metric]
+			incl = array('q', bytes(8 * n))
+			for e, child in enumerate(edge_child):
+				incl[child] += values[e]
+
+			excl = array('q', incl)
+			for e, parent in enumerate(edge_parent):
+				if parent >= 0:
+					excl[parent] -= values[e]
+
+			self.columns[metric] = incl
+			self.columns['excl_' + metric] = excl
+
+		# Columns used by the browser are always available.
+		for metric in ['ct', 'wt', 'mu']:
+			if metric not in self.columns:
+				self.columns[metric] = array('q', bytes(8 * n))
+				self.columns['excl_' + metric] = array('q', bytes(8 * n))
+
+		self.child_offsets, self.child_edges = _csr(edge_parent, n)
+		self.parent_offsets, self.parent_edges = _csr(edge_child, n)
+
+		self._totals()
+
+	def _totals(self):
+		main = self.ids['main()']
+		totals = {'ct': 0, 'wt': 0, 'ut': 0, 'st': 0, 'cpu': 0, 'mu': 0, 'pmu': 0, 'samples': 0,
+			'queries': 0, 'http_reqs': 0}
+
+		for metric in self.metrics:
+			totals[metric] = self.columns[metric][main]
+
+		totals['ct'] = sum(self.columns['ct'])
+
+		ct = self.columns['ct']
+		for i, symbol in enumerate(self.symbols):
+			func = symbol.split('#', 1)[0]
+			if func in QUERY_FUNCTIONS:
+				totals['queries'] += ct[i]
+			elif func in HTTP_FUNCTIONS:
+				totals['http_reqs'] += ct[i]
+
+		for key in ['timestamp', 'method', 'host', 'request_uri']:
+			totals[key] = self.meta.get(key)
+
+		# Aggregated profiles, see aggregate().
+		totals['runs'] = self.meta.get('runs', 1)
+		for stat in STATS:
+			if 'wt:' + stat in self.columns:
+				totals['wt:' + stat] = self.columns['wt:' + stat][main]
+
+		self.totals = totals
+
+def diff(base, new):
+	'''A profile of the differences between two profiles, new minus base, over
+	the union of their call graphs. Metrics are sums over edges, so build()
+	turns the edge deltas into inclusive and exclusive deltas.'''
+	profile = Profile()
+	profile.metrics = [m for m in new.metrics if m in base.metrics]
+	profile.edge_metrics = {m: array('q') for m in profile.metrics}
+
+	base_edges = dict(_edges(base))
+
+	for (parent, child), e in _edges(new):
+		b = base_edges.pop((parent, child), None)
+		_append(profile, parent, child, [new.edge_metrics[m][e] - (base.edge_metrics[m][b] if b is not None else 0)
+			for m in profile.metrics])
+
+	for (parent, child), b in base_edges.items():
+		_append(profile, parent, child, [-base.edge_metrics[m][b] for m in profile.metrics])
+
+	profile.build()
+
+	profile.status = array('b', bytes(len(profile)))
+	for i, symbol in enumerate(profile.symbols):
+		if symbol not in base.ids:
+			profile.status[i] = 1
+		elif symbol not in new.ids:
+			profile.status[i] = -1
+
+	profile.meta = new.meta
+	profile.totals = dict(new.totals, base=base.totals)
+	return profile
+
+# Columns which get median, p95 and stddev columns in aggregated profiles.
+STAT_KEYS = ['ct', 'wt', 'excl_wt', 'mu', 'excl_mu']
+STATS = ['median', 'p95', 'stddev']
+
+def aggregate(profiles):
+	'''Merge several runs of a request into a profile of mean metrics over the
+	union of their call graphs, with median, p95 and stddev columns per symbol
+	(as "wt:p95" etc). Symbols missing from a run count as zero in it.'''
+	runs = len(profiles)
+	profile = Profile()
+	profile.metrics = [m for m in profiles[0].metrics if all(m in p.metrics for p in profiles)]
+	profile.edge_metrics = {m: array('q') for m in profile.metrics}
+
+	sums = {}
+	for p in profiles:
+		for key, e in _edges(p):
+			values = sums.get(key)
+			if values is None:
+				values = sums[key] = [0] * len(profile.metrics)
+
+			for k, metric in enumerate(profile.metrics):
+				values[k] += p.edge_metrics[metric][e]
+
+	for (parent, child), values in sums.items():
+		_append(profile, parent, child, [round(value / runs) for value in values])
+
+	profile.meta = dict(profiles[-1].meta, runs=runs)
+	profile.build()
+
+	for key in STAT_KEYS:
+		if not all(key in p.columns for p in profiles):
+			continue
+
+		runs_values = []
+		for p in profiles:
+			values, ids = p.columns[key], p.ids
+			runs_values.append([values[ids[symbol]] if symbol in ids else 0 for symbol in profile.symbols])
+
+		columns = {stat: array('q') for stat in STATS}
+		for samples in zip(*runs_values):
+			for stat, value in zip(STATS, _stats(samples)):
+				columns[stat].append(value)
+
+		for stat in STATS:
+			profile.columns['%s:%s' % (key, stat)] = columns[stat]
+
+	profile._totals()
+	return profile
+
+def _stats(samples):
+	'''Median, nearest-rank p95 and population standard deviation, rounded'''
+	samples = sorted(samples)
+	n = len(samples)
+	mean = sum(samples) / n
+	middle = n // 2
+	median = samples[middle] if n % 2 else (samples[middle - 1] + samples[middle]) / 2
+	p95 = samples[max(math.ceil(0.95 * n) - 1, 0)]
+	stddev = math.sqrt(sum((x - mean) ** 2 for x in samples) / n)
+	return round(median), p95, round(stddev)
+
+def dump(profile, f):
+	'''Write a profile in the xhprof JSON format, with stats columns if any'''
+	data = dict(profile.meta)
+	data['xhprof'] = {}
+
+	for (parent, child), e in _edges(profile):
+		edge = child if parent is None else '%s==>%s' % (parent, child)
+		data['xhprof'][edge] = {m: profile.edge_metrics[m][e] for m in profile.metrics}
+
+	stats = {key: list(values) for key, values in profile.columns.items() if ':' in key}
+	if stats:
+		data['aggregate'] = {'symbols': profile.symbols, 'columns': stats}
+
+	json.dump(data, f)
+
+def _edges(profile):
+	'''(parent, child) symbol names and id of every edge'''
+	for e, child in enumerate(profile.edge_child):
+		parent = profile.edge_parent[e]
+		yield (profile.symbols[parent] if parent >= 0 else None, profile.symbols[child]), e
+
+def _append(profile, parent, child, values):
+	profile.edge_parent.append(-1 if parent is None else profile.intern(parent))
+	profile.edge_child.append(profile.intern(child))
+	for metric, value in zip(profile.metrics, values):
+		profile.edge_metrics[metric].append(value)
+
+def _csr(keys, n):
+	'''Group edge ids by a key (parent or child id) with a counting sort'''
+	offsets = array('i', bytes(4 * (n + 1)))
+	for key in keys:
+		if key >= 0:
+			offsets[key + 1] += 1
+
+	for i in range(n):
+		offsets[i + 1] += offsets[i]
+
+	edges = array('i', bytes(4 * offsets[n]))
+	position = array('i', offsets)
+	for e, key in enumerate(keys):
+		if key >= 0:
+			edges[position[key]] = e
+			position[key] += 1
+
+	return offsets, edges
+
+def load(f):
+	'''Load an xhprof profile from a text file object, reading it incrementally'''
+	reader = _Reader(f)
+	profile = Profile()
+
+	for key in reader.items():
+		if key == 'xhprof':
+			for batch in reader.batches():
+				for edge, info in batch:
+					profile.add_edge(edge, info)
+		else:
+			profile.meta[key] = reader.value()
+
+	stats = profile.meta.pop('aggregate', None)
+	profile.build()
+
+	if stats:
+		for key, values in stats['columns'].items():
+			column = array('q', bytes(8 * len(profile)))
+			for symbol, value in zip(stats['symbols'], values):
+				column[profile.ids[symbol]] = value
+
+			profile.columns[key] = column
+
+		profile._totals()
+
+	return profile
+
+# Binary sidecar cache, written next to a profile on first open. A JSON header
+# with the symbol table and array layout is followed by the raw arrays, which
+# are memory-mapped on later opens. The source size and mtime invalidate it.
+CACHE_MAGIC = b'SAILXHP1'
+CACHE_VERSION = 3
+
+def _cache_path(path):
+	return path.with_name(path.name + '.idx')
+
+def _arrays(profile):
+	arrays = {'edge_parent': profile.edge_parent, 'edge_child': profile.edge_child,
+		'child_offsets': profile.child_offsets, 'child_edges': profile.child_edges,
+		'parent_offsets': profile.parent_offsets, 'parent_edges': profile.parent_edges}
+
+	for key, values in profile.columns.items():
+		arrays['column:' + key] = values
+
+	for key, values in profile.edge_metrics.items():
+		arrays['edge:' + key] = values
+
+	for key, values in profile.orders.items():
+		arrays['order:' + key] = values
+
+	if profile.trigrams is not None:
+		arrays['trigram_offsets'] = profile.trigram_offsets
+		arrays['trigram_postings'] = profile.trigram_postings
+
+	return arrays
+
+def write_cache(profile, path):
+	'''Write the binary sidecar for a profile loaded from path'''
+	stat = os.stat(path)
+	arrays = _arrays(profile)
+	layout = {}
+	offset = 0
+
+	for key, values in arrays.items():
+		typecode = values.typecode if isinstance(values, array) else values.format
+		layout[key] = [offset, typecode, len(values)]
+		offset += len(values) * values.itemsize
+		offset += -offset % 8
+
+	header = json.dumps({'version': CACHE_VERSION, 'byteorder': sys.byteorder,
+		'source': [stat.st_size, stat.st_mtime_ns], 'meta': profile.meta, 'metrics': profile.metrics,
+		'totals': profile.totals, 'symbols': profile.symbols, 'arrays': layout,
+		'trigrams': sorted(profile.trigrams, key=profile.trigrams.get) if profile.trigrams is not None else None}).encode('utf8')
+	header += b' ' * (-(len(CACHE_MAGIC) + 4 + len(header)) % 8)
+
+	target = _cache_path(path)
+	temp = target.with_name(target.name + '.tmp')
+
+	with temp.open('wb') as f:
+		f.write(CACHE_MAGIC + struct.pack('<I', len(header)) + header)
+		for key, values in arrays.items():
+			data = values.tobytes() if isinstance(values, array) else bytes(values)
+			f.write(data + b'\0' * (-len(data) % 8))
+
+	os.replace(temp, target)
+
+def read_cache(path):
+	'''Map the binary sidecar of a profile, None if missing or out of date'''
+	target = _cache_path(path)
+
+	try:
+		stat = os.stat(path)
+		with target.open('rb') as f:
+			if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+				return None
+
+			length, = struct.unpack('<I', f.read(4))
+			header = json.loads(f.read(length))
+			start = len(CACHE_MAGIC) + 4 + length
+
+			if header['version'] != CACHE_VERSION or header['byteorder'] != sys.byteorder:
+				return None
+
+			if header['source'] != [stat.st_size, stat.st_mtime_ns]:
+				return None
+
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > start else b''
+	except (OSError, ValueError, KeyError):
+		return None
+
+	view = memoryview(data)
+	profile = Profile()
+	profile.meta = header['meta']
+	profile.metrics = header['metrics']
+	profile.totals = header['totals']
+	profile.symbols = header['symbols']
+	profile.ids = {symbol: i for i, symbol in enumerate(profile.symbols)}
+
+	if header['trigrams'] is not None:
+		profile.trigrams = {trigram: k for k, trigram in enumerate(header['trigrams'])}
+
+	for key, (offset, typecode, length) in header['arrays'].items():
+		size = array(typecode).itemsize
+		values = view[start + offset:start + offset + length * size].cast(typecode)
+
+		if key.startswith('column:'):
+			profile.columns[key[len('column:'):]] = values
+		elif key.startswith('edge:'):
+			profile.edge_metrics[key[len('edge:'):]] = values
+		elif key.startswith('order:'):
+			profile.orders[key[len('order:'):]] = values
+		else:
+			setattr(profile, key, values)
+
+	return profile
+
+def read(path, orders=()):
+	'''Load a profile from a JSON file, through its binary sidecar when valid.
+	Sort orders for the given columns and the search index are computed once
+	and kept in the sidecar.'''
+	profile = read_cache(path)
+	if profile and profile.trigrams is not None and all(key in profile.orders for key in orders):
+		return profile
+
+	if not profile:
+		with path.open('r') as f:
+			profile = load(f)
+
+	for key in orders:
+		profile.order(key)
+
+	if profile.trigrams is None:
+		profile.index_trigrams()
+
+	try:
+		write_cache(profile, path)
+	except OSError:
+		pass
+
+	return profile